@@ -0,0 +1,437 @@
+"""Benchmarks for the ledger, deflator and valuation hot paths of main.py.
+
+Runs against synthetic portfolios in a temporary directory; quotes come from a local stub server,
+so no request leaves the machine. Results are printed (or written) as JSON and can be compared
+with an earlier run:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --sizes 1000,10000,100000,1000000 --compare baseline.json
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import py_compile
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import main
+
+
+SYMBOLS_TR = ['THYAO', 'ASELS', 'GARAN', 'BIMAS', 'KCHOL', 'SISE', 'EREGL', 'TUPRS', 'AKBNK', 'FROTO']
+SYMBOLS_US = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'JPM', 'KO', 'PEP']
+UNLIMITED_RATE = (1e9, 10 ** 9)  # the stub server is local, so only bench_scheduler rate-limits it
+
+
+class StubQuoteHandler(BaseHTTPRequestHandler):
+    # Answers like the three quote sources main.py scrapes; requests arrive as /<original host><path>.
+    latency = 0.0
+    page_kb = 0
+    tail_every = 0  # every n-th CNBC answer is delayed by tail_latency, for the hedging benchmark
+    tail_latency = 0.0
+    served = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip('/').partition('/')
+        if host == 'www.isyatirim.com.tr' and path.endswith('OneEndeks'):
+            symbol = parse_qs(parts.query).get('endeks', [''])[0]
+            body = json.dumps([{'symbol': symbol, 'last': stub_price(symbol)}]).encode()
+            content_type = 'application/json'
+        elif host == 'www.cnbc.com':
+            StubQuoteHandler.served += 1
+            if self.tail_every and StubQuoteHandler.served % self.tail_every == 0:
+                time.sleep(self.tail_latency)
+            symbol = path.rsplit('/', 1)[-1]
+            body = quote_page('span', 'QuoteStrip-lastPrice', stub_price(symbol), self.page_kb)
+            content_type = 'text/html'
+        elif host == 'kur.doviz.com':
+            body = quote_page('div', 'text-xl font-semibold text-white', '41,2345', self.page_kb)
+            content_type = 'text/html'
+        else:
+            body = b'<html></html>'  # e.g. the Is Yatirim page visited for its cookie
+            content_type = 'text/html'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass  # the client stopped reading once it had the quote
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubQuoteServer(ThreadingHTTPServer):
+    # A listen backlog of 5 (the default) drops connection attempts of a concurrent fetch and stalls
+    # them for a TCP retransmit.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def stub_price(symbol: str) -> str:
+    return f"{10 + sum(map(ord, symbol)) % 290}.25"
+
+
+def quote_page(tag: str, class_name: str, value: str, size_kb: int) -> bytes:
+    # A page of about size_kb with the quote a tenth of the way in, like the real pages (header markup,
+    # scripts and the quote strip first, then news, tables and footer).
+    filler = '<div class="row"><a href="/x">headline</a><script>var x = 1;</script></div>\n'
+    rows = size_kb * 1024 // len(filler)
+    head = filler * (rows // 10)
+    tail = filler * (rows - rows // 10)
+    return f'<html><body>{head}<{tag} class="{class_name}">{value}</{tag}>{tail}</body></html>'.encode()
+
+
+@contextlib.contextmanager
+def stub_quote_server(latency: float, page_kb: int = 0, tail_every: int = 0, tail_latency: float = 0.0):
+    # Routes main.http_get to the stub server for the duration of the block.
+    StubQuoteHandler.latency = latency
+    StubQuoteHandler.page_kb = page_kb
+    StubQuoteHandler.tail_every = tail_every
+    StubQuoteHandler.tail_latency = tail_latency
+    StubQuoteHandler.served = 0
+    server = StubQuoteServer(('127.0.0.1', 0), StubQuoteHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    real_http_get = main.http_get
+    stub = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def http_get(url, **kwargs):
+        parts = urlsplit(url)
+        return real_http_get(f"{stub}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else ''), **kwargs)
+
+    main.http_get = http_get
+    try:
+        yield
+    finally:
+        main.http_get = real_http_get
+        server.shutdown()
+        server.server_close()
+
+
+def write_inflation(directory: str, years: int, first_year: int):
+    rng = random.Random(1)
+    with open(os.path.join(directory, 'inflation.csv'), mode='w', newline='') as f:
+        f.write('month,year,country,rate\r\n')
+        for year in range(first_year, first_year + years):
+            for month in range(1, 13):
+                f.write(f"{month},{year},TR,{rng.uniform(0.5, 6):.2f}\r\n")
+                f.write(f"{month},{year},US,{rng.uniform(-0.2, 0.8):.2f}\r\n")
+
+
+def write_ledger(directory: str, size: int, first_day: date, days: int):
+    # Purchases and sales of 20 symbols spread over the period; sales never exceed the position.
+    rng = random.Random(size)
+    held = {}
+    with open(os.path.join(directory, 'operations.csv'), mode='w', newline='') as f:
+        f.write(','.join(main.OPERATIONS_FIELDS) + '\r\n')
+        for i in range(1, size + 1):
+            country, symbols = ('TR', SYMBOLS_TR) if rng.random() < 0.5 else ('US', SYMBOLS_US)
+            symbol = rng.choice(symbols)
+            qty = rng.randint(1, 50)
+            kind = 'sale' if held.get(symbol, 0) >= qty and rng.random() < 0.3 else 'purchase'
+            held[symbol] = held.get(symbol, 0) + (qty if kind == 'purchase' else -qty)
+            rate = Decimal(rng.randint(500, 4200)) / 100
+            price = Decimal(rng.randint(100, 30000)) / 100
+            currency = 'TL' if country == 'TR' else 'USD'
+            tl_price, usd_price = main.operation_totals(price, Decimal(qty), rate, currency)
+            day = first_day + timedelta(days=days * i // (size + 1))
+            f.write(f"{i},{symbol},{country},{kind},{price},{qty},1,{rate},{currency},{day},{tl_price},{usd_price}\r\n")
+
+
+def measure(fn, repeat: int) -> float:
+    # Best wall time of repeat runs, in seconds.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(name: str, size: int, seconds: float, items: int | None = None) -> dict:
+    entry = {'name': name, 'size': size, 'seconds': round(seconds, 6)}
+    if items:
+        entry['per_item_us'] = round(seconds / items * 1e6, 3)
+    print(f"{name:<28}{size:>10}{seconds * 1000:>12.2f} ms", file=sys.stderr)
+    return entry
+
+
+def bench_deflators(directory: str, first_year: int, repeat: int) -> list[dict]:
+    main.set_portfolio(directory)
+    today = date.today()
+    months = list(main.iter_year_months(first_year, 1, today.year, today.month))
+
+    def cold():
+        main.set_portfolio(directory)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, main.CPI_INDEX_FILE))
+        main.build_deflators('TR', first_year, 1, months)
+
+    main.build_deflators('TR', first_year, 1, months)
+    return [
+        result('build_deflators_cold', len(months), measure(cold, repeat), len(months)),
+        result('build_deflators_warm', len(months), measure(lambda: main.build_deflators('TR', first_year, 1, months), repeat), len(months)),
+    ]
+
+
+def bench_ledger(directory: str, size: int, repeat: int, appends: int) -> list[dict]:
+    main.set_portfolio(directory)
+    main.FAST_MATH = False
+    results = [
+        result('aggregate_cash_flows', size, measure(lambda: main.aggregate_cash_flows(main.iter_operations(), 'TL'), repeat), size),
+        result('prepare_real_profit', size, measure(lambda: main.prepare_real_profit('TR'), repeat), size),
+    ]
+    if main.load_numpy() is not None:
+        main.FAST_MATH = True
+        results.append(result('prepare_real_profit_fast', size, measure(lambda: main.prepare_real_profit('TR'), repeat), size))
+        main.FAST_MATH = False
+    results.append(result('rebuild_positions', size, measure(main.rebuild_positions, repeat), size))
+
+    # Id allocation and append through share_purchase on a ledger of this size.
+    main.ensure_ledger_index()
+
+    def purchases():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(appends):
+                main.share_purchase('THYAO', 'TR', 'purchase', Decimal('100'), Decimal('1'), Decimal('0'),
+                                    Decimal('40'), 'TL', '2024-01-02')
+
+    results.append(result('share_purchase', size, measure(purchases, 1), appends))
+    return results
+
+
+def bench_show_stocks(holdings: int, repeat: int) -> dict:
+    rows = [{'share_name': f"S{i:04d}", 'country_name': 'TR' if i % 2 else 'US', 'quantity': str(i + 1),
+             'price': Decimal('123.45') + i} for i in range(holdings)]
+
+    def show():
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.print_stock_summary(main.stock_summary(rows, Decimal('41.2345')))
+
+    return result('show_stocks_format', holdings, measure(show, repeat), holdings)
+
+
+def bench_quotes(repeat: int, latency: float, page_kb: int) -> list[dict]:
+    symbols = [('TR', s) for s in SYMBOLS_TR] + [('US', s) for s in SYMBOLS_US]
+
+    def fetch():
+        main._quote_cache.clear()
+        prices, failed = main.fetch_share_prices(symbols)
+        if failed or main.get_usd_try() is None:
+            raise RuntimeError(f"stub quote server did not answer for {failed}")
+        if any(prices[('US', s)] != Decimal(stub_price(s)) for s in SYMBOLS_US):
+            raise RuntimeError('stub quotes were parsed wrongly')
+        if not os.path.exists(main.portfolio_path(main.QUOTE_CACHE_FILE)):
+            raise RuntimeError('fetched quotes were not saved to the quote cache file')
+
+    with stub_quote_server(latency, page_kb):
+        results = [result('fetch_share_prices', len(symbols), measure(fetch, repeat), len(symbols))]
+    # Quote pages parsed from memory: the streamed scan against the full lxml DOM and XPath it replaces.
+    page = quote_page('span', 'QuoteStrip-lastPrice', '123.25', page_kb)
+    chunks = [page[i:i + main.STREAM_CHUNK_SIZE] for i in range(0, len(page), main.STREAM_CHUNK_SIZE)]
+    pattern = main.element_text_pattern('span', 'QuoteStrip-lastPrice')
+    xpath = '//span[@class="QuoteStrip-lastPrice"]/text()'
+    if main.scan_element_text(chunks, pattern)[0] != main.xpath_text(page, xpath):
+        raise RuntimeError('streamed and XPath extraction disagree')
+    results.append(result('parse_quote_stream', page_kb, measure(lambda: main.scan_element_text(chunks, pattern), repeat * 10)))
+    results.append(result('parse_quote_xpath', page_kb, measure(lambda: main.xpath_text(page, xpath), repeat * 10)))
+    return results
+
+
+def bench_startup(directory: str, repeat: int) -> list[dict]:
+    # Fresh interpreters: the bare interpreter, importing main, and a short offline headless run
+    # (python -m reuses the cached bytecode of main.py). Imports of main are checked to stay lazy.
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here, REEL_PROFIT_TIMINGS='')
+    commands = [
+        ('startup_interpreter', [sys.executable, '-c', 'pass']),
+        ('startup_import_main', [sys.executable, '-c', 'import main']),
+        ('startup_headless_calc', [sys.executable, '-m', 'main', '--portfolio', directory, 'calc',
+                                   '--ref', 'TR', '--prices', 'history', '--fx', 'history']),
+    ]
+    py_compile.compile(os.path.join(here, 'main.py'))  # cached bytecode, also under PYTHONDONTWRITEBYTECODE
+    results = [result(name, 1, measure(lambda: subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                                                               stderr=subprocess.DEVNULL), repeat))
+               for name, command in commands]
+    check = "import main, sys; print(','.join(m for m in main.LAZY_MODULES if m in sys.modules))"
+    eager = subprocess.run([sys.executable, '-c', check], env=env, capture_output=True, text=True, check=True).stdout.strip()
+    if eager:
+        raise RuntimeError(f"importing main loaded {eager}")
+    return results
+
+
+def bench_hedging(directory: str, quotes: int, page_kb: int) -> list[dict]:
+    # One CNBC answer in 40 takes 300 ms. US quotes are fetched one by one with CNBC alone and with a
+    # quote file as backup provider, which is asked once CNBC runs past its p95 latency.
+    quote_file = os.path.join(directory, 'quotes.csv')
+    with open(quote_file, mode='w', newline='') as f:
+        f.write('country,symbol,price\r\n' + ''.join(f"US,{s},{stub_price(s)}\r\n" for s in SYMBOLS_US))
+    saved = {market: list(providers) for market, providers in main._quote_providers.items()}
+    results = []
+    try:
+        for name, backup in (('quote_tail_primary_only', False), ('quote_tail_hedged', True)):
+            main._quote_providers['US'] = [main.QuoteProvider('cnbc', main.get_share_price_us)]
+            if backup:
+                main.use_quote_file(quote_file)
+            latencies = []
+            with stub_quote_server(0.0, page_kb, tail_every=40, tail_latency=0.3):
+                for i in range(quotes):
+                    start = time.perf_counter()
+                    if main.fetch_quote('US', SYMBOLS_US[i % len(SYMBOLS_US)]) is None:
+                        raise RuntimeError('no quote from the stub server or the quote file')
+                    latencies.append(time.perf_counter() - start)
+            latencies = sorted(latencies[main.HEDGE_MIN_SAMPLES:])  # hedging starts once the p95 is known
+            p99 = latencies[int(0.99 * (len(latencies) - 1))]
+            results.append(result(f"{name}_p99", quotes, p99))
+            results.append(result(f"{name}_max", quotes, latencies[-1]))
+    finally:
+        main._quote_providers.clear()
+        main._quote_providers.update(saved)
+        main.QUOTE_FILE = None
+    return results
+
+
+def bench_scheduler(page_kb: int, symbols: int, rate: float) -> list[dict]:
+    # Three portfolios' worth of overlapping US holdings through the async scheduler, with the stub host
+    # limited to `rate` requests per second: each symbol must be requested once, and quotes stream in
+    # long before the last one arrives.
+    holdings = [('US', f"S{i:04d}") for i in range(symbols)] * 3
+    main._quote_cache.clear()
+    main.DEFAULT_HOST_RATE = (rate, 10)
+    try:
+        with stub_quote_server(0.0, page_kb):
+            start = time.perf_counter()
+            arrivals = [time.perf_counter() - start for key, price in main.iter_quotes(holdings) if price is not None]
+            served = StubQuoteHandler.served
+    finally:
+        main.DEFAULT_HOST_RATE = UNLIMITED_RATE
+        main._host_buckets.clear()
+    if len(arrivals) != symbols or served != symbols:
+        raise RuntimeError(f"{len(arrivals)} quotes from {served} requests for {symbols} symbols")
+    return [result('quote_scheduler_first', symbols, arrivals[0]),
+            result('quote_scheduler_all', symbols, arrivals[-1], symbols)]
+
+
+def check_fresh_numpy_paths(directory: str):
+    # numpy is imported on first use, so the vectorized entry points must load it themselves: run them in
+    # an interpreter where nothing else has touched numpy yet.
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = ("import main, sys\n"
+              "main.set_portfolio(sys.argv[1])\n"
+              "assert 'numpy' not in sys.modules\n"
+              "ok, exact, fast = main.check_fast_math('TR')\n"
+              "assert ok, (exact, fast)\n"
+              "main.FAST_MATH = True\n"
+              "main.prepare_real_profit('TR')\n"
+              "flows = [-100.0] * 299 + [40000.0]\n"
+              "assert main.xirr([i / 12 for i in range(300)], flows) is not None\n")
+    checked = subprocess.run([sys.executable, '-c', script, directory], env=dict(os.environ, PYTHONPATH=here),
+                             capture_output=True, text=True)
+    if checked.returncode != 0:
+        raise RuntimeError(f"numpy paths fail in a fresh interpreter:\n{checked.stderr}")
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    with open(baseline_path, mode='r') as f:
+        baseline = {(entry['name'], entry['size']): entry['seconds'] for entry in json.load(f)['results']}
+    regressions = []
+    for entry in results:
+        before = baseline.get((entry['name'], entry['size']))
+        if before and entry['seconds'] > before * (1 + threshold):
+            regressions.append(f"{entry['name']} ({entry['size']}): {before * 1000:.2f} ms -> {entry['seconds'] * 1000:.2f} ms")
+    return regressions
+
+
+def run(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma-separated ledger sizes (operations)')
+    parser.add_argument('--years', type=int, default=25, help='length of the synthetic inflation series')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement; the best is kept')
+    parser.add_argument('--appends', type=int, default=200, help='share_purchase calls per ledger size')
+    parser.add_argument('--holdings', type=int, default=500, help='rows formatted by the stock summary')
+    parser.add_argument('--stub-latency', type=float, default=0.0, metavar='SECONDS', help='delay of each stub quote')
+    parser.add_argument('--page-kb', type=int, default=512, help='size of the stub CNBC and doviz.com pages')
+    parser.add_argument('--scheduler-symbols', type=int, default=200, help='distinct symbols in the scheduler benchmark')
+    parser.add_argument('--scheduler-rate', type=float, default=100.0, help='stub host rate limit (requests/s) there')
+    parser.add_argument('--hedge-quotes', type=int, default=400, help='quotes fetched one by one in the hedging benchmark')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier --output file; exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline (0.2 = 20%%)')
+    parser.add_argument('--startup-budget', type=float, default=50.0, metavar='MS',
+                        help='allowed time of importing main on top of the bare interpreter; exit 1 above it')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    main.STORAGE_BACKEND = 'csv'
+    main.DEFAULT_HOST_RATE = UNLIMITED_RATE
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        # The series runs through the current year, as the calculations need a rate for the current month.
+        first_year = date.today().year - args.years + 1
+        write_inflation(root, args.years, first_year)
+        results.extend(bench_deflators(root, first_year, args.repeat))
+        for size in sizes:
+            directory = os.path.join(root, f"ledger_{size}")
+            os.mkdir(directory)
+            write_inflation(directory, args.years, first_year)
+            write_ledger(directory, size, date(first_year, 1, 1), 365 * (args.years - 1))
+            results.extend(bench_ledger(directory, size, args.repeat, args.appends))
+            if main.load_numpy() is not None and size == sizes[0]:
+                check_fresh_numpy_paths(directory)
+        startup = bench_startup(root, args.repeat)
+        results.extend(startup)
+        results.extend(bench_hedging(root, args.hedge_quotes, args.page_kb))
+        results.append(bench_show_stocks(args.holdings, args.repeat))
+        # Fetched quotes are saved to quote_cache.json as in real runs, in a portfolio of the temp directory.
+        main.set_portfolio(root)
+        results.extend(bench_quotes(args.repeat, args.stub_latency, args.page_kb))
+        results.extend(bench_scheduler(args.page_kb, args.scheduler_symbols, args.scheduler_rate))
+        main.set_portfolio('.')
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': getattr(main.load_numpy(), '__version__', None),
+            'repeat': args.repeat,
+            'inflation_years': args.years,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, mode='w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    status = 0
+    import_ms = (startup[1]['seconds'] - startup[0]['seconds']) * 1000
+    if import_ms > args.startup_budget:
+        print(f"Importing main takes {import_ms:.1f} ms, over the {args.startup_budget:g} ms budget", file=sys.stderr)
+        status = 1
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print(f"Slower than baseline: {regression}", file=sys.stderr)
+        status = 1 if regressions else status
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv[1:]))
@@ -1,10 +1,31 @@
 from datetime import datetime
+import argparse
+import atexit
+import sys
 import time
 import csv
-import requests
-from lxml import html
+import functools
+import io
+import json
+import math
+import mmap
+import sqlite3
 import os
+import random
+import re
+import struct
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 from decimal import Decimal, ROUND_HALF_EVEN, InvalidOperation
+from html import unescape
 
 
 #to - do
@@ -13,10 +34,492 @@ from decimal import Decimal, ROUND_HALF_EVEN, InvalidOperation
 # editing past transactions: User will select what he/se wants to edit. 
 # duplicated code
 
+# Opt-in instrumentation (REEL_PROFIT_TIMINGS=1 or the --timings option): call counts, rows and wall time
+# per named section, reported at the end of the run. While disabled a section costs one flag check.
+# Sections running in several threads (quote fetches) add up their time, so they can exceed the wall time.
+INSTRUMENT = os.environ.get('REEL_PROFIT_TIMINGS', '').strip() == '1'
+
+_timings: dict[str, list] = {}  # name -> [calls, rows, seconds]
+_timings_lock = threading.Lock()
+
+
+def record_timing(name: str, seconds: float, rows: int = 0):
+    with _timings_lock:
+        entry = _timings.get(name)
+        if entry is None:
+            entry = _timings[name] = [0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += rows
+        entry[2] += seconds
+
+
+def timed(name: str):
+    # Decorator timing every call of a function under name.
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENT:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_timing(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def timing(name: str):
+    # Times one block, e.g. a phase of a calculation.
+    if not INSTRUMENT:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+
+def timed_rows(name: str, rows):
+    # Counts the rows of a stream and times producing them, not the consumer's work between them.
+    return _timed_rows(name, rows) if INSTRUMENT else rows
+
+
+def _timed_rows(name: str, rows):
+    iterator = iter(rows)
+    count = 0
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            count += 1
+            yield row
+    finally:
+        record_timing(name, seconds, count)
+
+
+def timings_report() -> list[dict]:
+    with _timings_lock:
+        entries = sorted(_timings.items(), key=lambda item: item[1][2], reverse=True)
+    return [{'section': name, 'calls': calls, 'rows': rows, 'seconds': round(seconds, 6)}
+            for name, (calls, rows, seconds) in entries]
+
+
+@contextmanager
+def instrumented_run(timings: str | None = None, profile_path: str | None = None, trace_memory: bool = False):
+    # Wraps a whole run: timings ('text' or 'json') turns the sections on, profile_path collects a cProfile
+    # of the run into that file and trace_memory records allocations with tracemalloc. The report goes to
+    # stderr so it never mixes with --json output. Nothing is collected in calc-many worker processes.
+    global INSTRUMENT
+    if timings:
+        INSTRUMENT = True
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall_seconds = time.perf_counter() - started
+        memory = None
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            memory = {'current_bytes': current, 'peak_bytes': peak,
+                      'top': [{'where': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count} for stat in top]}
+        if profiler is not None:
+            profiler.dump_stats(profile_path)
+        if timings == 'json':
+            json.dump({'wall_seconds': round(wall_seconds, 6), 'timings': timings_report(), 'memory': memory},
+                      sys.stderr, indent=2)
+            print(file=sys.stderr)
+        elif timings or INSTRUMENT:
+            print_timings_report(timings_report(), wall_seconds)
+        if memory is not None and timings != 'json':
+            print(f"Memory: peak {memory['peak_bytes'] / 1024:.1f} KiB, current {memory['current_bytes'] / 1024:.1f} KiB", file=sys.stderr)
+            for entry in memory['top']:
+                print(f"  {entry['bytes'] / 1024:>10.1f} KiB  {entry['where']}", file=sys.stderr)
+        if profiler is not None:
+            import pstats
+            print(f"Profile written to {profile_path}; top functions by cumulative time:", file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(15)
+
+
+def print_timings_report(report: list[dict], wall_seconds: float | None = None, file=sys.stderr):
+    print(f"{'Section':<30}{'Calls':>8}{'Rows':>10}{'Total ms':>12}{'Avg ms':>10}", file=file)
+    for entry in report:
+        total_ms = entry['seconds'] * 1000
+        print(f"{entry['section']:<30}{entry['calls']:>8}{entry['rows'] or '':>10}{total_ms:>12.2f}"
+              f"{total_ms / entry['calls']:>10.3f}", file=file)
+    if wall_seconds is not None:
+        print(f"{'Wall time':<30}{'':>8}{'':>10}{wall_seconds * 1000:>12.2f}", file=file)
+
+
+# requests, lxml and numpy take most of the start-up time, so they are imported on first use: commands
+# that stay offline (inflation editing, manual or stored prices) never load them.
+LAZY_MODULES = ('requests', 'lxml', 'numpy', 'multiprocessing', 'asyncio')
+requests = None
+HTTPAdapter = None
+html = None
+np = None  # optional: FAST_MATH, large XIRR/TWR flow lists and scenario grids
+_numpy_loaded = False
+
+
+def load_requests():
+    global requests, HTTPAdapter
+    if requests is None:
+        import requests as module
+        from requests.adapters import HTTPAdapter
+        requests = module
+    return requests
+
+
+def load_html():
+    global html
+    if html is None:
+        from lxml import html as module
+        html = module
+    return html
+
+
+def load_numpy():
+    # None when numpy is not installed.
+    global np, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy as module
+            np = module
+        except ImportError:
+            np = None
+    return np
+
+
+# One pooled keep-alive session per host, shared by every quote/FX request of the run.
+_sessions: dict[str, 'requests.Session'] = {}
+_session_requests: dict[str, int] = {}
+_session_retries: dict[str, int] = {}
+_sessions_lock = threading.Lock()
+_isyatirim_warmed = False
+
+# Requests per second and burst allowed per host; every request, retries included, takes a token first.
+HOST_RATES = {'www.cnbc.com': (5.0, 10), 'www.isyatirim.com.tr': (5.0, 10), 'kur.doviz.com': (2.0, 4)}
+DEFAULT_HOST_RATE = (10.0, 10)
+# Connection errors and 429/5xx answers are retried after HTTP_BACKOFF seconds, doubled for every further
+# attempt (with jitter, at most HTTP_BACKOFF_MAX or the server's Retry-After). Read timeouts are not
+# retried: the hedged backup provider covers a slow host better than waiting another timeout.
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_BACKOFF_MAX = 8.0
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'lock')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Takes a token, waiting for it if the bucket is empty. Tokens are reserved in arrival order, so the
+        # balance goes negative while callers queue up.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_host_buckets: dict[str, TokenBucket] = {}
+
+
+def get_session(host: str) -> 'requests.Session':
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = load_requests().Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+            session.headers.update({'User-Agent': 'Mozilla/5.0'})
+            _sessions[host] = session
+            _session_requests[host] = 0
+            _session_retries[host] = 0
+            _host_buckets[host] = TokenBucket(*HOST_RATES.get(host, DEFAULT_HOST_RATE))
+        return session
+
+
+def retry_delay(attempt: int, response=None) -> float:
+    delay = min(HTTP_BACKOFF * 2 ** attempt, HTTP_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), HTTP_BACKOFF_MAX))
+    return delay
+
+
+def http_get(url: str, **kwargs) -> 'requests.Response':
+    requests = load_requests()
+    host = urlsplit(url).netloc
+    session = get_session(host)
+    bucket = _host_buckets[host]
+    kwargs.setdefault('timeout', 10)
+    for attempt in range(HTTP_RETRIES + 1):
+        bucket.acquire()
+        with _sessions_lock:
+            _session_requests[host] += 1
+            if attempt:
+                _session_retries[host] += 1
+        try:
+            response = session.get(url, **kwargs)
+        except requests.ConnectionError:  # includes connect timeouts
+            if attempt == HTTP_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                return response
+            delay = retry_delay(attempt, response)
+            response.close()
+        time.sleep(delay)
+
+
+# Quote pages are read in chunks and scanned for the one element holding the value; reading stops once it
+# is found. The pattern follows XPath's //tag[@class="..."]/text(): exact class attribute, first text node.
+# Pages where it does not match (other attribute quoting, markup changes) fall back to lxml and the XPath.
+STREAM_CHUNK_SIZE = 16 * 1024
+# After the match, a body with at most this much left is drained so the keep-alive connection is reused;
+# a larger (or unknown) rest is dropped with the connection, which is cheaper than downloading it.
+STREAM_DRAIN_LIMIT = 64 * 1024
+
+
+def element_text_pattern(tag: str, class_name: str) -> re.Pattern:
+    return re.compile(rb'<' + tag.encode() + rb'\b[^>]*?\sclass\s*=\s*(["\'])' + re.escape(class_name.encode())
+                      + rb'\1[^>]*>([^<]*)<', re.IGNORECASE)
+
+
+def scan_element_text(chunks, pattern: re.Pattern) -> tuple[str | None, bytes]:
+    # Returns the unescaped text of the first match and the bytes read so far; stops reading at the match.
+    # A matching element without leading text (e.g. the value sits in a child element) is left to the XPath.
+    buffer = bytearray()
+    for chunk in chunks:
+        # A new match can only start at or after the last tag opened before this chunk.
+        start = max(buffer.rfind(b'<'), 0)
+        buffer += chunk
+        for match in pattern.finditer(buffer, start):
+            if match.group(2).strip():
+                return unescape(match.group(2).decode('utf-8', errors='replace')), bytes(buffer)
+    return None, bytes(buffer)
+
+
+def xpath_text(content: bytes, xpath: str) -> str | None:
+    values = load_html().fromstring(content).xpath(xpath)
+    return values[0] if values else None
+
+
+def fetch_element_text(url: str, tag: str, class_name: str, **kwargs) -> str | None:
+    # Text of the first <tag class="class_name"> of the page at url. Raises what http_get raises.
+    response = http_get(url, stream=True, **kwargs)
+    try:
+        response.raise_for_status()
+        chunks = response.iter_content(STREAM_CHUNK_SIZE)
+        text, content = scan_element_text(chunks, element_text_pattern(tag, class_name))
+        if text is not None:
+            length = response.headers.get('Content-Length')
+            # Content-Length and raw.tell() count the bytes on the wire, i.e. before decompression.
+            if length is not None and length.isdigit() and int(length) - response.raw.tell() <= STREAM_DRAIN_LIMIT:
+                for _ in chunks:  # rest of the body, so the connection goes back to the pool
+                    pass
+            return text
+        return xpath_text(content, f'//{tag}[@class="{class_name}"]/text()')
+    finally:
+        response.close()
+
+
+def session_stats() -> dict[str, dict[str, int]]:
+    # requests sent vs. TCP/TLS connections opened per host; the difference was served by keep-alive.
+    stats = {}
+    with _sessions_lock:
+        for host, session in _sessions.items():
+            pools = session.get_adapter('https://').poolmanager.pools
+            connections = sum(pools[key].num_connections for key in pools.keys())
+            sent = _session_requests[host]
+            stats[host] = {'requests': sent, 'connections': connections, 'reused': max(sent - connections, 0),
+                           'retries': _session_retries[host]}
+    return stats
+
+
+def warm_isyatirim_session(referer: str) -> bool:
+    # Is Yatirim only answers the data endpoint after the cookie from a page visit is set; do it once per run.
+    global _isyatirim_warmed
+    if _isyatirim_warmed:
+        return True
+    try:
+        http_get(referer)
+    except Exception:
+        return False
+    _isyatirim_warmed = True
+    return True
+
+
+# Quote cache keyed by (country, symbol) for shares and ('FX', pair) for exchange rates. Only live quotes
+# are cached; prices of local providers (the quote file) are read from their source every time.
+QUOTE_CACHE_TTL = 300  # seconds a quote is served without hitting the network
+QUOTE_CACHE_SIZE = 256  # least recently used quotes are evicted beyond this
+QUOTE_CACHE_FILE = 'quote_cache.json'  # in the portfolio directory; None keeps the cache in memory only
+
+_quote_cache: OrderedDict[tuple[str, str], tuple[Decimal, float]] = OrderedDict()
+_quote_cache_loaded = False
+_quote_cache_dirty = False  # entries put since the file was last written
+_quote_cache_lock = threading.Lock()
+
+
+def _load_quote_cache():
+    # Merges the portfolio's cache file into memory; an entry already held is kept when it is newer.
+    global _quote_cache_loaded
+    _quote_cache_loaded = True
+    if not QUOTE_CACHE_FILE or not os.path.exists(portfolio_path(QUOTE_CACHE_FILE)):
+        return
+    try:
+        with open(portfolio_path(QUOTE_CACHE_FILE), mode='r') as f:
+            entries = json.load(f)
+        now = time.time()
+        loaded = {}
+        for country, symbol, value, fetched_at in entries:
+            if now - fetched_at < QUOTE_CACHE_TTL:
+                loaded[(country, symbol)] = (Decimal(value), fetched_at)
+    except (OSError, ValueError, TypeError, InvalidOperation):
+        return
+    for key, entry in loaded.items():
+        if key not in _quote_cache or _quote_cache[key][1] < entry[1]:
+            _quote_cache[key] = entry
+    while len(_quote_cache) > QUOTE_CACHE_SIZE:
+        _quote_cache.popitem(last=False)
+
+
+def save_quote_cache():
+    # Writes the quotes put since the last save, once per batch of fetches rather than once per quote.
+    # The file is written outside the lock so that fetches still running are not held up by the disk.
+    global _quote_cache_dirty
+    with _quote_cache_lock:
+        if not _quote_cache_dirty or not QUOTE_CACHE_FILE:
+            return
+        _quote_cache_dirty = False
+        path = portfolio_path(QUOTE_CACHE_FILE)
+        entries = [[key[0], key[1], str(value), fetched_at] for key, (value, fetched_at) in _quote_cache.items()]
+    try:
+        atomic_write(path, json.dumps(entries).encode('utf-8'))
+    except OSError:
+        pass
+
+
+atexit.register(save_quote_cache)  # quotes fetched one at a time (menus, get_usd_try)
+
+
+def cache_get(key: tuple[str, str]) -> tuple[Decimal, float] | None:
+    # Returns (value, age in seconds) for a fresh entry, otherwise None.
+    with _quote_cache_lock:
+        if not _quote_cache_loaded:
+            _load_quote_cache()
+        entry = _quote_cache.get(key)
+        if entry is None:
+            return None
+        value, fetched_at = entry
+        age = time.time() - fetched_at
+        if age >= QUOTE_CACHE_TTL:
+            del _quote_cache[key]
+            return None
+        _quote_cache.move_to_end(key)
+        return value, age
+
+
+def cache_put(key: tuple[str, str], value: Decimal):
+    # In memory only; save_quote_cache writes the file.
+    global _quote_cache_dirty
+    with _quote_cache_lock:
+        if not _quote_cache_loaded:
+            _load_quote_cache()
+        _quote_cache[key] = (value, time.time())
+        _quote_cache.move_to_end(key)
+        while len(_quote_cache) > QUOTE_CACHE_SIZE:
+            _quote_cache.popitem(last=False)
+        _quote_cache_dirty = True
+
+
+# Quotes being fetched right now: key -> (done event, [value]). A caller asking for a key that is in flight
+# waits for that fetch instead of starting another, so concurrent portfolios or menus share one request.
+_quotes_in_flight: dict[tuple[str, str], tuple[threading.Event, list]] = {}
+
+
+def reload_quote_cache():
+    # The cache file belongs to the portfolio directory: save the quotes fetched for the current one and
+    # merge the new one's on the next lookup. Call before switching PORTFOLIO_DIR.
+    global _quote_cache_loaded
+    save_quote_cache()
+    with _quote_cache_lock:
+        _quote_cache_loaded = False
+
+
+def cached_quote(key: tuple[str, str]) -> Decimal | None:
+    # key is (market, symbol); a miss asks the market's providers, and only a live provider's price is cached.
+    hit = cache_get(key)
+    if hit is not None:
+        return hit[0]
+    with _quote_cache_lock:
+        pending = _quotes_in_flight.get(key)
+        owner = pending is None
+        if owner:
+            pending = _quotes_in_flight[key] = (threading.Event(), [None])
+    done, result = pending
+    if not owner:
+        done.wait()
+        return result[0]
+    try:
+        result[0], provider = answered_quote(*key)
+        if result[0] is not None and not provider.local:
+            cache_put(key, result[0])
+    finally:
+        with _quote_cache_lock:
+            del _quotes_in_flight[key]
+        done.set()
+    return result[0]
+
+
+def format_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f}s ago"
+    return f"{int(seconds // 60)}m {seconds % 60:.0f}s ago"
+
+
 def ask_price(country: str, symbol: str) -> Decimal | None:
     while True:
         choice = input(f"How do you want to get the price for {symbol}? Auto (A) / Manual (M) / Cancel (0): ").strip().upper()
         if choice == 'A':
+            hit = cache_get((country, symbol.strip().upper()))
+            if hit is not None:
+                print(f"Using cached price for {symbol}: {hit[0]} (fetched {format_age(hit[1])})")
+                return hit[0]
             price = get_share_price(country, symbol)
             if price is not None:
                 return price
@@ -38,21 +541,20 @@ def ask_price(country: str, symbol: str) -> Decimal | None:
             print("Invalid choice. Please enter A, M, or 0.")
 
 
+@timed('http.isyatirim')
 def get_share_price_tr(name: str) -> Decimal | None:
     name = name.strip().upper()
     referer = f"https://www.isyatirim.com.tr/tr-tr/analiz/hisse/Sayfalar/sirket-karti.aspx?hisse={name}"
     one_endeks_url = f"https://www.isyatirim.com.tr/_layouts/15/Isyatirim.Website/Common/Data.aspx/OneEndeks?endeks={name}"
-    session = requests.Session()
-    ua = "Mozilla/5.0"
+    if not warm_isyatirim_session(referer):
+        return None
     try:
-        session.get(referer, headers={"User-Agent": ua}, timeout=10)
         headers = {
-            "User-Agent": ua,
             "Accept": "application/json, text/plain, */*",
             "Referer": referer,
             "X-Requested-With": "XMLHttpRequest",
         }
-        resp = session.get(one_endeks_url, headers=headers, timeout=10)
+        resp = http_get(one_endeks_url, headers=headers)
         resp.raise_for_status()
         data = resp.json()
     except Exception:
@@ -70,21 +572,18 @@ def get_share_price_tr(name: str) -> Decimal | None:
         return None
 
 
+@timed('http.cnbc')
 def get_share_price_us(name: str) -> Decimal | None:
     name = name.strip().upper()
     base_url = 'https://www.cnbc.com/quotes/'
     url = base_url + name
-    headers = { 'User-Agent': 'Mozilla/5.0' }
     try:
-        response = requests.get(url=url, headers=headers, timeout=10)
-        response.raise_for_status()
-        tree = html.fromstring(response.content)
-        value_list = tree.xpath('//span[@class="QuoteStrip-lastPrice"]/text()')
+        raw = fetch_element_text(url, 'span', 'QuoteStrip-lastPrice')
     except Exception:
         return None
-    if not value_list:
+    if raw is None:
         return None
-    raw = value_list[0].strip()
+    raw = raw.strip()
     # Clean formats like "$ 123.45" or "," thousands
     cleaned = raw.replace(',', '')
     if cleaned.startswith('$'):
@@ -100,12 +599,116 @@ def get_share_price_us(name: str) -> Decimal | None:
 
 
 def get_share_price(country: str, name: str) -> Decimal | None:
-    if country == 'US':
-        return get_share_price_us(name)
-    elif country == 'TR':
-        return get_share_price_tr(name)
-    else:
-        raise ValueError(f"Invalid country: {country}")
+    quote_providers(country)  # ValueError for a market without providers
+    name = name.strip().upper()
+    return cached_quote((country, name))
+
+
+# Quote fetches in flight at once over all hosts; the per-host rates in HOST_RATES apply on top.
+QUOTE_CONCURRENCY = 16
+
+
+async def stream_quotes(holdings: list[tuple[str, str]], concurrency: int = QUOTE_CONCURRENCY):
+    # Yields ((country, symbol), price or None) in the order the quotes arrive; duplicates are fetched once.
+    # The fetches are blocking requests calls, so they run on a pool of `concurrency` worker threads.
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    unique = list(dict.fromkeys((c.strip().upper(), s.strip().upper()) for c, s in holdings))
+    if not unique:
+        return
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(unique))), thread_name_prefix='quote') as pool:
+
+        async def fetch(key):
+            return key, await loop.run_in_executor(pool, get_share_price, key[0], key[1])
+
+        try:
+            for arrival in asyncio.as_completed([fetch(key) for key in unique]):
+                yield await arrival
+        finally:
+            save_quote_cache()
+
+
+def iter_quotes(holdings: list[tuple[str, str]], concurrency: int = QUOTE_CONCURRENCY):
+    # stream_quotes for synchronous callers: the event loop runs in a background thread and every quote
+    # is handed over as soon as it arrives.
+    import asyncio
+    import queue
+    arrivals = queue.Queue()
+    done = object()
+
+    async def collect():
+        async for item in stream_quotes(holdings, concurrency):
+            arrivals.put(item)
+
+    def run():
+        try:
+            asyncio.run(collect())
+        except BaseException as e:
+            arrivals.put(e)
+        arrivals.put(done)
+
+    threading.Thread(target=run, name='quotes', daemon=True).start()
+    while (item := arrivals.get()) is not done:
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def fetch_share_prices(holdings: list[tuple[str, str]], concurrency: int = QUOTE_CONCURRENCY) -> tuple[dict[tuple[str, str], Decimal], list[tuple[str, str]]]:
+    # Fetch every (country, symbol) concurrently; total time is bounded by the slowest quote.
+    prices: dict[tuple[str, str], Decimal] = {}
+    failed: list[tuple[str, str]] = []
+    for key, price in iter_quotes(holdings, concurrency):
+        if price is None:
+            failed.append(key)
+        else:
+            prices[key] = price
+    return prices, failed
+
+
+def ask_prices_for_shares(shares: list[dict]) -> dict[str, Decimal | None] | None:
+    # shares: rows of read_shares(). Returns {share_name: price or None}, or None if cancelled.
+    while True:
+        choice = input("How do you want to get the prices? Auto for all (A) / One by one (O) / Cancel (0): ").strip().upper()
+        if choice in ('A', 'O', '0'):
+            break
+        print("Invalid choice. Please enter A, O, or 0.")
+    if choice == '0':
+        return None
+
+    prices: dict[str, Decimal | None] = {}
+    if choice == 'O':
+        for share in shares:
+            prices[share['share_name']] = ask_price(share['country_name'].strip().upper(), share['share_name'])
+        return prices
+
+    holdings = [(share['country_name'], share['share_name']) for share in shares]
+    for country, symbol in dict.fromkeys((c.strip().upper(), n.strip().upper()) for c, n in holdings):
+        hit = cache_get((country, symbol))
+        if hit is not None:
+            print(f"Using cached price for {symbol}: {hit[0]} (fetched {format_age(hit[1])})")
+    start = time.perf_counter()
+    fetched, failed = fetch_share_prices(holdings)
+    elapsed = time.perf_counter() - start
+    stats = session_stats().values()
+    print(f"Fetched {len(fetched)} of {len(fetched) + len(failed)} prices in {elapsed:.2f}s "
+          f"({sum(s['requests'] for s in stats)} requests over {sum(s['connections'] for s in stats)} connections, "
+          f"{sum(s['retries'] for s in stats)} retried).")
+    for market, rows in provider_stats().items():
+        for row in rows:
+            if row['hedged'] or row['circuit'] == 'open':
+                print(f"{market} quotes from {row['provider']}: {row['hedged']} hedged after {row['p95_ms']} ms (p95), "
+                      f"{row['failures']} failures, circuit {row['circuit']}.")
+    for country, symbol in failed:
+        print(f"Failed to fetch the price for {symbol} ({country}).")
+    for share in shares:
+        key = (share['country_name'].strip().upper(), share['share_name'].strip().upper())
+        if key in fetched:
+            prices[share['share_name']] = fetched[key]
+        else:
+            prices[share['share_name']] = ask_price(key[0], share['share_name'])
+    return prices
 
 
 def round_money(value: Decimal, places: int = 4) -> Decimal:
@@ -114,34 +717,15 @@ def round_money(value: Decimal, places: int = 4) -> Decimal:
 
 
 def read_shares_csv() -> dict[str, Decimal]:
-    with open('shares.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        shares = {}
-        for line in reader:
-            shares[f"{line['share_name']}"] = Decimal(line['quantity'])
-        return shares # type: dict[str, Decimal]
-
-
-def show_stocks():
-    rows = []
-    with open('shares.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for share in reader:
-            price = ask_price(share['country_name'], share['share_name'])
-            share['price'] = price
-            if price is not None:
-                rows.append(share)
-            else:
-                print(f"Failed to get the price for {share['share_name']}. This share will be excluded from the list.")
-
-    dollar = get_dollar() # type: get_dollar() -> Decimal
-    if dollar is None:
-        print("Failed to get the dollar value.")
-        return
+    shares = {}
+    for line in read_shares():
+        shares[f"{line['share_name']}"] = Decimal(line['quantity'])
+    return shares # type: dict[str, Decimal]
 
-    print('_' * 46)
-    print(f"|Share Name|Quantity|Dollar Value|  TL Value  |")
 
+def stock_summary(rows: list[dict], dollar: Decimal) -> dict:
+    # rows: shares with a Decimal 'price' in their native currency.
+    summary_rows = []
     dollar_sum = Decimal('0')
     for share in rows:
         qty = Decimal(str(share['quantity']))
@@ -158,20 +742,57 @@ def show_stocks():
             print('Unexpected country name has been detected.')
             usd_price = tr_price = Decimal('0')
 
-        print(f"|{share['share_name']:^10}|{qty:^8.4f}|{usd_price:^12.4f}|{tr_price:^12.4f}|")
+        summary_rows.append({'share_name': share['share_name'], 'quantity': qty, 'usd_value': usd_price, 'tl_value': tr_price})
         dollar_sum += usd_price
+    return {
+        'usdtry': dollar,
+        'rows': summary_rows,
+        'total_usd': round_money(dollar_sum),
+        'total_tl': round_money(dollar_sum * dollar),
+    }
+
 
-    print(f"|{'Total':^10}|{'----':^8}|{round_money(dollar_sum):^12.4f}|{round_money(dollar_sum*dollar):^12.4f}|")
+def print_stock_summary(summary: dict):
+    print('_' * 46)
+    print(f"|Share Name|Quantity|Dollar Value|  TL Value  |")
+    for row in summary['rows']:
+        print(f"|{row['share_name']:^10}|{row['quantity']:^8.4f}|{row['usd_value']:^12.4f}|{row['tl_value']:^12.4f}|")
+    print(f"|{'Total':^10}|{'----':^8}|{summary['total_usd']:^12.4f}|{summary['total_tl']:^12.4f}|")
     print('¯' * 46)
+
+
+def show_stocks() -> bool:
+    # Returns True if the user chose to exit the application.
+    shares = read_shares()
+
+    prices = ask_prices_for_shares(shares)
+    if prices is None:
+        print('Operation cancelled.')
+        return False
+    rows = []
+    for share in shares:
+        price = prices.get(share['share_name'])
+        share['price'] = price
+        if price is not None:
+            rows.append(share)
+        else:
+            print(f"Failed to get the price for {share['share_name']}. This share will be excluded from the list.")
+
+    dollar = get_usd_try() # type: get_usd_try() -> Decimal
+    if dollar is None:
+        print("Failed to get the dollar value.")
+        return False
+
+    print_stock_summary(stock_summary(rows, dollar))
     while True:
         is_continue = input("If you want to continue, press Y. Press 0 to exit: ").upper()
         if is_continue == 'Y':
-            router()
-            return
+            return False
         elif is_continue == '0':
+            checkpoint_positions()
             print('Exiting...')
             load_bar()
-            return
+            return True
         else:
             print('You can only enter Y or 0.')
 
@@ -184,31 +805,352 @@ def is_valid_date(date_str: str) -> bool:
         return False
 
 
+@timed('http.doviz')
 def get_dollar() -> Decimal:
+    # Used as the 'doviz' FX provider: failures go to stderr so a backup's answer leaves --json output clean.
     url = 'https://kur.doviz.com/serbest-piyasa/amerikan-dolari'
+    requests = load_requests()
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        tree = html.fromstring(response.content)
-        value_strs = tree.xpath('//div[@class="text-xl font-semibold text-white"]/text()')
-        if not value_strs:
-            print("Exchange rate value not found. XPath result is empty.")
+        value_str = fetch_element_text(url, 'div', 'text-xl font-semibold text-white')
+        if value_str is None:
+            print("Exchange rate value not found on the page.", file=sys.stderr)
             return None
-        value_str = value_strs[0]
         try:
             return Decimal(value_str.replace(",", "."))
         except Exception:
-            print(f"Exchange rate value could not be parsed: '{value_str}'")
+            print(f"Exchange rate value could not be parsed: '{value_str}'", file=sys.stderr)
             return None
     except requests.Timeout:
-        print("Timeout occurred while retrieving the exchange rate.")
+        print("Timeout occurred while retrieving the exchange rate.", file=sys.stderr)
         return None
     except requests.RequestException as e:
-        print(f"An error occurred during the exchange rate request: {e}")
+        print(f"An error occurred during the exchange rate request: {e}", file=sys.stderr)
         return None
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        print(f"An unexpected error occurred: {e}", file=sys.stderr)
+        return None
+
+
+def get_usd_try() -> Decimal | None:
+    return cached_quote(('FX', 'USDTRY'))
+
+
+# Quote providers per market ('TR', 'US', and 'FX' for USD/TRY), tried in order. Every provider keeps the
+# latencies of its recent answers and a circuit breaker. When a market has a backup, a primary that has
+# not answered within its p95 latency is hedged: the backup is asked as well and the first price wins.
+PROVIDER_LATENCY_WINDOW = 50  # latest successful calls kept per provider
+HEDGE_MIN_SAMPLES = 10  # no hedging until the primary's p95 rests on this many calls
+HEDGE_WORKERS = 16
+BREAKER_FAILURES = 3  # consecutive failures that open a provider's circuit
+BREAKER_COOLDOWN = 60  # seconds an open circuit skips the provider before one trial call
+QUOTE_FILE = os.environ.get('REEL_PROFIT_QUOTE_FILE') or None  # country,symbol,price rows for the 'file' provider
+
+
+class QuoteProvider:
+    __slots__ = ('name', 'fetch', 'local', 'latencies', 'calls', 'failures', 'hedged',
+                 'consecutive_failures', 'open_until', 'lock')
+
+    def __init__(self, name: str, fetch, local: bool = False):
+        self.name = name
+        self.fetch = fetch  # symbol -> Decimal | None
+        self.local = local  # local providers never trip the breaker: a missing symbol is not an outage
+        self.latencies = deque(maxlen=PROVIDER_LATENCY_WINDOW)
+        self.calls = 0
+        self.failures = 0
+        self.hedged = 0  # calls that outlived the p95 and got a backup request
+        self.consecutive_failures = 0
+        self.open_until = None  # monotonic time; None while the circuit is closed
+        self.lock = threading.Lock()
+
+    def available(self) -> bool:
+        with self.lock:
+            if self.open_until is None:
+                return True
+            now = time.monotonic()
+            if now < self.open_until:
+                return False
+            self.open_until = now + BREAKER_COOLDOWN  # half-open: this caller makes the one trial call
+            return True
+
+    def call(self, symbol: str) -> Decimal | None:
+        start = time.perf_counter()
+        try:
+            value = self.fetch(symbol)
+        except Exception:
+            value = None
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.calls += 1
+            if value is not None:
+                self.latencies.append(elapsed)
+                self.consecutive_failures = 0
+                self.open_until = None
+            elif not self.local:
+                self.failures += 1
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= BREAKER_FAILURES:
+                    self.open_until = time.monotonic() + BREAKER_COOLDOWN
+        return value
+
+    def p95(self) -> float | None:
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[math.ceil(0.95 * len(ordered)) - 1]
+
+
+_quote_providers: dict[str, list[QuoteProvider]] = {}
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def register_quote_provider(market: str, name: str, fetch, local: bool = False):
+    # The first provider registered for a market is its primary; later ones are backups in order.
+    _quote_providers.setdefault(market, []).append(QuoteProvider(name, fetch, local))
+
+
+def quote_providers(market: str) -> list[QuoteProvider]:
+    providers = _quote_providers.get(market)
+    if not providers:
+        raise ValueError(f"Invalid country: {market}")
+    return providers
+
+
+def order_quote_providers(spec: str):
+    # spec like 'US=file,cnbc;FX=file': the listed providers, in this order, become the market's chain.
+    for part in filter(None, (p.strip() for p in spec.split(';'))):
+        market, _, names = part.partition('=')
+        market = market.strip().upper()
+        by_name = {provider.name: provider for provider in quote_providers(market)}
+        chain = []
+        for name in filter(None, (n.strip().lower() for n in names.split(','))):
+            if name not in by_name:
+                raise ValueError(f"Unknown quote provider for {market}: {name} (known: {', '.join(by_name)})")
+            chain.append(by_name[name])
+        if not chain:
+            raise ValueError(f"No quote providers given for {market}")
+        _quote_providers[market] = chain
+
+
+def hedge_pool():
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+        return _hedge_pool
+
+
+def hedged_call(primary: QuoteProvider, backup: QuoteProvider, symbol: str,
+                delay: float) -> tuple[Decimal | None, QuoteProvider | None]:
+    # (price, provider that gave it), or (None, None) when neither did.
+    from concurrent.futures import FIRST_COMPLETED, TimeoutError as FutureTimeout, wait
+    pool = hedge_pool()
+    first = pool.submit(primary.call, symbol)
+    try:
+        value = first.result(timeout=delay)
+    except FutureTimeout:
+        pass
+    else:
+        if value is not None:
+            return value, primary
+        value = backup.call(symbol)
+        return (value, backup) if value is not None else (None, None)
+    with primary.lock:
+        primary.hedged += 1
+    # The slower request is left to finish in the background, so its latency still counts.
+    providers = {first: primary, pool.submit(backup.call, symbol): backup}
+    pending = set(providers)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result() is not None:
+                return future.result(), providers[future]
+    return None, None
+
+
+def answered_quote(market: str, symbol: str) -> tuple[Decimal | None, QuoteProvider | None]:
+    # First price the market's providers give and the provider that gave it: failover in order, hedging a
+    # primary slower than its p95.
+    providers = [provider for provider in quote_providers(market) if provider.available()]
+    i = 0
+    while i < len(providers):
+        delay = providers[i].p95() if i + 1 < len(providers) else None
+        if delay is None:
+            value, provider = providers[i].call(symbol), providers[i]
+            i += 1
+        else:
+            value, provider = hedged_call(providers[i], providers[i + 1], symbol, delay)
+            i += 2
+        if value is not None:
+            return value, provider
+    return None, None
+
+
+def fetch_quote(market: str, symbol: str) -> Decimal | None:
+    return answered_quote(market, symbol)[0]
+
+
+def provider_stats() -> dict[str, list[dict]]:
+    stats = {}
+    for market, providers in _quote_providers.items():
+        rows = []
+        for provider in providers:
+            p95 = provider.p95()
+            with provider.lock:
+                rows.append({'provider': provider.name, 'calls': provider.calls, 'failures': provider.failures,
+                             'hedged': provider.hedged, 'p95_ms': None if p95 is None else round(p95 * 1000, 1),
+                             'circuit': 'closed' if provider.open_until is None else 'open'})
+        stats[market] = rows
+    return stats
+
+
+_file_quotes: dict[tuple[str, str], Decimal] = {}
+_file_quotes_mtime = None
+
+
+def file_quote(market: str, symbol: str) -> Decimal | None:
+    # Quotes from QUOTE_FILE (CSV with a country,symbol,price header; FX,USDTRY for the exchange rate),
+    # re-read when the file changes. For offline runs and as a last-resort backup.
+    global _file_quotes_mtime
+    if not QUOTE_FILE:
+        return None
+    try:
+        mtime = os.stat(QUOTE_FILE).st_mtime_ns
+        if mtime != _file_quotes_mtime:
+            quotes = {}
+            with open(QUOTE_FILE, mode='r', newline='') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        quotes[(row['country'].strip().upper(), row['symbol'].strip().upper())] = \
+                            Decimal(row['price'].strip().replace(',', '.'))
+                    except (AttributeError, KeyError, InvalidOperation):
+                        continue
+            _file_quotes.clear()
+            _file_quotes.update(quotes)
+            _file_quotes_mtime = mtime
+    except OSError:
+        return None
+    return _file_quotes.get((market, symbol))
+
+
+def use_quote_file(path: str):
+    # Adds the 'file' provider as the last backup of every market that does not have it yet.
+    global QUOTE_FILE, _file_quotes_mtime
+    QUOTE_FILE = path
+    _file_quotes_mtime = None
+    for market, providers in _quote_providers.items():
+        if all(provider.name != 'file' for provider in providers):
+            register_quote_provider(market, 'file', functools.partial(file_quote, market), local=True)
+
+
+register_quote_provider('TR', 'isyatirim', get_share_price_tr)
+register_quote_provider('US', 'cnbc', get_share_price_us)
+register_quote_provider('FX', 'doviz', lambda symbol: get_dollar())
+
+
+def configure_quote_providers(quote_file: str | None, spec: str | None):
+    # From --quote-file/--quote-providers or REEL_PROFIT_QUOTE_FILE/REEL_PROFIT_QUOTE_PROVIDERS.
+    if quote_file:
+        use_quote_file(quote_file)
+    if spec:
+        order_quote_providers(spec)
+
+
+# Historical daily closes for offline/back-dated valuations, keyed like the quote cache:
+# (country, symbol) for shares and ('FX', 'USDTRY') for the exchange rate.
+# Each key is one binary file in PRICE_STORE_DIR of the portfolio directory holding date-sorted fixed-width
+# records (date as YYYYMMDD, close in millionths), memory-mapped and binary-searched on lookup.
+# `python main.py import-prices FILE` loads date,country,symbol,close CSV rows into it.
+PRICE_STORE_DIR = 'price_store'
+PRICE_RECORD = struct.Struct('<iq')
+PRICE_SCALE = Decimal('1000000')
+
+_price_maps: dict[tuple[str, str], mmap.mmap | None] = {}
+
+
+def price_store_path(key: tuple[str, str]) -> str:
+    return os.path.join(portfolio_path(PRICE_STORE_DIR), f"{key[0]}_{key[1]}.bin")
+
+
+def open_price_series(key: tuple[str, str]) -> mmap.mmap | None:
+    # Mapped once per run; None if the key has no history.
+    if key not in _price_maps:
+        mapped = None
+        try:
+            with open(price_store_path(key), mode='rb') as f:
+                if os.fstat(f.fileno()).st_size >= PRICE_RECORD.size:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            pass
+        _price_maps[key] = mapped
+    return _price_maps[key]
+
+
+def close_price_store():
+    for mapped in _price_maps.values():
+        if mapped is not None:
+            mapped.close()
+    _price_maps.clear()
+
+
+def historical_close(key: tuple[str, str], date: str) -> Decimal | None:
+    # Last close on or before date (YYYY-MM-DD, day may be past the month end); None if the history starts later.
+    mapped = open_price_series(key)
+    if mapped is None:
+        return None
+    target = int(date.replace('-', ''))
+    lo, hi = 0, len(mapped) // PRICE_RECORD.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if PRICE_RECORD.unpack_from(mapped, mid * PRICE_RECORD.size)[0] <= target:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == 0:
         return None
+    return Decimal(PRICE_RECORD.unpack_from(mapped, (lo - 1) * PRICE_RECORD.size)[1]) / PRICE_SCALE
+
+
+def write_price_series(key: tuple[str, str], closes: dict[int, int]):
+    # Merges {YYYYMMDD: millionths} into the key's file; new closes win on the same date.
+    path = price_store_path(key)
+    merged = {}
+    if os.path.exists(path):
+        with open(path, mode='rb') as f:
+            merged = {date: close for date, close in PRICE_RECORD.iter_unpack(f.read())}
+    merged.update(closes)
+    atomic_write(path, b''.join(PRICE_RECORD.pack(date, merged[date]) for date in sorted(merged)))
+
+
+@timed('csv.import prices')
+def import_price_history(path: str) -> tuple[int, int, list[str]]:
+    # Rows: date,country,symbol,close. Returns (closes imported, series written, errors).
+    series: dict[tuple[str, str], dict[int, int]] = {}
+    errors = []
+    imported = 0
+    with open(path, mode='r', newline='') as f:
+        for line_no, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                date = row['date'].strip()
+                key = (row['country'].strip().upper(), row['symbol'].strip().upper())
+                close = Decimal(str(row['close']).strip().replace(',', '.'))
+            except (KeyError, AttributeError, InvalidOperation):
+                errors.append(f"line {line_no}: invalid row")
+                continue
+            if not is_valid_date(date) or key[0] not in {'TR', 'US', 'FX'} \
+                    or not key[1].replace('.', '').replace('-', '').isalnum() or close <= 0:
+                errors.append(f"line {line_no}: invalid date, country, symbol or close")
+                continue
+            micros = int((close * PRICE_SCALE).to_integral_value(rounding=ROUND_HALF_EVEN))
+            series.setdefault(key, {})[int(date.replace('-', ''))] = micros
+            imported += 1
+    close_price_store()
+    os.makedirs(portfolio_path(PRICE_STORE_DIR), exist_ok=True)
+    for key, closes in series.items():
+        write_price_series(key, closes)
+    return imported, len(series), errors
 
 
 def load_bar():
@@ -251,77 +1193,805 @@ def get_usr_info():
         return None, None
 
 
-def create_files():
-    if not os.path.exists("operations.csv"):
-        with open("operations.csv", mode="w") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                ['id','stock_name', 'country_name', 'transaction_type', 'share_price',
-                 'number_of_shares', 'transaction_fee', 'exchange_rate', 'currency', 'date' ,'tl_price', 'usd_price']
-            )
-    if not os.path.exists("inflation.csv"):
-        with open("inflation.csv", mode="w") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                ['month', 'year', 'country', 'rate']
-            )
-    if not os.path.exists("shares.csv"):
-        with open("shares.csv", mode="w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                'share_name','country_name', 'quantity'
-            ])
+# Every data file of a portfolio lives in PORTFOLIO_DIR; switch portfolios with set_portfolio().
+PORTFOLIO_DIR = '.'
 
 
-def share_purchase(stock_name,country_name,transaction_type,share_price,number_of_shares,transaction_fee,exchange_rate,currency,date):
-    price = Decimal(str(share_price))
-    qty = Decimal(str(number_of_shares))
-    fee = Decimal(str(transaction_fee))
-    rate = Decimal(str(exchange_rate))
-    if currency == 'TL':
-        tl_price = round_money(price * qty)
-        usd_price = round_money(tl_price / rate)
-    else:  # USD
-        usd_price = round_money(price * qty)
-        tl_price = round_money(usd_price * rate)
-        # total_cost =  will be added later
-    new_id = 0
-    with open('operations.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            new_id = max(new_id, int(row['id']))
-        new_id +=1
-    with open('operations.csv', mode = 'a', newline='') as f:
-        writer = csv.writer(f)
+def portfolio_path(name: str) -> str:
+    return os.path.join(PORTFOLIO_DIR, name)
 
-        writer.writerow([new_id,stock_name,country_name, transaction_type,share_price,
-                         number_of_shares,transaction_fee,exchange_rate,currency,date, f'{tl_price}', f'{usd_price}'
-        ])
 
-    with open('shares.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames
-        control = False
-        rows = []
-        for row in reader:
-            if stock_name == row['share_name']:
-                current_qty = Decimal(row['quantity'])
-                new_qty = current_qty + qty
-                row['quantity'] = str(new_qty)
-                control = True
-            rows.append(row)
-    if not control:
-        rows.append({
-            'share_name': stock_name,
-            'country_name': country_name,
-            'quantity': str(qty)
-        })
-    with open('shares.csv', mode='w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+def set_portfolio(directory: str):
+    # Points storage at another portfolio directory and drops every in-memory view of the previous one.
+    global PORTFOLIO_DIR, _db, _ledger_index, _ledger_index_size
+    global _positions, _positions_offset, _positions_tail, _positions_pending, _cpi_index, _cpi_index_source
+    checkpoint_positions()
+    reload_quote_cache()
+    close_price_store()
+    if _db is not None:
+        _db.close()
+        _db = None
+    PORTFOLIO_DIR = directory
+    _ledger_index, _ledger_index_size = None, -1
+    _positions, _positions_offset, _positions_tail, _positions_pending = None, 0, b'', 0
+    if not _cpi_index_pinned:
+        _cpi_index, _cpi_index_source = None, None
+
+
+# Crash-safe writes. Whole-file rewrites go to a temp file in the same directory that is fsynced and then
+# renamed over the target, so readers see either the old or the new file. Processes writing to the same
+# portfolio directory take turns through an advisory lock on LOCK_FILE, and ledger appends are first
+# recorded in JOURNAL_FILE so that an append cut short by a crash is redone on the next start.
+LOCK_FILE = '.lock'
+JOURNAL_FILE = 'operations.journal'
+
+_write_lock = threading.RLock()
+_lock_handle = None
+_lock_depth = 0
+
+
+@contextmanager
+def portfolio_lock():
+    # Exclusive for the current portfolio directory across processes; re-entrant within one.
+    global _lock_handle, _lock_depth
+    with _write_lock:
+        if _lock_depth == 0:
+            handle = open(portfolio_path(LOCK_FILE), mode='a+b')
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+            _lock_handle = handle
+            _lock_depth = 1
+            try:
+                recover_journal()
+                terminate_ledger()
+            except BaseException:
+                release_portfolio_lock()
+                raise
+        else:
+            _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+            if _lock_depth == 0:
+                release_portfolio_lock()
+
+
+def release_portfolio_lock():
+    global _lock_handle, _lock_depth
+    if fcntl is not None:
+        fcntl.flock(_lock_handle.fileno(), fcntl.LOCK_UN)
+    else:
+        _lock_handle.seek(0)
+        msvcrt.locking(_lock_handle.fileno(), msvcrt.LK_UNLCK, 1)
+    _lock_handle.close()
+    _lock_handle, _lock_depth = None, 0
+
+
+def fsync_directory(directory: str):
+    # Makes a rename durable; directories cannot be opened for this outside POSIX.
+    if os.name != 'posix':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(path: str, binary: bool = False):
+    # Yields a temp file that replaces path only if the block completes.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode='wb' if binary else 'w', newline=None if binary else '') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(os.path.dirname(path))
+
+
+def atomic_write(path: str, data: bytes):
+    with atomic_open(path, binary=True) as f:
+        f.write(data)
+
+
+def durable_append(path: str, data: bytes):
+    with open(path, mode='ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def ledger_terminated() -> bool:
+    # False when the last row of operations.csv has no line break yet.
+    try:
+        with open(portfolio_path('operations.csv'), mode='rb') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+    except OSError:
+        return True
+
+
+def terminate_ledger():
+    # A last row without a line break (hand edits, other tools) is skipped by fold_ledger as an append in
+    # progress, while csv readers already count it, and the next append would be glued onto it. With the
+    # portfolio lock held and the journal recovered no append is in progress, so the row is complete:
+    # end it. Call with the portfolio lock held.
+    if STORAGE_BACKEND == 'csv' and not ledger_terminated():
+        durable_append(portfolio_path('operations.csv'), b'\r\n')
+
+
+def journaled_append(ledger_data: bytes, index_data: bytes, ledger_size: int, index_size: int):
+    # Appends to operations.csv and its index, which must currently be ledger_size and index_size bytes.
+    # Call with the portfolio lock held.
+    journal = {'ledger_size': ledger_size, 'index_size': index_size,
+               'ledger': ledger_data.decode('utf-8'), 'index': index_data.decode('utf-8')}
+    atomic_write(portfolio_path(JOURNAL_FILE), json.dumps(journal).encode('utf-8'))
+    durable_append(portfolio_path('operations.csv'), ledger_data)
+    durable_append(portfolio_path(LEDGER_INDEX_FILE), index_data)
+    os.remove(portfolio_path(JOURNAL_FILE))
+
+
+def recover_journal():
+    # Redoes an append that a crash interrupted: both files are cut back to their size before it
+    # and the journaled rows are written again. Call with the portfolio lock held.
+    path = portfolio_path(JOURNAL_FILE)
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, mode='r') as f:
+            journal = json.load(f)
+    except ValueError:
+        # The journal itself was cut short, so the append never started.
+        os.remove(path)
+        return
+    for name, size, data in (('operations.csv', journal['ledger_size'], journal['ledger']),
+                             (LEDGER_INDEX_FILE, journal['index_size'], journal['index'])):
+        with open(portfolio_path(name), mode='r+b') as f:
+            if os.fstat(f.fileno()).st_size > size:
+                f.truncate(size)
+        durable_append(portfolio_path(name), data.encode('utf-8'))
+    os.remove(path)
+
+
+OPERATIONS_FIELDS = ['id','stock_name', 'country_name', 'transaction_type', 'share_price',
+                     'number_of_shares', 'transaction_fee', 'exchange_rate', 'currency', 'date' ,'tl_price', 'usd_price']
+
+
+def create_files():
+    if STORAGE_BACKEND == 'sqlite':
+        get_db()
+        return
+    # Nothing to create, recover or terminate on an existing portfolio: skip the lock so read-only runs
+    # start fast. An unterminated last row means an append in progress or an unended row; the lock waits
+    # for the former and terminate_ledger ends the latter.
+    if (os.path.exists(portfolio_path('operations.csv')) and os.path.exists(portfolio_path('inflation.csv'))
+            and not os.path.exists(portfolio_path(JOURNAL_FILE)) and ledger_terminated()):
+        return
+    with portfolio_lock():  # also finishes an append a crash interrupted and ends an unterminated row
+        if not os.path.exists(portfolio_path('operations.csv')):
+            atomic_write(portfolio_path('operations.csv'), encode_csv_row(OPERATIONS_FIELDS))
+        if not os.path.exists(portfolio_path('inflation.csv')):
+            atomic_write(portfolio_path('inflation.csv'), encode_csv_row(['month', 'year', 'country', 'rate']))
+
+
+# Sidecar index of operations.csv: one (id, stock_name, offset, length, next_id) row per ledger row,
+# appended together with the ledger. next_id is one above the highest id up to that row, which need not
+# be the row's own id in a hand-edited or reordered ledger. The last index row gives the next id and tells
+# whether the index still covers the whole ledger, so an append never has to read operations.csv.
+LEDGER_INDEX_FILE = 'operations.idx'
+
+_ledger_index: dict[str, list[tuple[int, int]]] | None = None  # stock_name -> [(offset, length), ...]
+_ledger_index_size = -1  # size of operations.csv the in-memory index reflects
+
+
+def read_last_line(path: str) -> bytes | None:
+    try:
+        with open(path, mode='rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            pos = end
+            chunk = b''
+            while pos > 0:
+                step = min(1024, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + chunk
+                if chunk.rstrip(b'\r\n').rfind(b'\n') != -1:
+                    break
+    except OSError:
+        return None
+    lines = chunk.rstrip(b'\r\n').split(b'\n')
+    return lines[-1].rstrip(b'\r') if lines and lines[-1] else None
+
+
+def encode_csv_row(row: list) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue().encode('utf-8')
+
+
+@timed('csv.rebuild ledger index')
+def rebuild_ledger_index():
+    global _ledger_index, _ledger_index_size
+    _ledger_index = {}
+    with portfolio_lock(), open(portfolio_path('operations.csv'), mode='rb') as src, \
+            atomic_open(portfolio_path(LEDGER_INDEX_FILE), binary=True) as idx:
+        idx.write(encode_csv_row(['id', 'stock_name', 'offset', 'length', 'next_id']))
+        src.readline()  # header
+        offset = src.tell()
+        next_id = 1
+        for line in iter(src.readline, b''):
+            if line.strip():
+                row = next(csv.reader([line.decode('utf-8')]))
+                next_id = max(next_id, int(row[0]) + 1)
+                idx.write(encode_csv_row([row[0], row[1], offset, len(line), next_id]))
+                _ledger_index.setdefault(row[1], []).append((offset, len(line)))
+            offset += len(line)
+    _ledger_index_size = offset
+
+
+def last_ledger_index_entry() -> tuple[int, int] | None:
+    # (next id, end offset of the last indexed row) if the index covers operations.csv, else None.
+    ledger_size = os.path.getsize(portfolio_path('operations.csv'))
+    last = read_last_line(portfolio_path(LEDGER_INDEX_FILE))
+    if last is None:
+        return None
+    if last.startswith(b'id,'):
+        # No rows indexed yet: fresh only if the ledger holds just its header.
+        header = read_last_line(portfolio_path('operations.csv'))
+        return (1, ledger_size) if header is not None and header.startswith(b'id,') else None
+    row = next(csv.reader([last.decode('utf-8')]))
+    if len(row) < 5:
+        return None  # written before next_id was indexed
+    end = int(row[2]) + int(row[3])
+    return (int(row[4]), end) if end == ledger_size else None
+
+
+def ensure_ledger_index() -> int:
+    # Returns the next operation id, rebuilding the index first if operations.csv changed behind it.
+    entry = last_ledger_index_entry()
+    if entry is None:
+        rebuild_ledger_index()
+        entry = last_ledger_index_entry()
+    return entry[0]
+
+
+def append_operation(row: list) -> int:
+    # row: every operations.csv column except id. Returns the id assigned to it.
+    return append_operations([row])[0]
+
+
+@timed('csv.append operations')
+def append_operations(rows: list[list]) -> list[int]:
+    # One journaled append to operations.csv and its index for all rows; ids are allocated under the lock.
+    global _ledger_index_size
+    with portfolio_lock():
+        first_id = ensure_ledger_index()
+        start = offset = os.path.getsize(portfolio_path('operations.csv'))
+        lines, entries, spans = [], [], []
+        for new_id, row in enumerate(rows, start=first_id):
+            line = encode_csv_row([new_id] + row)
+            lines.append(line)
+            entries.append(encode_csv_row([new_id, row[0], offset, len(line), new_id + 1]))
+            spans.append((row[0], offset, len(line)))
+            offset += len(line)
+        journaled_append(b''.join(lines), b''.join(entries), start, os.path.getsize(portfolio_path(LEDGER_INDEX_FILE)))
+    if _ledger_index is not None and _ledger_index_size == start:
+        for stock_name, position, length in spans:
+            _ledger_index.setdefault(stock_name, []).append((position, length))
+        _ledger_index_size = offset
+    return list(range(first_id, first_id + len(rows)))
+
+
+def load_ledger_index() -> dict[str, list[tuple[int, int]]]:
+    global _ledger_index, _ledger_index_size
+    ensure_ledger_index()
+    ledger_size = os.path.getsize(portfolio_path('operations.csv'))
+    if _ledger_index is not None and _ledger_index_size == ledger_size:
+        return _ledger_index
+    _ledger_index = {}
+    with open(portfolio_path(LEDGER_INDEX_FILE), mode='r', newline='') as f:
+        for row in csv.DictReader(f):
+            _ledger_index.setdefault(row['stock_name'], []).append((int(row['offset']), int(row['length'])))
+    _ledger_index_size = ledger_size
+    return _ledger_index
+
+
+def csv_find_operations(stock_name: str) -> list[dict]:
+    # All operations of one symbol, read by seeking to their indexed offsets.
+    entries = load_ledger_index().get(stock_name, [])
+    operations = []
+    with open(portfolio_path('operations.csv'), mode='rb') as f:
+        for offset, length in entries:
+            f.seek(offset)
+            row = next(csv.reader([f.read(length).decode('utf-8')]))
+            operations.append(dict(zip(OPERATIONS_FIELDS, row)))
+    return operations
+
+
+# Holdings are a materialized view of the operations ledger: share_name -> [country_name, quantity],
+# folded one operation at a time. POSITIONS_FILE is a checkpoint of that view together with the ledger
+# byte offset it covers, so a run only folds the operations appended after the last checkpoint.
+POSITIONS_FILE = 'positions.json'
+POSITIONS_CHECKPOINT_EVERY = 100  # operations folded in memory before the snapshot is rewritten
+
+_positions: dict[str, list] | None = None
+_positions_offset = 0  # bytes of operations.csv folded into _positions
+_positions_tail = b''  # last folded ledger line, used to recognise the same ledger on reload
+_positions_pending = 0  # operations folded since the last checkpoint
+
+
+def fold_positions(positions: dict[str, list], operations) -> int:
+    # operations: iterable of (stock_name, country_name, transaction_type, number_of_shares).
+    count = 0
+    for stock_name, country_name, transaction_type, number_of_shares in operations:
+        kind = transaction_type.strip().lower()
+        if kind == 'purchase':
+            delta = Decimal(number_of_shares)
+        elif kind == 'sale':
+            delta = -Decimal(number_of_shares)
+        else:
+            continue
+        entry = positions.get(stock_name)
+        new_qty = (entry[1] if entry else Decimal('0')) + delta
+        if new_qty > 0:
+            positions[stock_name] = [entry[0] if entry else country_name, new_qty]
+        else:
+            # Quantity drops to zero; remove the position
+            positions.pop(stock_name, None)
+        count += 1
+    return count
+
+
+@timed('csv.fold ledger')
+def fold_ledger(positions: dict[str, list], offset: int) -> tuple[int, int, bytes | None]:
+    # Streams operations.csv from offset (0 = start) into positions. Returns (folded, end offset, last line).
+    tail = None
+    end = offset
+
+    def rows(f):
+        nonlocal tail, end
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                break  # another process is still appending this row; it is folded on a later call
+            end += len(line)
+            if line.strip():
+                row = next(csv.reader([line.decode('utf-8')]))
+                tail = line
+                yield row[1], row[2], row[3], row[5]
+
+    with open(portfolio_path('operations.csv'), mode='rb') as f:
+        if offset:
+            f.seek(offset)
+        else:
+            end = len(f.readline())  # header
+        folded = fold_positions(positions, rows(f))
+        return folded, end, tail
+
+
+def ledger_tail_matches(offset: int, tail: bytes) -> bool:
+    if not tail or offset < len(tail):
+        return False
+    try:
+        with open(portfolio_path('operations.csv'), mode='rb') as f:
+            f.seek(offset - len(tail))
+            return f.read(len(tail)) == tail
+    except OSError:
+        return False
+
+
+@timed('json.write positions')
+def checkpoint_positions():
+    global _positions_pending
+    if _positions is None or STORAGE_BACKEND == 'sqlite':
+        return
+    if not os.path.exists(portfolio_path('operations.csv')):
+        return  # not a portfolio (e.g. a calc-many directory without a ledger); leave it untouched
+    data = {
+        'ledger_offset': _positions_offset,
+        'ledger_tail': _positions_tail.decode('utf-8'),
+        'positions': [[name, country, str(qty)] for name, (country, qty) in _positions.items()],
+    }
+    try:
+        atomic_write(portfolio_path(POSITIONS_FILE), json.dumps(data).encode('utf-8'))
+        _positions_pending = 0
+    except OSError:
+        pass
+
+
+def read_positions_snapshot() -> bool:
+    global _positions, _positions_offset, _positions_tail
+    try:
+        with open(portfolio_path(POSITIONS_FILE), mode='r') as f:
+            data = json.load(f)
+        positions = {name: [country, Decimal(qty)] for name, country, qty in data['positions']}
+        offset, tail = data['ledger_offset'], data['ledger_tail'].encode('utf-8')
+    except (OSError, ValueError, KeyError, TypeError, InvalidOperation):
+        return False
+    if not ledger_tail_matches(offset, tail):
+        return False
+    _positions, _positions_offset, _positions_tail = positions, offset, tail
+    return True
+
+
+def load_positions() -> dict[str, list]:
+    # Brings the view up to date with operations.csv by folding only the rows it has not seen yet.
+    global _positions, _positions_offset, _positions_tail, _positions_pending
+    if _positions is not None and _positions_offset == os.path.getsize(portfolio_path('operations.csv')):
+        return _positions
+    if _positions is None or not ledger_tail_matches(_positions_offset, _positions_tail):
+        if not read_positions_snapshot():
+            _positions, _positions_offset, _positions_tail = {}, 0, b''
+    folded, _positions_offset, tail = fold_ledger(_positions, _positions_offset)
+    if tail is not None:
+        _positions_tail = tail
+    _positions_pending += folded
+    if _positions_pending >= POSITIONS_CHECKPOINT_EVERY:
+        checkpoint_positions()
+    return _positions
+
+
+def rebuild_positions():
+    # Recomputes every holding from the operations ledger in one streaming pass.
+    global _positions, _positions_offset, _positions_tail
+    if STORAGE_BACKEND == 'sqlite':
+        sqlite_rebuild_positions()
+        return
+    _positions = {}
+    _, _positions_offset, tail = fold_ledger(_positions, 0)
+    _positions_tail = tail or b''
+    checkpoint_positions()
+
+
+@timed('csv.read inflation')
+def csv_read_inflation_rows() -> list[dict]:
+    with open(portfolio_path('inflation.csv'), mode='r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+@timed('csv.write inflation')
+def csv_add_inflation_rate(month: int, year: int, country: str, rate: Decimal) -> bool:
+    # The CPI index holds every stored month, so duplicates are found without rescanning the file.
+    if (year, month) in load_cpi_index().get(country, {}):
+        return False
+    durable_append(portfolio_path('inflation.csv'), encode_csv_row([month, year, country, str(rate)]))
+    return True
+
+
+@timed('csv.write inflation')
+def csv_replace_inflation_rate(month: int, year: int, country: str, rate: Decimal | None) -> bool:
+    # Sets the rate of an existing row, or deletes it when rate is None. False if no row matched.
+    with open(portfolio_path('inflation.csv'), mode='r', newline='') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    new_rows = []
+    found = False
+    for row in rows:
+        if row['month'] == str(month) and row['year'] == str(year) and row['country'] == country:
+            found = True
+            if rate is None:
+                continue
+            row['rate'] = str(rate)
+        new_rows.append(row)
+    if found:
+        with atomic_open(portfolio_path('inflation.csv')) as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(new_rows)
+    return found
+
+
+@timed('csv.write inflation')
+def csv_write_inflation_rates(rates: dict[tuple[str, int, int], Decimal]) -> tuple[int, int]:
+    # Sets many (country, year, month) rates with one rewrite of inflation.csv. Returns (added, updated).
+    path = portfolio_path('inflation.csv')
+    rows = csv_read_inflation_rows()
+    pending = dict(rates)
+    updated = 0
+    for row in rows:
+        key = (row['country'].strip().upper(), int(row['year']), int(row['month']))
+        if key in pending:
+            row['rate'] = str(pending.pop(key))
+            updated += 1
+    rows.extend({'month': month, 'year': year, 'country': country, 'rate': str(rate)}
+                for (country, year, month), rate in pending.items())
+    with atomic_open(path) as f:
+        writer = csv.DictWriter(f, fieldnames=['month', 'year', 'country', 'rate'])
         writer.writeheader()
         writer.writerows(rows)
+    return len(pending), updated
 
 
+# Optional SQLite backend. Select it with STORAGE_BACKEND = 'sqlite' (or REEL_PROFIT_STORAGE=sqlite);
+# amounts are stored as TEXT so Decimal values round-trip exactly.
+STORAGE_BACKEND = os.environ.get('REEL_PROFIT_STORAGE', 'csv').strip().lower()
+SQLITE_FILE = 'portfolio.db'
+
+_db: sqlite3.Connection | None = None
+
+
+def get_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(portfolio_path(SQLITE_FILE))
+        _db.executescript("""
+            CREATE TABLE IF NOT EXISTS operations (
+                id INTEGER PRIMARY KEY, stock_name TEXT NOT NULL, country_name TEXT NOT NULL,
+                transaction_type TEXT NOT NULL, share_price TEXT, number_of_shares TEXT,
+                transaction_fee TEXT, exchange_rate TEXT, currency TEXT, date TEXT NOT NULL,
+                tl_price TEXT, usd_price TEXT
+            );
+            CREATE INDEX IF NOT EXISTS operations_stock_date ON operations (stock_name, date);
+            CREATE TABLE IF NOT EXISTS shares (
+                share_name TEXT PRIMARY KEY, country_name TEXT NOT NULL, quantity TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS inflation (
+                month INTEGER NOT NULL, year INTEGER NOT NULL, country TEXT NOT NULL, rate TEXT NOT NULL,
+                PRIMARY KEY (country, year, month)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+    return _db
+
+
+def sqlite_rows(query: str, params: tuple = ()) -> list[dict]:
+    cursor = get_db().execute(query, params)
+    columns = [c[0] for c in cursor.description]
+    return [{col: str(value) for col, value in zip(columns, row)} for row in cursor]
+
+
+def sqlite_bump_inflation_version(db: sqlite3.Connection):
+    db.execute("INSERT INTO meta (key, value) VALUES ('inflation_version', 1) "
+               "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+
+def sqlite_inflation_version() -> int:
+    row = get_db().execute("SELECT value FROM meta WHERE key = 'inflation_version'").fetchone()
+    return row[0] if row else 0
+
+
+def sqlite_record_operation(row: list, quantity_delta: Decimal) -> int:
+    db = get_db()
+    stock_name, country_name = row[0], row[1]
+    with db:
+        cursor = db.execute(f"INSERT INTO operations ({', '.join(OPERATIONS_FIELDS[1:])}) VALUES ({', '.join('?' * len(row))})",
+                            [str(value) for value in row])
+        # The shares table is the SQLite position view, updated in the same transaction.
+        current = db.execute("SELECT quantity FROM shares WHERE share_name = ?", (stock_name,)).fetchone()
+        new_qty = (Decimal(current[0]) if current else Decimal('0')) + quantity_delta
+        if new_qty > 0:
+            db.execute("INSERT INTO shares (share_name, country_name, quantity) VALUES (?, ?, ?) "
+                       "ON CONFLICT(share_name) DO UPDATE SET quantity = excluded.quantity",
+                       (stock_name, country_name, str(new_qty)))
+        else:
+            db.execute("DELETE FROM shares WHERE share_name = ?", (stock_name,))
+    return cursor.lastrowid
+
+
+def sqlite_record_operations(rows: list[list], quantity_deltas: list[Decimal]) -> list[int]:
+    # Batch version of sqlite_record_operation in one transaction; each position is written once.
+    db = get_db()
+    totals: dict[str, list] = {}
+    for row, delta in zip(rows, quantity_deltas):
+        totals.setdefault(row[0], [row[1], Decimal('0')])[1] += delta
+    with db:
+        first_id = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM operations").fetchone()[0]
+        db.executemany(f"INSERT INTO operations ({', '.join(OPERATIONS_FIELDS)}) VALUES ({', '.join('?' * len(OPERATIONS_FIELDS))})",
+                       [[new_id] + [str(value) for value in row] for new_id, row in enumerate(rows, start=first_id)])
+        for stock_name, (country_name, delta) in totals.items():
+            current = db.execute("SELECT quantity FROM shares WHERE share_name = ?", (stock_name,)).fetchone()
+            new_qty = (Decimal(current[0]) if current else Decimal('0')) + delta
+            if new_qty > 0:
+                db.execute("INSERT INTO shares (share_name, country_name, quantity) VALUES (?, ?, ?) "
+                           "ON CONFLICT(share_name) DO UPDATE SET quantity = excluded.quantity",
+                           (stock_name, country_name, str(new_qty)))
+            else:
+                db.execute("DELETE FROM shares WHERE share_name = ?", (stock_name,))
+    return list(range(first_id, first_id + len(rows)))
+
+
+def sqlite_rebuild_positions():
+    db = get_db()
+    positions: dict[str, list] = {}
+    fold_positions(positions, db.execute("SELECT stock_name, country_name, transaction_type, number_of_shares "
+                                         "FROM operations ORDER BY id"))
+    with db:
+        db.execute("DELETE FROM shares")
+        db.executemany("INSERT INTO shares (share_name, country_name, quantity) VALUES (?, ?, ?)",
+                       ((name, country, str(qty)) for name, (country, qty) in positions.items()))
+
+
+def sqlite_write_inflation_rate(month: int, year: int, country: str, rate: Decimal | None, insert: bool) -> bool:
+    db = get_db()
+    with db:
+        if insert:
+            cursor = db.execute("INSERT OR IGNORE INTO inflation (month, year, country, rate) VALUES (?, ?, ?, ?)",
+                                (month, year, country, str(rate)))
+        elif rate is None:
+            cursor = db.execute("DELETE FROM inflation WHERE country = ? AND year = ? AND month = ?",
+                                (country, year, month))
+        else:
+            cursor = db.execute("UPDATE inflation SET rate = ? WHERE country = ? AND year = ? AND month = ?",
+                                (str(rate), country, year, month))
+        if cursor.rowcount:
+            sqlite_bump_inflation_version(db)
+    return cursor.rowcount > 0
+
+
+def sqlite_write_inflation_rates(rates: dict[tuple[str, int, int], Decimal]) -> tuple[int, int]:
+    db = get_db()
+    existing = {(country, year, month) for country, year, month in db.execute("SELECT country, year, month FROM inflation")}
+    with db:
+        db.executemany("INSERT INTO inflation (month, year, country, rate) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(country, year, month) DO UPDATE SET rate = excluded.rate",
+                       [(month, year, country, str(rate)) for (country, year, month), rate in rates.items()])
+        if rates:
+            sqlite_bump_inflation_version(db)
+    updated = len(existing & set(rates))
+    return len(rates) - updated, updated
+
+
+def import_csv_to_sqlite():
+    # One-shot copy of operations.csv and inflation.csv into SQLITE_FILE, replacing its contents.
+    # Holdings are derived from the imported operations.
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM operations")
+        db.execute("DELETE FROM shares")
+        db.execute("DELETE FROM inflation")
+        if os.path.exists(portfolio_path('operations.csv')):
+            with open(portfolio_path('operations.csv'), mode='r', newline='') as f:
+                db.executemany(f"INSERT INTO operations ({', '.join(OPERATIONS_FIELDS)}) VALUES ({', '.join('?' * len(OPERATIONS_FIELDS))})",
+                               ([row[field] for field in OPERATIONS_FIELDS] for row in csv.DictReader(f)))
+        if os.path.exists(portfolio_path('inflation.csv')):
+            db.executemany("INSERT OR REPLACE INTO inflation (month, year, country, rate) VALUES (?, ?, ?, ?)",
+                           ((int(row['month']), int(row['year']), row['country'].strip().upper(), row['rate'])
+                            for row in csv_read_inflation_rows()))
+        sqlite_bump_inflation_version(db)
+    sqlite_rebuild_positions()
+
+
+def export_sqlite_to_csv():
+    # Writes the SQLite operations and inflation rows back to their CSV files, overwriting them.
+    tables = [
+        (portfolio_path('operations.csv'), OPERATIONS_FIELDS, f"SELECT {', '.join(OPERATIONS_FIELDS)} FROM operations ORDER BY id"),
+        (portfolio_path('inflation.csv'), ['month', 'year', 'country', 'rate'], "SELECT month, year, country, rate FROM inflation ORDER BY rowid"),
+    ]
+    with portfolio_lock():
+        for path, fieldnames, query in tables:
+            with atomic_open(path) as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(sqlite_rows(query))
+
+
+# Storage interface: every read/write of operations, shares and inflation goes through these.
+def iter_operations():
+    # Streams operations one row at a time (as dicts of strings) without loading the ledger.
+    if STORAGE_BACKEND == 'sqlite':
+        cursor = get_db().execute(f"SELECT {', '.join(OPERATIONS_FIELDS)} FROM operations ORDER BY id")
+        for row in timed_rows('sqlite.read operations', cursor):
+            yield {col: str(value) for col, value in zip(OPERATIONS_FIELDS, row)}
+        return
+    with open(portfolio_path('operations.csv'), mode='r', newline='') as f:
+        yield from timed_rows('csv.read operations', csv.DictReader(f))
+
+
+def find_operations(stock_name: str) -> list[dict]:
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_rows(f"SELECT {', '.join(OPERATIONS_FIELDS)} FROM operations WHERE stock_name = ? ORDER BY date, id",
+                           (stock_name,))
+    return csv_find_operations(stock_name)
+
+
+def has_operations() -> bool:
+    if STORAGE_BACKEND == 'sqlite':
+        return get_db().execute("SELECT 1 FROM operations LIMIT 1").fetchone() is not None
+    return ensure_ledger_index() > 1
+
+
+def record_operation(row: list, quantity_delta: Decimal) -> int:
+    # Logs one operation (every column except id) and applies quantity_delta to its position.
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_record_operation(row, quantity_delta)
+    new_id = append_operation(row)
+    load_positions()  # folds just the appended row
+    return new_id
+
+
+def record_operations(rows: list[list], quantity_deltas: list[Decimal]) -> list[int]:
+    # Batch version of record_operation: one write, positions brought up to date once.
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_record_operations(rows, quantity_deltas)
+    new_ids = append_operations(rows)
+    load_positions()
+    return new_ids
+
+
+def read_shares() -> list[dict]:
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_rows("SELECT share_name, country_name, quantity FROM shares ORDER BY rowid")
+    return [{'share_name': name, 'country_name': country, 'quantity': str(qty)}
+            for name, (country, qty) in load_positions().items()]
+
+
+def read_inflation_rows() -> list[dict]:
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_rows("SELECT month, year, country, rate FROM inflation ORDER BY rowid")
+    return csv_read_inflation_rows()
+
+
+def add_inflation_rate(month: int, year: int, country: str, rate: Decimal) -> bool:
+    # False if a row for (month, year, country) already exists.
+    with portfolio_lock():
+        fingerprint = inflation_fingerprint()
+        if STORAGE_BACKEND == 'sqlite':
+            added = sqlite_write_inflation_rate(month, year, country, rate, insert=True)
+        else:
+            added = csv_add_inflation_rate(month, year, country, rate)
+        if added:
+            update_cpi_index(country, year, month, rate, fingerprint)
+        return added
+
+
+def set_inflation_rates(rates: dict[tuple[str, int, int], Decimal]) -> tuple[int, int]:
+    # Adds or overwrites many (country, year, month) rates in one write. Returns (added, updated).
+    with portfolio_lock():
+        fingerprint = inflation_fingerprint()
+        if STORAGE_BACKEND == 'sqlite':
+            counts = sqlite_write_inflation_rates(rates)
+        else:
+            counts = csv_write_inflation_rates(rates)
+        update_cpi_index_rows([(country, year, month, rate) for (country, year, month), rate in rates.items()], fingerprint)
+        return counts
+
+
+def set_inflation_rate(month: int, year: int, country: str, rate: Decimal | None) -> bool:
+    # Edits an existing row, or deletes it when rate is None. False if no row matched.
+    with portfolio_lock():
+        fingerprint = inflation_fingerprint()
+        if STORAGE_BACKEND == 'sqlite':
+            found = sqlite_write_inflation_rate(month, year, country, rate, insert=False)
+        else:
+            found = csv_replace_inflation_rate(month, year, country, rate)
+        if found:
+            update_cpi_index(country, year, month, rate, fingerprint)
+        return found
+
+
+def operation_totals(price: Decimal, qty: Decimal, rate: Decimal, currency: str) -> tuple[Decimal, Decimal]:
+    # (tl_price, usd_price): the trade's total in both currencies, converted at the operation's rate.
+    if currency == 'TL':
+        tl_price = round_money(price * qty)
+        return tl_price, round_money(tl_price / rate)
+    usd_price = round_money(price * qty)
+    return round_money(usd_price * rate), usd_price
+
+
+def share_purchase(stock_name,country_name,transaction_type,share_price,number_of_shares,transaction_fee,exchange_rate,currency,date):
+    price = Decimal(str(share_price))
+    qty = Decimal(str(number_of_shares))
+    fee = Decimal(str(transaction_fee))
+    rate = Decimal(str(exchange_rate))
+    tl_price, usd_price = operation_totals(price, qty, rate, currency)
+    record_operation([stock_name,country_name, transaction_type,share_price,
+                      number_of_shares,transaction_fee,exchange_rate,currency,date, f'{tl_price}', f'{usd_price}'], qty)
+
     print('Successfully saved.')
 
 
@@ -334,37 +2004,24 @@ def share_sale(stock_name,country_name,transaction_type,share_price,number_of_sh
     rate = Decimal(str(exchange_rate))
     
     # Calculate TL and USD equivalents for the sale
-    if currency == 'TL':
-        tl_price = round_money(price * qty)
-        usd_price = round_money(tl_price / rate)
-    else:
-        usd_price = round_money(price * qty)
-        tl_price = round_money(usd_price * rate)
+    tl_price, usd_price = operation_totals(price, qty, rate, currency)
     # Read current shares as a dict: {share_name: quantity}
     
-    shares = read_shares_csv()
+    # Held under the portfolio lock so that no other process sells the same shares in between
+    with portfolio_lock():
+        shares = read_shares_csv()
 
-    # Existence & quantity checks
-    if stock_name not in shares:
-        print(f"You don't have this share: {stock_name}")
-        return
-    have_qty = shares[stock_name]
-    if qty > have_qty:
-        print(f"The number of shares you have is not enough. You have {have_qty} shares but you tried to sell {qty} shares.")
-        return
+        # Existence & quantity checks
+        if stock_name not in shares:
+            print(f"You don't have this share: {stock_name}")
+            return
+        have_qty = shares[stock_name]
+        if qty > have_qty:
+            print(f"The number of shares you have is not enough. You have {have_qty} shares but you tried to sell {qty} shares.")
+            return
 
-    new_id = 0
-    with open('operations.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            new_id = max(new_id, int(row['id']))
-        new_id += 1
-
-    # 1) Append this sale into operations.csv (log the transaction)
-    with open('operations.csv', mode='a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            new_id,
+        # Log the sale and decrease the position (removed once it reaches 0)
+        record_operation([
             stock_name,
             country_name,
             transaction_type,
@@ -376,299 +2033,329 @@ def share_sale(stock_name,country_name,transaction_type,share_price,number_of_sh
             date,
             f"{tl_price}",
             f"{usd_price}"
-        ])
+        ], -qty)
 
-    # 2) Update shares.csv (decrease quantity and remove the row if it reaches 0)
-    with open('shares.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames
-        rows = []
-        for row in reader:
-            if row['share_name'] == stock_name:
-                new_qty = Decimal(row['quantity']) - qty
-                if new_qty > 0:
-                    row['quantity'] = str(new_qty)
-                    rows.append(row)
-                else:
-                    # Quantity drops to zero; omit the row to "remove" the position
-                    pass
-            else:
-                rows.append(row)
+    print('Sale saved and positions updated successfully.')
 
-    with open('shares.csv', mode='w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
 
-    print('Sale saved and positions updated successfully.')
+# Broker statements for import-operations use the operations.csv columns without id, tl_price and usd_price.
+# transaction_fee may be left out (0); an empty or 0 exchange_rate is taken from the local price store.
+IMPORT_FIELDS = ['stock_name', 'country_name', 'transaction_type', 'share_price', 'number_of_shares', 'currency', 'date']
 
 
-def opr(country_name: str):
-    create_files()
-    print()
-    print('1. Share Purchase')
-    print('2. Share Sale')
-    print('3. Edit past transactions.')
-    print('0. Return to the previous page.')
+def parse_import_decimal(row: dict, field: str, default: str | None = None) -> Decimal:
+    raw = (row.get(field) or '').strip() or default
     try:
-        choice = int(input('Please select the action you wish to perform from the options above: '))
-    except ValueError:
-        print('You can only enter a number between 0-3.')
-        opr(country_name)
-    else:
-        if choice == 0:
-            router()
-        elif choice == 1:
+        return Decimal(raw.replace(',', '.'))
+    except (AttributeError, InvalidOperation):
+        raise ValueError(f"invalid {field}")
+
+
+def parse_import_row(row: dict) -> tuple[list, Decimal]:
+    # Returns (ledger row without id, quantity delta); raises ValueError naming the bad field.
+    stock_name = (row.get('stock_name') or '').strip().upper()
+    country_name = (row.get('country_name') or '').strip().upper()
+    transaction_type = (row.get('transaction_type') or '').strip().lower()
+    currency = (row.get('currency') or '').strip().upper()
+    currency = 'TL' if currency == 'TRY' else currency
+    date = (row.get('date') or '').strip()
+    if not stock_name:
+        raise ValueError('missing stock_name')
+    if country_name not in {'TR', 'US'}:
+        raise ValueError('country_name must be TR or US')
+    if transaction_type not in ('purchase', 'sale'):
+        raise ValueError('transaction_type must be purchase or sale')
+    if currency not in ('TL', 'USD'):
+        raise ValueError('currency must be TL or USD')
+    if not is_valid_date(date):
+        raise ValueError('date must be YYYY-MM-DD')
+    price = parse_import_decimal(row, 'share_price')
+    qty = parse_import_decimal(row, 'number_of_shares')
+    fee = parse_import_decimal(row, 'transaction_fee', '0')
+    rate = parse_import_decimal(row, 'exchange_rate', '0')
+    if price <= 0 or qty <= 0 or fee < 0 or rate < 0:
+        raise ValueError('share_price and number_of_shares must be positive, fee and exchange_rate not negative')
+    if rate == 0:
+        rate = historical_close(('FX', 'USDTRY'), date)
+        if rate is None:
+            raise ValueError('no exchange_rate and no stored USD/TRY close for the date')
+    tl_price, usd_price = operation_totals(price, qty, rate, currency)
+    ledger_row = [stock_name, country_name, transaction_type, str(price), str(qty), str(fee), str(rate), currency, date,
+                  f"{tl_price}", f"{usd_price}"]
+    return ledger_row, qty if transaction_type == 'purchase' else -qty
+
+
+@timed('csv.import operations')
+def import_operations(path: str, dry_run: bool = False) -> tuple[int, list[str]]:
+    # All or nothing: returns (rows written, errors); nothing is written if any row is rejected.
+    parsed = []  # (date, line number, ledger row, quantity delta)
+    errors = []
+    with open(path, mode='r', newline='') as f:
+        reader = csv.DictReader(f)
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        missing = [field for field in IMPORT_FIELDS if field not in reader.fieldnames]
+        if missing:
+            return 0, [f"missing columns: {', '.join(missing)}"]
+        for line_no, row in enumerate(reader, start=2):
             try:
-                stock_name = input("Enter stock name: ").upper()
-                share_price = ask_price(country_name, stock_name)
-                if share_price is None:
-                    print('Operation cancelled.')
-                    router()
-                    return
-                while True:
-                    try:
-                        number_of_shares = Decimal(input("Enter number of shares: ").strip().replace(',', '.'))
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid number. Try again.')
-                while True:
-                    try:
-                        transaction_fee = Decimal(input("Enter transaction fee: ").strip().replace(',', '.'))
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid fee. Try again.')
-                while True:
-                    try:
-                        ex_raw = input("Enter exchange rate, if you want to get it automatically enter 0: ").strip().replace(',', '.')
-                        exchange_rate = Decimal(ex_raw)
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid rate. Try again.')
-                if exchange_rate == Decimal('0'):
-                    exchange_rate = get_dollar()
-                    if exchange_rate is None:
-                        print("Failed to get the dollar value.")
-                        return
-                while True:
-                    currency = input("Enter currency: (tl, usd): ").upper()
-                    if currency in ('TL', 'USD'):
-                        break
-                    else:
-                        print('You can only enter TL or USD')
-                while True:
-                    date = input("Enter date (YYYY-MM-DD), if you want to get it automatically enter 0: ")
-                    if  date == '0':
-                        date = str(datetime.today()).split()[0]
-                        break
-                    elif is_valid_date(date):
-                        break
-                    else:
-                        print('You need to enter a valid date. (Ex: 2025-12-19)')
-                share_purchase(stock_name=stock_name, country_name= country_name, transaction_type='purchase',
-                               share_price=share_price, number_of_shares=number_of_shares,
-                               transaction_fee=transaction_fee, exchange_rate=exchange_rate,
-                               currency=currency, date=date)
+                ledger_row, delta = parse_import_row(row)
             except ValueError as e:
-                print(f'Invalid input detected. {e}')
-                print('You are being redirected to the previous page.')
-                load_bar()
-                opr(country_name)
+                errors.append(f"line {line_no}: {e}")
+                continue
+            parsed.append((ledger_row[8], line_no, ledger_row, delta))
+
+    # Oversell check against the current holdings in date order (statements often list newest first).
+    parsed.sort(key=lambda item: item[0])
+    with portfolio_lock():
+        held = {share['share_name']: Decimal(str(share['quantity'])) for share in read_shares()}
+        for _, line_no, ledger_row, delta in parsed:
+            have_qty = held.get(ledger_row[0], Decimal('0'))
+            if have_qty + delta < 0:
+                errors.append(f"line {line_no}: sells {-delta} {ledger_row[0]} but only {have_qty} held")
             else:
-                router()
+                held[ledger_row[0]] = have_qty + delta
+        if errors or dry_run or not parsed:
+            return 0, errors
+        record_operations([ledger_row for _, _, ledger_row, _ in parsed], [delta for _, _, _, delta in parsed])
+    return len(parsed), []
 
-        elif choice == 2:
-            read_shares_csv()
-            try:
-                stock_name = input("Enter stock name: ").upper()
-                share_price = ask_price(country_name, stock_name)
-                if share_price is None:
-                    print('Operation cancelled.')
-                    router()
-                    return
-                while True:
-                    try:
-                        number_of_shares = Decimal(input("Enter number of shares: ").strip().replace(',', '.'))
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid number. Try again.')
-                while True:
-                    try:
-                        transaction_fee = Decimal(input("Enter transaction fee: ").strip().replace(',', '.'))
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid fee. Try again.')
-                while True:
-                    try:
-                        ex_raw = input("Enter exchange rate, if you want to get it automatically enter 0: ").strip().replace(',', '.')
-                        exchange_rate = Decimal(ex_raw)
-                        break
-                    except (InvalidOperation, ValueError):
-                        print('Invalid rate. Try again.')
-                if exchange_rate == Decimal('0'):
-                    exchange_rate = get_dollar()
-                    if exchange_rate is None:
-                        print("Failed to get the dollar value.")
+
+def opr(country_name: str):
+    create_files()
+    while True:
+        print()
+        print('1. Share Purchase')
+        print('2. Share Sale')
+        print('3. Edit past transactions.')
+        print('0. Return to the previous page.')
+        try:
+            choice = int(input('Please select the action you wish to perform from the options above: '))
+        except ValueError:
+            print('You can only enter a number between 0-3.')
+            continue
+        else:
+            if choice == 0:
+                return
+            elif choice == 1:
+                try:
+                    stock_name = input("Enter stock name: ").upper()
+                    share_price = ask_price(country_name, stock_name)
+                    if share_price is None:
+                        print('Operation cancelled.')
                         return
-                while True:
-                    currency = input("Enter currency: (tl, usd): ").upper()
-                    if currency in ('TL', 'USD'):
-                        break
-                    else:
-                        print('You can only enter TL or USD')
-                while True:
-                    date = input("Enter date (YYYY-MM-DD), if you want to get it automatically enter 0: ")
-                    if  date == '0':
-                        date = str(datetime.today()).split()[0]
-                        break
-                    elif is_valid_date(date):
-                        break
-                    else:
-                        print('You need to enter a valid date. (Ex: 2025-12-19)')
-                share_sale(stock_name=stock_name, country_name= country_name, transaction_type='sale',
-                               share_price=share_price, number_of_shares=number_of_shares,
-                               transaction_fee=transaction_fee, exchange_rate=exchange_rate,
-                               currency=currency, date=date)
-            except ValueError as e:
-                print(f'Invalid input detected. {e}')
-                print('You are being redirected to the previous page.')
-                load_bar()
-                opr(country_name)
-            else:
-                router()
-        elif choice == 3: # Edit past transactions.
-            operations =[]
-            with open('operations.csv', mode='r', newline='') as f:
-                reader = csv.DictReader(f)
-                for operation in reader:
-                    operations.append(operation)
-
-            if not operations:
-                print('There has been no transaction yet. First, you need to make a transaction.')
-
-            usr_share_name = input('Please enter the name of the share you want to edit (eg. NVDA): ').strip().upper()
-            matched_transactions = {}
-            count = 0
-            id_edit = 0
-            for share in operations:
-                if share['stock_name'] == usr_share_name:
-                    matched_transactions[count] = share
-                    if count == 0:
-                        print(
-                            f"| {'Number':^6} | {'Stock Name':^12} | {'Country Name':^14} | {'Transaction Type':^18} | {'Share Price':^13} | {'Number Of Shares':^18} | {'Transaction Fee':^15} | {'Exchange Rate':^14} | {'Currency':^8} | {'Date':^10} | {'TL Price':^10} | {'USD Price':^10} |")
-                    count += 1
-
-                    print(
-                        f"| {count:^6} | {share['stock_name']:^12} | {share['country_name']:^14} | {share['transaction_type']:^18} | {share['share_price']:^13} | {share['number_of_shares']:^18} | {share['transaction_fee']:^15} | {share['exchange_rate']:^14} | {share['currency']:^8} | {share['date']:^10} | {share['tl_price']:^10} | {share['usd_price']:^10} |")
-            if not matched_transactions:
-                print('There has been no transaction executed for this share.')
-                router()
-            while True:
+                    while True:
+                        try:
+                            number_of_shares = Decimal(input("Enter number of shares: ").strip().replace(',', '.'))
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid number. Try again.')
+                    while True:
+                        try:
+                            transaction_fee = Decimal(input("Enter transaction fee: ").strip().replace(',', '.'))
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid fee. Try again.')
+                    while True:
+                        try:
+                            ex_raw = input("Enter exchange rate, if you want to get it automatically enter 0: ").strip().replace(',', '.')
+                            exchange_rate = Decimal(ex_raw)
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid rate. Try again.')
+                    if exchange_rate == Decimal('0'):
+                        exchange_rate = get_usd_try()
+                        if exchange_rate is None:
+                            print("Failed to get the dollar value.")
+                            return
+                    while True:
+                        currency = input("Enter currency: (tl, usd): ").upper()
+                        if currency in ('TL', 'USD'):
+                            break
+                        else:
+                            print('You can only enter TL or USD')
+                    while True:
+                        date = input("Enter date (YYYY-MM-DD), if you want to get it automatically enter 0: ")
+                        if  date == '0':
+                            date = str(datetime.today()).split()[0]
+                            break
+                        elif is_valid_date(date):
+                            break
+                        else:
+                            print('You need to enter a valid date. (Ex: 2025-12-19)')
+                    share_purchase(stock_name=stock_name, country_name= country_name, transaction_type='purchase',
+                                   share_price=share_price, number_of_shares=number_of_shares,
+                                   transaction_fee=transaction_fee, exchange_rate=exchange_rate,
+                                   currency=currency, date=date)
+                except ValueError as e:
+                    print(f'Invalid input detected. {e}')
+                    print('You are being redirected to the previous page.')
+                    load_bar()
+                    continue
+                else:
+                    return
+
+            elif choice == 2:
+                read_shares_csv()
                 try:
-                    choice = int(input('Please enter the number of transaction you want to edit: '))
-                except ValueError:
-                    print('You can only enter a number.')
+                    stock_name = input("Enter stock name: ").upper()
+                    share_price = ask_price(country_name, stock_name)
+                    if share_price is None:
+                        print('Operation cancelled.')
+                        return
+                    while True:
+                        try:
+                            number_of_shares = Decimal(input("Enter number of shares: ").strip().replace(',', '.'))
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid number. Try again.')
+                    while True:
+                        try:
+                            transaction_fee = Decimal(input("Enter transaction fee: ").strip().replace(',', '.'))
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid fee. Try again.')
+                    while True:
+                        try:
+                            ex_raw = input("Enter exchange rate, if you want to get it automatically enter 0: ").strip().replace(',', '.')
+                            exchange_rate = Decimal(ex_raw)
+                            break
+                        except (InvalidOperation, ValueError):
+                            print('Invalid rate. Try again.')
+                    if exchange_rate == Decimal('0'):
+                        exchange_rate = get_usd_try()
+                        if exchange_rate is None:
+                            print("Failed to get the dollar value.")
+                            return
+                    while True:
+                        currency = input("Enter currency: (tl, usd): ").upper()
+                        if currency in ('TL', 'USD'):
+                            break
+                        else:
+                            print('You can only enter TL or USD')
+                    while True:
+                        date = input("Enter date (YYYY-MM-DD), if you want to get it automatically enter 0: ")
+                        if  date == '0':
+                            date = str(datetime.today()).split()[0]
+                            break
+                        elif is_valid_date(date):
+                            break
+                        else:
+                            print('You need to enter a valid date. (Ex: 2025-12-19)')
+                    share_sale(stock_name=stock_name, country_name= country_name, transaction_type='sale',
+                                   share_price=share_price, number_of_shares=number_of_shares,
+                                   transaction_fee=transaction_fee, exchange_rate=exchange_rate,
+                                   currency=currency, date=date)
+                except ValueError as e:
+                    print(f'Invalid input detected. {e}')
+                    print('You are being redirected to the previous page.')
+                    load_bar()
+                    continue
                 else:
-                    if 0<= choice <= count:
+                    return
+            elif choice == 3: # Edit past transactions.
+                if not has_operations():
+                    print('There has been no transaction yet. First, you need to make a transaction.')
 
-                        break
-                    else:
-                        print(f'You can only enter a number between 0-{count} (Enter 0 to exit)')
+                usr_share_name = input('Please enter the name of the share you want to edit (eg. NVDA): ').strip().upper()
+                matched_transactions = {}
+                count = 0
+                id_edit = 0
+                for share in find_operations(usr_share_name):
+                    if share['stock_name'] == usr_share_name:
+                        matched_transactions[count] = share
+                        if count == 0:
+                            print(
+                                f"| {'Number':^6} | {'Stock Name':^12} | {'Country Name':^14} | {'Transaction Type':^18} | {'Share Price':^13} | {'Number Of Shares':^18} | {'Transaction Fee':^15} | {'Exchange Rate':^14} | {'Currency':^8} | {'Date':^10} | {'TL Price':^10} | {'USD Price':^10} |")
+                        count += 1
 
-            print('This function has not yet been completed.')
+                        print(
+                            f"| {count:^6} | {share['stock_name']:^12} | {share['country_name']:^14} | {share['transaction_type']:^18} | {share['share_price']:^13} | {share['number_of_shares']:^18} | {share['transaction_fee']:^15} | {share['exchange_rate']:^14} | {share['currency']:^8} | {share['date']:^10} | {share['tl_price']:^10} | {share['usd_price']:^10} |")
+                if not matched_transactions:
+                    print('There has been no transaction executed for this share.')
+                    return
+                while True:
+                    try:
+                        choice = int(input('Please enter the number of transaction you want to edit: '))
+                    except ValueError:
+                        print('You can only enter a number.')
+                    else:
+                        if 0<= choice <= count:
 
+                            break
+                        else:
+                            print(f'You can only enter a number between 0-{count} (Enter 0 to exit)')
 
+                print('This function has not yet been completed.')
+                return
 
-        else:
-            print('Please enter a number within the valid range.')
-            opr(country_name)
+            else:
+                print('Please enter a number within the valid range.')
 
 
 def show_inflation_rates():
     print('_' * 34)
     print(f"|{'Month':^10}|{'Year':^6}|{'Country':^7}|{'Rate':^6}|")
-    with open('inflation.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            month = ""
-            month_num = int(row['month'])
-            months = {
-                1: "January",
-                2: "February",
-                3: "March",
-                4: "April",
-                5: "May",
-                6: "June",
-                7: "July",
-                8: "August",
-                9: "September",
-                10: "October",
-                11: "November",
-                12: "December"
-            }
-            month = months.get(month_num, f"Month {month_num}")
-            print(f"|{month:^10}|{row['year']:^6}|{row['country']:^7}|{row['rate']:^6}|")
+    for row in read_inflation_rows():
+        month = ""
+        month_num = int(row['month'])
+        months = {
+            1: "January",
+            2: "February",
+            3: "March",
+            4: "April",
+            5: "May",
+            6: "June",
+            7: "July",
+            8: "August",
+            9: "September",
+            10: "October",
+            11: "November",
+            12: "December"
+        }
+        month = months.get(month_num, f"Month {month_num}")
+        print(f"|{month:^10}|{row['year']:^6}|{row['country']:^7}|{row['rate']:^6}|")
     print('¯' * 34)
-    router()
 
 
 def edit_inflation_rates():
     create_files()
-    print()
-    print('1. Add a new inflation rate')
-    print('2. Edit an existing inflation rate')
-    print('3. Delete an existing inflation rate')
-    print('4. Show all inflation rates')
-    print('0. Return to the previous page.')
-    choice = input("Please enter the action you wish to perform from the options above: ")
-    if choice == '1': # Add a new inflation rate
-        try:
-            month = int(input("Enter the month: (eg. 12 for December): "))
-            year = int(input("Enter the year: (eg. 2025): "))
-            country = input("Enter the country: (eg. TR): ").strip().upper()
-            rate_input = input("Enter the rate: (eg. 1.5): ").strip().replace(',', '.')
-            rate = Decimal(rate_input)
-        except ValueError:
-            print("Please enter a valid number.")
-            edit_inflation_rates()
-            return
+    while True:
+        print()
+        print('1. Add a new inflation rate')
+        print('2. Edit an existing inflation rate')
+        print('3. Delete an existing inflation rate')
+        print('4. Show all inflation rates')
+        print('5. Import rates from a CSV or JSON file')
+        print('0. Return to the previous page.')
+        choice = input("Please enter the action you wish to perform from the options above: ")
+        if choice == '1': # Add a new inflation rate
+            try:
+                month = int(input("Enter the month: (eg. 12 for December): "))
+                year = int(input("Enter the year: (eg. 2025): "))
+                country = input("Enter the country: (eg. TR): ").strip().upper()
+                rate_input = input("Enter the rate: (eg. 1.5): ").strip().replace(',', '.')
+                rate = Decimal(rate_input)
+            except ValueError:
+                print("Please enter a valid number.")
+                continue
 
-        if country not in {'TR', 'US'}:
-            print("Please enter a valid country.")
-            edit_inflation_rates()
-            return
-        elif not (1 <= month <= 12):
-            print("Please enter a valid month.")
-            edit_inflation_rates()
-            return
-        elif not (2000 <= year <= 2100):
-            print("Please enter a valid year.")
-            edit_inflation_rates()
-            return
-        else:
-            # Duplicate check
-            exists = False
-            with open('inflation.csv', mode='r', newline='') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['month'] == str(month) and row['year'] == str(year) and row['country'] == country:
-                        exists = True
-                        break
-            if exists:
-                print('A record for the same (month, year, country) already exists. Use edit option.')
-                return
-            with open('inflation.csv', mode='a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow([month, year, country, str(rate)])
-            print('Inflation rate saved successfully.')
+            if country not in {'TR', 'US'}:
+                print("Please enter a valid country.")
+                continue
+            elif not (1 <= month <= 12):
+                print("Please enter a valid month.")
+                continue
+            elif not (2000 <= year <= 2100):
+                print("Please enter a valid year.")
+                continue
+            else:
+                if not add_inflation_rate(month, year, country, rate):
+                    print('A record for the same (month, year, country) already exists. Use edit option.')
+                    return
+                print('Inflation rate saved successfully.')
 
-    elif choice == '2': # Edit an existing inflation rate
-        rows = []
-        with open('inflation.csv', mode='r', newline='') as f:
-            reader = csv.DictReader(f)
-            fieldnames = reader.fieldnames
-            for row in reader:
-                rows.append(row)
+        elif choice == '2': # Edit an existing inflation rate
+            for row in read_inflation_rows():
                 print(row)
             try:
                 month = int(input("Enter the month you want to edit: (eg. 12 for December): "))
@@ -678,43 +2365,25 @@ def edit_inflation_rates():
                 rate = Decimal(rate_input)
             except ValueError:
                 print("Please enter a valid number.")
-                edit_inflation_rates()
-                return
+                continue
 
             if country not in {'TR', 'US'}:
                 print("Please enter a valid country.")
-                edit_inflation_rates()
-                return
+                continue
             elif month < 1 or month > 12:
                 print("Please enter a valid month.")
-                edit_inflation_rates()
-                return
+                continue
             elif year < 2000 or year > 2100:
                 print("Please enter a valid year.")
-                edit_inflation_rates()
-                return
+                continue
             else:
-                with open('inflation.csv', mode='w', newline='') as f:
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    found = False
-                    for row in rows:
-                        if row['month'] == str(month) and row['year'] == str(year) and row['country'] == country:
-                            row['rate'] = str(rate)
-                            found = True
-                        writer.writerow(row)
-                if found:
+                if set_inflation_rate(month, year, country, rate):
                     print('Inflation rate saved successfully.')
                 else:
                     print('No matching record found to edit.')
 
-    elif choice == '3': # Delete an existing inflation rate
-        rows = []
-        with open('inflation.csv', mode='r', newline='') as f:
-            reader = csv.DictReader(f)
-            fieldnames = reader.fieldnames
-            for row in reader:
-                rows.append(row)
+        elif choice == '3': # Delete an existing inflation rate
+            for row in read_inflation_rows():
                 print(row)
             try:
                 month = int(input("Enter the month you want to delete: (eg. 12 for December): "))
@@ -722,47 +2391,48 @@ def edit_inflation_rates():
                 country = input("Enter the country you want to delete: (eg. TR): ").strip().upper()
             except ValueError:
                 print("Please enter a valid number.")
-                edit_inflation_rates()
-                return
+                continue
 
             if country != 'TR' and country != 'US':
                 print("Please enter a valid country.")
-                edit_inflation_rates()
-                return
+                continue
             elif month < 1 or month > 12:
                 print("Please enter a valid month.")
-                edit_inflation_rates()
-                return
+                continue
             elif year < 2000 or year > 2100:
                 print("Please enter a valid year.")
-                edit_inflation_rates()
-                return
+                continue
             else:
-                new_rows = []
-                removed = 0
-                for row in rows:
-                    if row['month'] == str(month) and row['year'] == str(year) and row['country'] == country:
-                        removed += 1
-                        continue
-                    new_rows.append(row)
-                with open('inflation.csv', mode='w', newline='') as f:
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(new_rows)
-                if removed:
+                if set_inflation_rate(month, year, country, None):
                     print('Inflation rate deleted successfully.')
                 else:
                     print('No matching record found to delete.')
 
-    elif choice == '4': # Show all inflation rates
-        show_inflation_rates()
+        elif choice == '4': # Show all inflation rates
+            show_inflation_rates()
 
-    elif choice == '0':
-        pass
-    else:
-        print('Please enter a valid number.')
-        edit_inflation_rates()
-    router()
+        elif choice == '5': # Import many rates at once
+            path = input("Enter the file path: ").strip()
+            try:
+                added, updated, errors, gaps = import_inflation_series(path)
+            except (OSError, ValueError) as e:
+                print(f"Could not read the file: {e}")
+                continue
+            for error in errors:
+                print(error)
+            for country, missing in gaps.items():
+                print(f"{country} missing months: {format_gaps(missing)}")
+            if errors or gaps:
+                print('Nothing imported. Fix the file and try again.')
+            else:
+                print(f'Inflation rates imported. Added: {added}, updated: {updated}')
+
+        elif choice == '0':
+            pass
+        else:
+            print('Please enter a valid number.')
+            continue
+        return
 
 
 def parse_year_month(date_str: str) -> tuple[int, int]:
@@ -785,153 +2455,680 @@ def iter_year_months(start_year: int, start_month: int, end_year: int, end_month
 
 def load_inflation_rates_by_country(country: str) -> dict[tuple[int, int], Decimal]:
     rates: dict[tuple[int, int], Decimal] = {}
-    with open('inflation.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['country'].strip().upper() != country:
-                continue
-            y = int(row['year'])
-            m = int(row['month'])
-            r = Decimal(str(row['rate']).replace(',', '.'))
-            rates[(y, m)] = r
+    for row in read_inflation_rows():
+        if row['country'].strip().upper() != country:
+            continue
+        y = int(row['year'])
+        m = int(row['month'])
+        r = Decimal(str(row['rate']).replace(',', '.'))
+        rates[(y, m)] = r
     return rates
 
 
+def find_gaps(months: set[tuple[int, int]]) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    # (first missing, last missing) month ranges between the earliest and latest month, in one sorted pass.
+    gaps = []
+    ordered = sorted(months)
+    for prev, ym in zip(ordered, ordered[1:]):
+        first = next_year_month(*prev)
+        if first != ym:
+            last = (ym[0], ym[1] - 1) if ym[1] > 1 else (ym[0] - 1, 12)
+            gaps.append((first, last))
+    return gaps
+
+
+def format_gaps(gaps: list[tuple[tuple[int, int], tuple[int, int]]]) -> str:
+    return ", ".join(f"{a[0]}-{a[1]:02d}" if a == b else f"{a[0]}-{a[1]:02d}..{b[0]}-{b[1]:02d}" for a, b in gaps)
+
+
+def read_inflation_records(path: str):
+    # Yields (label for messages, row dict) from a month,year,country,rate CSV or a JSON file holding
+    # either a list of such objects or {"TR": {"2024-01": 2.97, ...}, "US": {...}}.
+    if not path.lower().endswith('.json'):
+        with open(path, mode='r', newline='') as f:
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                yield f"line {line_no}", row
+        return
+    with open(path, mode='r') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        for country, months in data.items():
+            if not isinstance(months, dict):
+                raise ValueError(f"{path}: expected month -> rate objects per country")
+            for ym, rate in months.items():
+                year, _, month = str(ym).partition('-')
+                yield f"{country} {ym}", {'month': month, 'year': year, 'country': country, 'rate': rate}
+    elif isinstance(data, list):
+        for i, row in enumerate(data, start=1):
+            yield f"item {i}", row if isinstance(row, dict) else {}
+    else:
+        raise ValueError(f"{path}: expected a list or an object")
+
+
+@timed('import inflation')
+def import_inflation_series(path: str, allow_gaps: bool = False) -> tuple[int, int, list[str], dict[str, list]]:
+    # Returns (added, updated, errors, {country: gaps}). Rates for months already stored are overwritten.
+    # Nothing is written if any row is invalid or duplicated, or if the merged series has gaps (unless allowed).
+    rates: dict[tuple[str, int, int], Decimal] = {}
+    months: dict[str, set[tuple[int, int]]] = {}
+    errors = []
+    for label, row in read_inflation_records(path):
+        try:
+            month, year = int(row['month']), int(row['year'])
+            country = row['country'].strip().upper()
+            rate = Decimal(str(row['rate']).strip().replace(',', '.'))
+        except (KeyError, TypeError, ValueError, AttributeError, InvalidOperation):
+            errors.append(f"{label}: invalid row")
+            continue
+        if country not in {'TR', 'US'} or not (1 <= month <= 12) or not (2000 <= year <= 2100):
+            errors.append(f"{label}: invalid month, year or country")
+            continue
+        if (country, year, month) in rates:
+            errors.append(f"{label}: duplicate {country} {year}-{month:02d}")
+            continue
+        rates[(country, year, month)] = rate
+        months.setdefault(country, set()).add((year, month))
+
+    index = load_cpi_index()
+    gaps = {}
+    for country, new_months in sorted(months.items()):
+        country_gaps = find_gaps(new_months | set(index.get(country, {})))
+        if country_gaps:
+            gaps[country] = country_gaps
+    if errors or (gaps and not allow_gaps) or not rates:
+        return 0, 0, errors, gaps
+    added, updated = set_inflation_rates(rates)
+    return added, updated, errors, gaps
+
+
+# Persisted cumulative CPI index per country, kept in sync with the inflation data.
+# Each month maps to (rate, index, run_start): index = product of (1 + rate/100) from run_start up to the
+# month, where run_start is the first month of the gap-free run containing it. The index ratio of two
+# months in the same run gives the compounded inflation between them in O(1).
+CPI_INDEX_FILE = 'cpi_index.json'
+
+_cpi_index: dict[str, dict[tuple[int, int], tuple[Decimal, Decimal, tuple[int, int]]]] | None = None
+_cpi_index_source: list[int] | None = None
+_cpi_index_pinned = False  # set in valuation workers, which share the parent's index
+
+
+def pin_cpi_index(index: dict[str, dict[tuple[int, int], tuple[Decimal, Decimal, tuple[int, int]]]]):
+    global _cpi_index, _cpi_index_pinned
+    _cpi_index, _cpi_index_pinned = index, True
+
+
+def inflation_fingerprint() -> list[int] | None:
+    # Changes whenever the inflation data is written: a version counter for SQLite, stat() for the CSV.
+    if STORAGE_BACKEND == 'sqlite':
+        return [sqlite_inflation_version()]
+    try:
+        st = os.stat(portfolio_path('inflation.csv'))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def recompute_cpi_suffix(series: dict[tuple[int, int], tuple[Decimal, Decimal, tuple[int, int]]], start: tuple[int, int]):
+    # Recompute index/run_start for every month >= start, continuing from the month before it.
+    suffix = sorted(ym for ym in series if ym >= start)
+    prev = max((ym for ym in series if ym < start), default=None)
+    for ym in suffix:
+        rate = series[ym][0]
+        growth = Decimal('1') + rate / Decimal('100')
+        if prev is not None and next_year_month(*prev) == ym:
+            _, prev_index, run_start = series[prev]
+            series[ym] = (rate, prev_index * growth, run_start)
+        else:
+            series[ym] = (rate, growth, ym)
+        prev = ym
+
+
+@timed('cpi.rebuild')
+def rebuild_cpi_index():
+    global _cpi_index, _cpi_index_source
+    _cpi_index = {}
+    for country in ('TR', 'US'):
+        series = {ym: (rate, Decimal('0'), ym) for ym, rate in load_inflation_rates_by_country(country).items()}
+        if series:
+            recompute_cpi_suffix(series, min(series))
+        _cpi_index[country] = series
+    _cpi_index_source = inflation_fingerprint()
+    save_cpi_index()
+
+
+@timed('json.write cpi index')
+def save_cpi_index():
+    data = {
+        'source': _cpi_index_source,
+        'series': {
+            country: [[y, m, str(rate), str(index), rs[0], rs[1]] for (y, m), (rate, index, rs) in sorted(series.items())]
+            for country, series in _cpi_index.items()
+        },
+    }
+    try:
+        atomic_write(portfolio_path(CPI_INDEX_FILE), json.dumps(data).encode('utf-8'))
+    except OSError:
+        pass
+
+
+@timed('json.read cpi index')
+def read_cpi_index_file() -> bool:
+    global _cpi_index, _cpi_index_source
+    try:
+        with open(portfolio_path(CPI_INDEX_FILE), mode='r') as f:
+            data = json.load(f)
+        _cpi_index = {
+            country: {(y, m): (Decimal(rate), Decimal(index), (rs_y, rs_m)) for y, m, rate, index, rs_y, rs_m in rows}
+            for country, rows in data['series'].items()
+        }
+        _cpi_index_source = data['source']
+        return True
+    except (OSError, ValueError, KeyError, TypeError, InvalidOperation):
+        _cpi_index = None
+        _cpi_index_source = None
+        return False
+
+
+def load_cpi_index() -> dict[str, dict[tuple[int, int], tuple[Decimal, Decimal, tuple[int, int]]]]:
+    # Served from memory/disk while the inflation data is unchanged; rebuilt from scratch otherwise.
+    if _cpi_index_pinned:
+        return _cpi_index
+    fingerprint = inflation_fingerprint()
+    if _cpi_index is not None and _cpi_index_source == fingerprint:
+        return _cpi_index
+    if read_cpi_index_file() and _cpi_index_source == fingerprint:
+        return _cpi_index
+    rebuild_cpi_index()
+    return _cpi_index
+
+
+def update_cpi_index(country: str, year: int, month: int, rate: Decimal | None, previous_fingerprint: list[int] | None):
+    # Apply one added/edited (rate) or deleted (rate=None) row after it has been written.
+    update_cpi_index_rows([(country, year, month, rate)], previous_fingerprint)
+
+
+def update_cpi_index_rows(changes: list[tuple[str, int, int, Decimal | None]], previous_fingerprint: list[int] | None):
+    # Apply (country, year, month, rate or None) rows after they have been written, recomputing each
+    # country once from its earliest changed month.
+    # previous_fingerprint is the inflation data's fingerprint before that write; if the stored index does
+    # not match it, the index is stale anyway and is rebuilt in full.
+    global _cpi_index_source
+    if _cpi_index is None or _cpi_index_source != previous_fingerprint:
+        if not read_cpi_index_file() or _cpi_index_source != previous_fingerprint:
+            rebuild_cpi_index()
+            return
+    starts: dict[str, tuple[int, int]] = {}
+    for country, year, month, rate in changes:
+        series = _cpi_index.setdefault(country, {})
+        if rate is None:
+            series.pop((year, month), None)
+        else:
+            series[(year, month)] = (rate, Decimal('0'), (year, month))
+        starts[country] = min(starts.get(country, (year, month)), (year, month))
+    for country, start in starts.items():
+        recompute_cpi_suffix(_cpi_index[country], start)
+    _cpi_index_source = inflation_fingerprint()
+    save_cpi_index()
+
+
+@timed('calc.build_deflators')
 def build_deflators(country: str, base_year: int, base_month: int, needed_months: list[tuple[int, int]]):
-    rates = load_inflation_rates_by_country(country)
-    if not rates:
+    series = load_cpi_index().get(country)
+    if not series:
         return None, {m for m in needed_months}
 
-    min_needed = min(needed_months)
+    base = (base_year, base_month)
     max_needed = max(needed_months)
+    deflators: dict[tuple[int, int], Decimal] = {base: Decimal('1')}
+    if max_needed <= base:
+        return deflators, None
+
+    # Every month after base up to max_needed must exist (base itself can be treated as index=1):
+    # that holds iff max_needed is present and its gap-free run starts no later than the month after base.
+    first = next_year_month(base_year, base_month)
+    last = series.get(max_needed)
+    if last is None or last[2] > first:
+        missing = {ym for ym in iter_year_months(first[0], first[1], max_needed[0], max_needed[1]) if ym not in series}
+        return None, missing
+
+    # Deflator D(t) = I(base) / I(t), with I(base) implied by the first month after it.
+    first_rate, first_index, _ = series[first]
+    base_index = first_index / (Decimal('1') + first_rate / Decimal('100'))
+    for ym in needed_months:
+        if ym > base:
+            deflators[ym] = base_index / series[ym][1]
+    return deflators, None
+
+
+def get_current_dollar_rate_interactive() -> Decimal | None:
+    hit = cache_get(('FX', 'USDTRY'))
+    if hit is not None:
+        print(f"Using cached USD/TRY: {hit[0]} (fetched {format_age(hit[1])})")
+        return hit[0]
+    rate = get_usd_try()
+    if rate is None:
+        try:
+            manual = input("Failed to fetch USD/TRY. Enter rate manually (e.g., 41.50) or 0 to cancel: ").strip()
+            if manual == '0':
+                return None
+            return Decimal(manual.replace(',', '.'))
+        except Exception:
+            return None
+    return rate
+
+
+def needs_usdtry(shares: list[dict], reference_country: str) -> bool:
+    # USD/TRY is only needed to convert holdings quoted in the other currency.
+    other = 'US' if reference_country == 'TR' else 'TR'
+    return any(share['country_name'].strip().upper() == other for share in shares)
+
+
+def price_in_reference(price: Decimal, native_country: str, reference_country: str, usdtry: Decimal | None) -> Decimal:
+    if reference_country == 'TR':
+        if native_country == 'US':
+            return round_money(price * usdtry)
+        return round_money(price)
+    if native_country == 'TR':
+        return round_money(price / usdtry)
+    return round_money(price)
+
+
+def price_holdings_in_reference(shares: list[dict], prices: dict[str, Decimal], reference_country: str, usdtry: Decimal | None) -> list[dict]:
+    current_prices = []
+    for share in shares:
+        native_country = share['country_name'].strip().upper()
+        price = prices[share['share_name']]
+        price_in_ref = price_in_reference(price, native_country, reference_country, usdtry)
+        current_prices.append({
+            'share_name': share['share_name'],
+            'native_country': native_country,
+            'quantity': Decimal(str(share['quantity'])),
+            'native_price': price,
+            'price_in_ref': price_in_ref
+        })
+    return current_prices
+
+
+def prompt_current_prices_for_shares(reference_country: str) -> tuple[list[dict] | None, Decimal | None]:
+    rows = read_shares()
+
+    if not rows:
+        return [], None
+
+    prices = ask_prices_for_shares(rows)
+    if prices is None or any(prices.get(share['share_name']) is None for share in rows):
+        return None, None
+
+    usdtry = None
+    if needs_usdtry(rows, reference_country):
+        usdtry = get_current_dollar_rate_interactive()
+        if usdtry is None:
+            return None, None
+
+    return price_holdings_in_reference(rows, prices, reference_country, usdtry), usdtry
+
+
+def aggregate_cash_flows(operations, ref_ccy: str) -> dict[tuple[int, int], list[Decimal]]:
+    # Single pass over the ledger: each operation is parsed once and folded into its month's
+    # [outflows, inflows] in the reference currency (purchases and fees out, sales in).
+    # Memory grows with the number of distinct months, not with the number of operations.
+    price_field = 'tl_price' if ref_ccy == 'TL' else 'usd_price'
+    buckets: dict[tuple[int, int], list[Decimal]] = {}
+    for op in operations:
+        ym = parse_year_month(op['date'])
+        bucket = buckets.get(ym)
+        if bucket is None:
+            bucket = buckets[ym] = [Decimal('0'), Decimal('0')]
+        kind = op['transaction_type'].strip().lower()
+        if kind == 'purchase':
+            amount_ref = -Decimal(op[price_field])
+        elif kind == 'sale':
+            amount_ref = Decimal(op[price_field])
+        else:
+            # Unknown type, skip
+            continue
+        bucket[0 if amount_ref < 0 else 1] += amount_ref
+
+        # Include transaction fee as an additional negative cash flow
+        fee_ref = fee_in_reference(op, ref_ccy)
+        if fee_ref:
+            bucket[0 if fee_ref > 0 else 1] -= fee_ref
+    return buckets
+
+
+def fee_in_reference(op: dict, ref_ccy: str) -> Decimal | None:
+    try:
+        fee_native = Decimal(str(op['transaction_fee']).strip())
+    except Exception:
+        return None
+    if fee_native == 0:
+        return None
+    op_ccy = op['currency'].strip().upper()
+    if op_ccy == ref_ccy:
+        return fee_native
+    try:
+        rate = Decimal(str(op['exchange_rate']).strip())
+    except Exception:
+        rate = None
+    if rate is None or rate == 0:
+        # Fallback: if rate missing, skip fee conversion for safety
+        return None
+    if op_ccy == 'USD' and ref_ccy == 'TL':
+        return round_money(fee_native * rate)
+    if op_ccy == 'TL' and ref_ccy == 'USD':
+        return round_money(fee_native / rate)
+    return None
+
+
+def deflate_cash_flows(buckets: dict[tuple[int, int], list[Decimal]], deflators: dict[tuple[int, int], Decimal]) -> tuple[Decimal, Decimal]:
+    # Returns (sum of real cash flows, invested real capital as a positive amount).
+    total_real_cashflows = Decimal('0')
+    invested_real_abs = Decimal('0')
+    for ym, (outflows, inflows) in buckets.items():
+        deflator = deflators[ym]
+        real_out = round_money(outflows * deflator)
+        total_real_cashflows += real_out + round_money(inflows * deflator)
+        invested_real_abs -= real_out
+    return total_real_cashflows, invested_real_abs
+
+
+# Opt-in vectorized path (REEL_PROFIT_FAST_MATH=1, requires numpy): operations are loaded into columnar
+# float arrays and deflated in bulk. It skips round_money per month, so totals may differ from the exact
+# Decimal path by float error plus the rounding it skips; check_fast_math() verifies the difference stays
+# within FAST_MATH_TOLERANCE (absolute, in the reference currency) plus FAST_MATH_RELATIVE_TOLERANCE of
+# the total.
+FAST_MATH = os.environ.get('REEL_PROFIT_FAST_MATH', '').strip() == '1'
+FAST_MATH_TOLERANCE = Decimal('0.01')
+FAST_MATH_RELATIVE_TOLERANCE = Decimal('1e-9')
+
+
+def use_fast_math() -> bool:
+    return FAST_MATH and load_numpy() is not None
+
+
+def month_index(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+
+def load_operation_columns(operations, ref_ccy: str) -> dict:
+    # Columns: month index, signed amount in reference currency, fee converted to reference currency.
+    if load_numpy() is None:
+        raise ImportError('The FAST_MATH path needs numpy (pip install numpy).')
+    price_field = 'tl_price' if ref_ccy == 'TL' else 'usd_price'
+    months, amounts, fees, rates, same_ccy = [], [], [], [], []
+    for op in operations:
+        y, m = parse_year_month(op['date'])
+        kind = op['transaction_type'].strip().lower()
+        if kind == 'purchase':
+            sign = -1.0
+        elif kind == 'sale':
+            sign = 1.0
+        else:
+            sign = 0.0  # Unknown type: only counts towards the base month
+        try:
+            fee = float(op['transaction_fee']) if sign else 0.0
+        except ValueError:
+            fee = 0.0
+        try:
+            rate = float(op['exchange_rate'])
+        except ValueError:
+            rate = 0.0
+        months.append(month_index(y, m))
+        amounts.append(sign * float(op[price_field]) if sign else 0.0)
+        fees.append(fee)
+        rates.append(rate)
+        same_ccy.append(op['currency'].strip().upper() == ref_ccy)
+
+    fee = np.array(fees, dtype=np.float64)
+    rate = np.array(rates, dtype=np.float64)
+    same = np.array(same_ccy, dtype=bool)
+    if ref_ccy == 'TL':
+        converted = fee * rate
+    else:
+        converted = np.divide(fee, rate, out=np.zeros_like(fee), where=rate != 0)
+    # Fallback: if rate missing, skip fee conversion for safety
+    fee_ref = np.where(same, fee, np.where(rate != 0, converted, 0.0))
+    return {
+        'month': np.array(months, dtype=np.int64),
+        'amount': np.array(amounts, dtype=np.float64),
+        'fee': fee_ref,
+    }
+
+
+def column_months(columns: dict) -> list[tuple[int, int]]:
+    return [(int(i) // 12, int(i) % 12 + 1) for i in np.unique(columns['month'])]
+
+
+def vectorized_cash_flows(columns: dict, deflators: dict[tuple[int, int], Decimal]) -> tuple[Decimal, Decimal]:
+    # Same result as deflate_cash_flows(aggregate_cash_flows(...)), computed in bulk with floats.
+    first = min(month_index(y, m) for y, m in deflators)
+    last = max(month_index(y, m) for y, m in deflators)
+    by_month = np.zeros(last - first + 1, dtype=np.float64)
+    for (y, m), deflator in deflators.items():
+        by_month[month_index(y, m) - first] = float(deflator)
+    d = by_month[columns['month'] - first]
+    flows = np.concatenate((columns['amount'] * d, -columns['fee'] * d))
+    total = flows.sum()
+    invested = -flows[flows < 0].sum()
+    return round_money(Decimal(repr(float(total)))), round_money(Decimal(repr(float(invested))))
+
+
+def check_fast_math(ref_country: str) -> tuple[bool, Decimal, Decimal]:
+    # Runs both paths on the stored ledger; returns (within tolerance, exact total, vectorized total).
+    ref_ccy = 'TL' if ref_country == 'TR' else 'USD'
+    buckets = aggregate_cash_flows(iter_operations(), ref_ccy)
+    if not buckets:
+        return True, Decimal('0'), Decimal('0')
+    today = datetime.today()
+    needed = sorted(set(buckets) | {(today.year, today.month)})
+    deflators, missing = build_deflators(ref_country, *min(buckets), needed)
+    if missing is not None:
+        raise ValueError(f"Missing inflation data for {len(missing)} month(s).")
+    exact_total, exact_invested = deflate_cash_flows(buckets, deflators)
+    fast_total, fast_invested = vectorized_cash_flows(load_operation_columns(iter_operations(), ref_ccy), deflators)
+    ok = True
+    for exact, fast in ((exact_total, fast_total), (exact_invested, fast_invested)):
+        if abs(exact - fast) > FAST_MATH_TOLERANCE + abs(exact) * FAST_MATH_RELATIVE_TOLERANCE:
+            ok = False
+    return ok, exact_total, fast_total
+
+
+# Real return rates (XIRR and TWR). Dated cash flows are deflated to base-month purchasing power with
+# their month's deflator, so both rates are real. They are solved in floats (numpy arrays when available)
+# since they are reported as percentages, not money.
+XIRR_TOLERANCE = 1e-10
+XIRR_MAX_ITERATIONS = 50
+XIRR_LOWEST_RATE = -0.99
+# Below this many flows plain Python beats converting to numpy arrays (and importing numpy at all).
+VECTORIZE_MIN_FLOWS = 256
 
-    # Ensure base is included
-    all_months = list(iter_year_months(base_year, base_month, max_needed[0], max_needed[1]))
 
-    # Check missing months (excluding base which can be treated as index=1)
-    missing = set()
-    for (y, m) in all_months:
-        if (y, m) == (base_year, base_month):
+def dated_ledger_flows(operations, ref_ccy: str) -> dict[str, list]:
+    # {date: [net cash flow in the reference currency (purchases and fees negative), {stock: [country, quantity delta]}]}
+    price_field = 'tl_price' if ref_ccy == 'TL' else 'usd_price'
+    flows: dict[str, list] = {}
+    for op in operations:
+        kind = op['transaction_type'].strip().lower()
+        if kind == 'purchase':
+            amount_ref = -Decimal(op[price_field])
+            delta = Decimal(op['number_of_shares'])
+        elif kind == 'sale':
+            amount_ref = Decimal(op[price_field])
+            delta = -Decimal(op['number_of_shares'])
+        else:
             continue
-        if (y, m) not in rates:
-            missing.add((y, m))
+        fee_ref = fee_in_reference(op, ref_ccy)
+        if fee_ref:
+            amount_ref -= fee_ref
+        entry = flows.get(op['date'])
+        if entry is None:
+            entry = flows[op['date']] = [Decimal('0'), {}]
+        entry[0] += amount_ref
+        holding = entry[1].setdefault(op['stock_name'], [op['country_name'].strip().upper(), Decimal('0')])
+        holding[1] += delta
+    return flows
+
+
+def year_fractions(dates: list[str]) -> list[float]:
+    start = datetime.strptime(dates[0], "%Y-%m-%d")
+    return [(datetime.strptime(date, "%Y-%m-%d") - start).days / 365.0 for date in dates]
+
+
+def npv_and_slope(rate: float, times, amounts) -> tuple[float, float]:
+    # Net present value of the flows at rate and its derivative with respect to rate.
+    if np is not None and isinstance(amounts, np.ndarray):
+        values = amounts * (1.0 + rate) ** -times
+        return float(values.sum()), float(-(times * values).sum() / (1.0 + rate))
+    values = [amount * (1.0 + rate) ** -t for t, amount in zip(times, amounts)]
+    return sum(values), -sum(t * value for t, value in zip(times, values)) / (1.0 + rate)
+
+
+def xirr(times: list[float], amounts: list[float]) -> float | None:
+    # Annual rate r with sum(amount * (1 + r) ** -t) == 0, t in years. Newton's method first; if it
+    # stalls or leaves the domain, bisection between rates whose NPVs have opposite signs.
+    # None without both negative and positive flows or when no root lies in the searched range.
+    if not (any(a < 0 for a in amounts) and any(a > 0 for a in amounts)):
+        return None
+    if len(amounts) >= VECTORIZE_MIN_FLOWS and load_numpy() is not None:
+        times, amounts = np.asarray(times, dtype=float), np.asarray(amounts, dtype=float)
+
+    rate = 0.1
+    for _ in range(XIRR_MAX_ITERATIONS):
+        value, slope = npv_and_slope(rate, times, amounts)
+        if slope == 0 or not math.isfinite(value) or not math.isfinite(slope):
+            break
+        new_rate = rate - value / slope
+        if new_rate <= XIRR_LOWEST_RATE or not math.isfinite(new_rate):
+            break
+        if abs(new_rate - rate) < XIRR_TOLERANCE:
+            return new_rate
+        rate = new_rate
+
+    low, high = XIRR_LOWEST_RATE, 1.0
+    low_value = npv_and_slope(low, times, amounts)[0]
+    while npv_and_slope(high, times, amounts)[0] * low_value > 0:
+        high *= 2
+        if high > 1e6:
+            return None
+    while high - low > XIRR_TOLERANCE:
+        mid = (low + high) / 2
+        mid_value = npv_and_slope(mid, times, amounts)[0]
+        if mid_value * low_value > 0:
+            low, low_value = mid, mid_value
+        else:
+            high = mid
+    return (low + high) / 2
 
-    if missing:
-        return None, missing
 
-    # Build CPI index with base = 1.0
-    index: dict[tuple[int, int], Decimal] = {}
-    index[(base_year, base_month)] = Decimal('1')
-    prev_y, prev_m = base_year, base_month
-    for (y, m) in iter_year_months(base_year, base_month, max_needed[0], max_needed[1]):
-        if (y, m) == (base_year, base_month):
+def value_at_closes(holdings: dict[str, list], date: str, ref_country: str) -> tuple[Decimal, list[str]]:
+    # Nominal value in the reference currency of {stock: [country, quantity]} at the stored closes on or
+    # before date. Returns (value, names without a close), the latter left out of the value.
+    usdtry = historical_close(('FX', 'USDTRY'), date)
+    value = Decimal('0')
+    missing = []
+    for name, (country, qty) in holdings.items():
+        close = historical_close((country, name.strip().upper()), date)
+        if close is None or (usdtry is None and country != ref_country):
+            missing.append(name)
             continue
-        prev_index = index[(prev_y, prev_m)]
-        monthly_rate = rates[(y, m)]  # percent per month
-        growth = (Decimal('1') + (monthly_rate / Decimal('100')))
-        index[(y, m)] = (prev_index * growth)
-        prev_y, prev_m = y, m
-
-    # Deflator D(t) = 1 / I(t)
-    deflators = {ym: (Decimal('1') / idx) for ym, idx in index.items()}
-    return deflators, None
+        value += round_money(price_in_reference(close, country, ref_country, usdtry) * qty)
+    return value, missing
 
 
-def get_current_dollar_rate_interactive() -> Decimal | None:
-    rate = get_dollar()
-    if rate is None:
-        try:
-            manual = input("Failed to fetch USD/TRY. Enter rate manually (e.g., 41.50) or 0 to cancel: ").strip()
-            if manual == '0':
-                return None
-            return Decimal(manual.replace(',', '.'))
-        except Exception:
-            return None
-    return rate
+def time_weighted_return(flows: dict[str, list], deflators: dict[tuple[int, int], Decimal], ref_country: str,
+                         end_value_real: Decimal) -> tuple[float | None, list[str]]:
+    # Chains the real sub-period returns between flow dates: each period starts with the holdings value
+    # plus that date's contribution and ends with the value just before the next flow (stored closes)
+    # or end_value_real. Periods starting with no holdings are skipped. Returns (TWR, unpriced names).
+    holdings: dict[str, list] = {}
+    starts, ends = [], []
+    unpriced = set()
+    for date in sorted(flows):
+        net, deltas = flows[date]
+        deflator = deflators[parse_year_month(date)]
+        before = Decimal('0')
+        if holdings:
+            before, missing = value_at_closes(holdings, date, ref_country)
+            unpriced.update(missing)
+            ends.append(round_money(before * deflator))
+        for name, (country, delta) in deltas.items():
+            entry = holdings.setdefault(name, [country, Decimal('0')])
+            entry[1] += delta
+            if entry[1] <= 0:
+                del holdings[name]
+        if holdings:
+            starts.append(round_money((before - net) * deflator))
+    if unpriced:
+        return None, sorted(unpriced)
+    if holdings:
+        ends.append(end_value_real)
+    if len(starts) >= VECTORIZE_MIN_FLOWS and load_numpy() is not None:
+        starts, ends = np.array(starts, dtype=float), np.array(ends, dtype=float)
+        growth = float(np.prod(ends[starts > 0] / starts[starts > 0]))
+    else:
+        growth = math.prod(float(end) / float(start) for start, end in zip(starts, ends) if start > 0)
+    return growth - 1.0, []
 
 
-def prompt_current_prices_for_shares(reference_country: str) -> tuple[list[dict] | None, Decimal | None]:
-    rows = []
-    with open('shares.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for share in reader:
-            rows.append(share)
+@timed('calc.returns')
+def real_returns(prepared: dict, portfolio_nominal: Decimal) -> dict:
+    # Real XIRR and TWR (annual and whole-period percentages) for a prepare_real_profit() result.
+    # Reads the ledger again by date, so it only runs when asked for (calc --returns, interactive detail).
+    ref_country, as_of = prepared['ref_country'], prepared['as_of']
+    flows = dated_ledger_flows(operations_until(as_of), prepared['ref_ccy'])
+    dates = sorted(flows)
+    months = sorted({parse_year_month(date) for date in dates} | {prepared['current']})
+    deflators, _ = build_deflators(ref_country, *prepared['base'], months)
+    end_value_real = round_money(portfolio_nominal * prepared['curr_deflator'])
 
-    if not rows:
-        return [], None
+    amounts = [float(flows[date][0] * deflators[parse_year_month(date)]) for date in dates]
+    times = year_fractions(dates + [as_of or str(datetime.today().date())])
+    rate = xirr(times, amounts + [float(end_value_real)])
+    twr, unpriced = time_weighted_return(flows, deflators, ref_country, end_value_real)
+    return {
+        'real_xirr_pct': None if rate is None else rate * 100,
+        'real_twr_pct': None if twr is None else twr * 100,
+        'twr_unpriced': unpriced,
+    }
 
-    usdtry = None
-    current_prices = []
-    for share in rows:
-        share_name = share['share_name']
-        native_country = share['country_name'].strip().upper()
-        qty = Decimal(str(share['quantity']))
-        price = ask_price(native_country, share_name)
-        if price is None:
-            return None, None
-        current_prices.append({
-            'share_name': share_name,
-            'native_country': native_country,
-            'quantity': qty,
-            'native_price': price
-        })
 
-    if reference_country == 'TR':
-        if any(p['native_country'] == 'US' for p in current_prices):
-            usdtry = get_current_dollar_rate_interactive()
-            if usdtry is None:
-                return None, None
-    else:
-        if any(p['native_country'] == 'TR' for p in current_prices):
-            usdtry = get_current_dollar_rate_interactive()
-            if usdtry is None:
-                return None, None
+def operations_until(as_of: str | None):
+    # Ledger rows dated on or before as_of (YYYY-MM-DD); the whole ledger for None.
+    for op in iter_operations():
+        if as_of is None or op['date'] <= as_of:
+            yield op
 
-    for p in current_prices:
-        if reference_country == 'TR':
-            if p['native_country'] == 'US':
-                p['price_in_ref'] = round_money(p['native_price'] * usdtry)
-            else:
-                p['price_in_ref'] = round_money(p['native_price'])
-        else:
-            if p['native_country'] == 'TR':
-                p['price_in_ref'] = round_money(p['native_price'] / usdtry)
-            else:
-                p['price_in_ref'] = round_money(p['native_price'])
-    return current_prices, usdtry
 
+def holdings_as_of(as_of: str) -> list[dict]:
+    # Same shape as read_shares(), folded from the ledger rows up to as_of.
+    positions: dict[str, list] = {}
+    fold_positions(positions, ((op['stock_name'], op['country_name'], op['transaction_type'], op['number_of_shares'])
+                               for op in operations_until(as_of)))
+    return [{'share_name': name, 'country_name': country, 'quantity': str(qty)} for name, (country, qty) in positions.items()]
 
-def calculate_reel_profit():
-    # 1) Ask reference inflation country
-    while True:
-        ref_country = input("Reference inflation (TR or US): ").strip().upper()
-        if ref_country in {'TR', 'US'}:
-            break
-        print("Please enter TR or US.")
 
+def prepare_real_profit(ref_country: str, as_of: str | None = None) -> dict:
+    # Everything that does not depend on current prices. Raises ValueError if it cannot be computed.
+    # as_of (YYYY-MM-DD) values the ledger up to that date in that month instead of today.
     ref_ccy = 'TL' if ref_country == 'TR' else 'USD'
 
-    # 2) Read operations and determine base month
-    operations = []
-    with open('operations.csv', mode='r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            operations.append(row)
+    # 2) Stream operations into monthly cash flows (or columns) and determine base month
+    fast = use_fast_math()
+    with timing('calc.cash_flows'):
+        if fast:
+            columns = load_operation_columns(operations_until(as_of), ref_ccy)
+            tx_months = column_months(columns) # type: list[tuple[int, int]]: year, month
+        else:
+            buckets = aggregate_cash_flows(operations_until(as_of), ref_ccy)
+            tx_months = list(buckets)
 
-    if not operations:
-        print('There has been no transaction yet. First, you need to make a transaction.')
-        router()
-        return
+    if not tx_months:
+        raise ValueError('There has been no transaction yet. First, you need to make a transaction.')
 
-    tx_months = [] # type: list[tuple[int, int]]: year, month
-    for op in operations:
-        y, m = parse_year_month(op['date'])
-        tx_months.append((y, m))
-    
     base_year, base_month = min(tx_months)
 
     # 3) Needed months include all tx months and current month
-    today = datetime.today()
+    today = datetime.strptime(as_of, "%Y-%m-%d") if as_of else datetime.today()
     curr_year, curr_month = today.year, today.month
     needed = sorted(set(tx_months + [(curr_year, curr_month)]))
 
@@ -939,83 +3136,43 @@ def calculate_reel_profit():
     deflators, missing = build_deflators(ref_country, base_year, base_month, needed)
     if missing is not None:
         missing_str = ", ".join([f"{y}-{m:02d}" for (y, m) in sorted(missing)])
-        print(f"Missing inflation data for: {missing_str}. Please add rates and try again.")
-        router()
-        return
+        raise ValueError(f"Missing inflation data for: {missing_str}. Please add rates and try again.")
 
-    # Convenience to get deflator for a month (base month uses 1)
-    def get_deflator(y: int, m: int) -> Decimal:
-        if (y, m) == (base_year, base_month):
-            return Decimal('1')
-        return deflators[(y, m)]
-
-    # 5) Aggregate deflated cash flows in reference currency
-    total_real_cashflows = Decimal('0')
-    invested_real_abs = Decimal('0')
-    for op in operations:
-        y, m = parse_year_month(op['date'])
-        amount_ref = Decimal(op['tl_price']) if ref_ccy == 'TL' else Decimal(op['usd_price'])
-        if op['transaction_type'].strip().lower() == 'purchase':
-            amount_ref = -amount_ref
-        elif op['transaction_type'].strip().lower() == 'sale':
-            pass
+    # 5) Deflate the cash flows in reference currency
+    with timing('calc.deflate'):
+        if fast:
+            total_real_cashflows, invested_real_abs = vectorized_cash_flows(columns, deflators)
         else:
-            # Unknown type, skip
-            continue
-        deflator = get_deflator(y, m)
-        real_amount = round_money(amount_ref * deflator)
-        total_real_cashflows += real_amount
-        if real_amount < 0:
-            invested_real_abs += (-real_amount)
+            total_real_cashflows, invested_real_abs = deflate_cash_flows(buckets, deflators)
 
-        # Include transaction fee as an additional negative cash flow
-        try:
-            fee_native = Decimal(str(op['transaction_fee']).strip())
-        except Exception:
-            fee_native = Decimal('0')
-        if fee_native != 0:
-            op_ccy = op['currency'].strip().upper()
-            try:
-                rate = Decimal(str(op['exchange_rate']).strip())
-            except Exception:
-                rate = None
-
-            # Convert fee to reference currency
-            if op_ccy == ref_ccy:
-                fee_ref = fee_native
-            elif op_ccy == 'USD' and ref_ccy == 'TL' and rate is not None and rate != 0:
-                fee_ref = round_money(fee_native * rate)
-            elif op_ccy == 'TL' and ref_ccy == 'USD' and rate is not None and rate != 0:
-                fee_ref = round_money(fee_native / rate)
-            else:
-                # Fallback: if rate missing, skip fee conversion for safety
-                fee_ref = None
+    return {
+        'ref_country': ref_country,
+        'ref_ccy': ref_ccy,
+        'as_of': as_of,
+        'base': (base_year, base_month),
+        'current': (curr_year, curr_month),
+        'curr_deflator': deflators[(curr_year, curr_month)],
+        'total_real_cashflows': total_real_cashflows,
+        'invested_real_abs': invested_real_abs,
+    }
 
-            if fee_ref is not None:
-                fee_real = round_money((-fee_ref) * deflator)
-                total_real_cashflows += fee_real
-                if fee_real < 0:
-                    invested_real_abs += (-fee_real)
 
+@timed('calc.valuation')
+def finish_real_profit(prepared: dict, current_prices: list[dict]) -> dict:
     # 6) Current portfolio nominal value in reference currency
-    current_prices, usdtry = prompt_current_prices_for_shares(ref_country)
-    if current_prices is None:
-        print('Operation cancelled.')
-        router()
-        return
-
     portfolio_nominal_ref = Decimal('0')
     for p in current_prices:
         portfolio_nominal_ref += round_money(p['price_in_ref'] * p['quantity'])
 
     # 7) Deflate current value to base
-    curr_deflator = get_deflator(curr_year, curr_month)
+    curr_deflator = prepared['curr_deflator']
     portfolio_real = round_money(portfolio_nominal_ref * curr_deflator)
 
     # 8) Real gain and ROI (base-month purchasing power)
-    real_gain = round_money(portfolio_real + total_real_cashflows)
+    real_gain = round_money(portfolio_real + prepared['total_real_cashflows'])
     # Convert real gain to today's purchasing power (scale by I(T) = 1 / D(T))
     real_gain_today = round_money(real_gain / curr_deflator)
+    invested_real_abs = prepared['invested_real_abs']
     if invested_real_abs > 0:
         real_roi = (real_gain / invested_real_abs) * Decimal('100')
     else:
@@ -1025,40 +3182,528 @@ def calculate_reel_profit():
     curr_index = (Decimal('1') / curr_deflator)
     inflation_over_period_pct = (curr_index - Decimal('1')) * Decimal('100')
 
-    # 9) Report
+    return dict(prepared, **{
+        'portfolio_nominal': portfolio_nominal_ref,
+        'portfolio_real': portfolio_real,
+        'real_gain': real_gain,
+        'real_gain_today': real_gain_today,
+        'real_roi': real_roi,
+        'inflation_over_period_pct': inflation_over_period_pct,
+    })
+
+
+# Per-holding lot tracking. Purchases open lots whose cost includes the purchase fee; sales close lots
+# first-in first-out or at average cost and realize the proceeds net of the sale fee. Real amounts are
+# deflated with the operation's month deflator, like the portfolio cash flows.
+LOT_METHODS = ('fifo', 'average')
+
+
+class Lot:
+    __slots__ = ('quantity', 'cost', 'real_cost')
+
+    def __init__(self, quantity: Decimal, cost: Decimal, real_cost: Decimal):
+        self.quantity = quantity
+        self.cost = cost
+        self.real_cost = real_cost
+
+
+class LotBook:
+    # Open lots of one symbol (a single merged lot with the average method) and its realized P&L.
+    __slots__ = ('country', 'lots', 'fees', 'realized', 'realized_real')
+
+    def __init__(self, country: str):
+        self.country = country
+        self.lots: deque[Lot] = deque()
+        self.fees = Decimal('0')
+        self.realized = Decimal('0')
+        self.realized_real = Decimal('0')
+
+    def buy(self, quantity: Decimal, cost: Decimal, real_cost: Decimal, average: bool):
+        if average and self.lots:
+            lot = self.lots[0]
+            lot.quantity += quantity
+            lot.cost += cost
+            lot.real_cost += real_cost
+        else:
+            self.lots.append(Lot(quantity, cost, real_cost))
+
+    def sell(self, quantity: Decimal, proceeds: Decimal, real_proceeds: Decimal):
+        # Sales beyond the open quantity realize their proceeds with no cost.
+        cost = real_cost = Decimal('0')
+        lots = self.lots
+        while quantity > 0 and lots:
+            lot = lots[0]
+            if lot.quantity <= quantity:
+                lots.popleft()
+                quantity -= lot.quantity
+                cost += lot.cost
+                real_cost += lot.real_cost
+            else:
+                part_cost = round_money(lot.cost * quantity / lot.quantity)
+                part_real_cost = round_money(lot.real_cost * quantity / lot.quantity)
+                lot.quantity -= quantity
+                lot.cost -= part_cost
+                lot.real_cost -= part_real_cost
+                cost += part_cost
+                real_cost += part_real_cost
+                quantity = Decimal('0')
+        self.realized += proceeds - cost
+        self.realized_real += real_proceeds - real_cost
+
+    def open_position(self) -> tuple[Decimal, Decimal, Decimal]:
+        # (quantity, cost, real cost) of the open lots
+        quantity = cost = real_cost = Decimal('0')
+        for lot in self.lots:
+            quantity += lot.quantity
+            cost += lot.cost
+            real_cost += lot.real_cost
+        return quantity, cost, real_cost
+
+
+def build_lot_books(operations, ref_ccy: str, deflators: dict[tuple[int, int], Decimal], method: str = 'fifo') -> dict[str, LotBook]:
+    # One pass over the ledger; each trade touches only its symbol's book.
+    price_field = 'tl_price' if ref_ccy == 'TL' else 'usd_price'
+    average = method == 'average'
+    books: dict[str, LotBook] = {}
+    for op in operations:
+        kind = op['transaction_type'].strip().lower()
+        if kind not in ('purchase', 'sale'):
+            continue
+        book = books.get(op['stock_name'])
+        if book is None:
+            book = books[op['stock_name']] = LotBook(op['country_name'].strip().upper())
+        deflator = deflators[parse_year_month(op['date'])]
+        amount_ref = Decimal(op[price_field])
+        fee_ref = fee_in_reference(op, ref_ccy) or Decimal('0')
+        book.fees += fee_ref
+        if kind == 'purchase':
+            cost = amount_ref + fee_ref
+            book.buy(Decimal(op['number_of_shares']), cost, round_money(cost * deflator), average)
+        else:
+            proceeds = amount_ref - fee_ref
+            book.sell(Decimal(op['number_of_shares']), proceeds, round_money(proceeds * deflator))
+    return books
+
+
+@timed('calc.lots')
+def holding_pnl(prepared: dict, current_prices: list[dict], method: str = 'fifo') -> list[dict]:
+    # Nominal and real (base-month purchasing power) realized and unrealized P&L per symbol, including
+    # closed positions. Raises ValueError like prepare_real_profit.
+    months = list(iter_year_months(*prepared['base'], *prepared['current']))
+    deflators, missing = build_deflators(prepared['ref_country'], *prepared['base'], months)
+    if missing is not None:
+        raise ValueError(f"Missing inflation data for {len(missing)} month(s).")
+    books = build_lot_books(operations_until(prepared['as_of']), prepared['ref_ccy'], deflators, method)
+    prices_in_ref = {p['share_name']: p['price_in_ref'] for p in current_prices}
+    curr_deflator = prepared['curr_deflator']
+
+    rows = []
+    for name, book in books.items():
+        quantity, cost, real_cost = book.open_position()
+        market_value = round_money(prices_in_ref[name] * quantity) if quantity and name in prices_in_ref else None
+        rows.append({
+            'share_name': name,
+            'country_name': book.country,
+            'quantity': quantity,
+            'cost_basis': cost,
+            'fees': book.fees,
+            'realized': book.realized,
+            'realized_real': book.realized_real,
+            'market_value': market_value,
+            'unrealized': None if market_value is None else market_value - cost,
+            'unrealized_real': None if market_value is None else round_money(market_value * curr_deflator) - real_cost,
+        })
+    return rows
+
+
+def print_holding_pnl(rows: list[dict], ref_ccy: str):
+    print('_' * 102)
+    print(f"|{'Share Name':^12}|{'Quantity':^12}|{'Cost basis':^14}|{'Realized':^14}|{'Real realized':^14}|"
+          f"{'Unrealized':^14}|{'Real unrealized':^15}|")
+    for row in rows:
+        unrealized = '----' if row['unrealized'] is None else f"{row['unrealized']:.4f}"
+        unrealized_real = '----' if row['unrealized_real'] is None else f"{row['unrealized_real']:.4f}"
+        print(f"|{row['share_name']:^12}|{row['quantity']:^12.4f}|{row['cost_basis']:^14.4f}|{row['realized']:^14.4f}|"
+              f"{row['realized_real']:^14.4f}|{unrealized:^14}|{unrealized_real:^15}|")
+    print('¯' * 102)
+    print(f"Amounts in {ref_ccy} including fees, real amounts in base-month purchasing power.")
+
+
+# What-if scenarios: the ledger's monthly cash flows and the current holdings are prepared once, then
+# every combination of an inflation shock (each monthly rate scaled by 1 + shock), a USD/TRY shock and
+# a price shock (all current prices scaled by 1 + shock) is evaluated in one batched float computation.
+def scenario_inputs(prepared: dict, current_prices: list[dict]) -> dict:
+    ref_country = prepared['ref_country']
+    months = list(iter_year_months(*prepared['base'], *prepared['current']))
+    buckets = aggregate_cash_flows(operations_until(prepared['as_of']), prepared['ref_ccy'])
+    series = load_cpi_index()[ref_country]
+    home = foreign = Decimal('0')
+    for p in current_prices:
+        value = round_money(p['price_in_ref'] * p['quantity'])
+        if p['native_country'] == ref_country:
+            home += value
+        else:
+            foreign += value
+    return {
+        'ref_country': ref_country,
+        'rates': [float(series[ym][0]) for ym in months[1:]],  # months after base, percent
+        'flows': [float(sum(buckets.get(ym, ()), Decimal('0'))) for ym in months],
+        'outflows': [float(-buckets[ym][0]) if ym in buckets else 0.0 for ym in months],
+        'home_value': float(home),
+        'foreign_value': float(foreign),
+    }
+
+
+@timed('calc.scenarios')
+def evaluate_scenarios(inputs: dict, inflation_shocks: list[float], fx_shocks: list[float],
+                       price_shocks: list[float]) -> list[dict]:
+    # Shocks are fractions (0.1 = +10%). Returns one row per combination, inflation shocks outermost.
+    rates, flows, outflows = inputs['rates'], inputs['flows'], inputs['outflows']
+    # A USD/TRY shock scales foreign holdings up for a TL reference and down for a USD reference.
+    if inputs['ref_country'] == 'TR':
+        fx_factors = [1.0 + shock for shock in fx_shocks]
+    else:
+        fx_factors = [1.0 / (1.0 + shock) for shock in fx_shocks]
+
+    if load_numpy() is not None:
+        growth = np.log1p(np.outer(1.0 + np.asarray(inflation_shocks), np.asarray(rates)) / 100.0)
+        log_deflators = np.concatenate((np.zeros((len(inflation_shocks), 1)), -np.cumsum(growth, axis=1)), axis=1)
+        deflators = np.exp(log_deflators)  # (inflation, month)
+        real_flows = deflators @ np.asarray(flows)
+        invested = deflators @ np.asarray(outflows)
+        curr_deflators = deflators[:, -1]
+        nominal = np.outer(inputs['home_value'] + inputs['foreign_value'] * np.asarray(fx_factors),
+                           1.0 + np.asarray(price_shocks))  # (fx, price)
+        real_gain = curr_deflators[:, None, None] * nominal[None] + real_flows[:, None, None]
+        real_gain_today = real_gain / curr_deflators[:, None, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            real_roi = np.where(invested[:, None, None] > 0, real_gain / invested[:, None, None] * 100.0, np.nan)
+        real_gain, real_gain_today, real_roi = real_gain.tolist(), real_gain_today.tolist(), real_roi.tolist()
+    else:
+        real_gain, real_gain_today, real_roi = [], [], []
+        for shock in inflation_shocks:
+            deflator, deflators = 1.0, [1.0]
+            for rate in rates:
+                deflator /= 1.0 + (1.0 + shock) * rate / 100.0
+                deflators.append(deflator)
+            real_flows = sum(d * flow for d, flow in zip(deflators, flows))
+            invested = sum(d * out for d, out in zip(deflators, outflows))
+            gains = [[deflator * (inputs['home_value'] + inputs['foreign_value'] * fx) * (1.0 + price) + real_flows
+                      for price in price_shocks] for fx in fx_factors]
+            real_gain.append(gains)
+            real_gain_today.append([[gain / deflator for gain in row] for row in gains])
+            real_roi.append([[gain / invested * 100.0 if invested > 0 else float('nan') for gain in row] for row in gains])
+
+    rows = []
+    for i, inflation in enumerate(inflation_shocks):
+        for j, fx in enumerate(fx_shocks):
+            for k, price in enumerate(price_shocks):
+                roi = real_roi[i][j][k]
+                rows.append({
+                    'inflation_shock_pct': inflation * 100,
+                    'fx_shock_pct': fx * 100,
+                    'price_shock_pct': price * 100,
+                    'real_gain': real_gain[i][j][k],
+                    'real_gain_today': real_gain_today[i][j][k],
+                    'real_roi': None if math.isnan(roi) else roi,
+                })
+    return rows
+
+
+def print_scenarios(rows: list[dict], ref_ccy: str):
+    print('_' * 82)
+    print(f"|{'Inflation':^11}|{'USD/TRY':^11}|{'Prices':^11}|{'Real gain':^17}|{'Real gain (today)':^17}|{'Real ROI':^9}|")
+    for row in rows:
+        roi = '----' if row['real_roi'] is None else f"{row['real_roi']:.2f}%"
+        print(f"|{row['inflation_shock_pct']:^+11.1f}|{row['fx_shock_pct']:^+11.1f}|{row['price_shock_pct']:^+11.1f}|"
+              f"{row['real_gain']:^17.2f}|{row['real_gain_today']:^17.2f}|{roi:^9}|")
+    print('¯' * 82)
+    print(f"Shocks in %, amounts in {ref_ccy}; real gain in base-month purchasing power.")
+
+
+def print_real_profit(result: dict):
+    ref_country, ref_ccy = result['ref_country'], result['ref_ccy']
+    base_year, base_month = result['base']
+    curr_year, curr_month = result['current']
     print('_' * 64)
     print(f"Reference: {ref_country} / {ref_ccy}")
     print(f"Base: {base_year}-{base_month:02d}  Current: {curr_year}-{curr_month:02d}")
-    print(f"Period CPI change: {inflation_over_period_pct:.2f}%")
+    print(f"Period CPI change: {result['inflation_over_period_pct']:.2f}%")
     print('-' * 64)
-    print(f"Real cash flows sum: {total_real_cashflows:.4f} {ref_ccy}")
-    print(f"Current portfolio (nominal): {portfolio_nominal_ref:.4f} {ref_ccy}")
-    print(f"Current portfolio (real): {portfolio_real:.4f} {ref_ccy}")
-    print(f"Real net gain: {real_gain_today:.4f} {ref_ccy} (in today's purchasing power)")
-    if real_roi is not None:
-        print(f"Real ROI: {real_roi:.2f}%  (on invested real capital {invested_real_abs:.4f} {ref_ccy})")
+    print(f"Real cash flows sum: {result['total_real_cashflows']:.4f} {ref_ccy}")
+    print(f"Current portfolio (nominal): {result['portfolio_nominal']:.4f} {ref_ccy}")
+    print(f"Current portfolio (real): {result['portfolio_real']:.4f} {ref_ccy}")
+    print(f"Real net gain: {result['real_gain_today']:.4f} {ref_ccy} (in today's purchasing power)")
+    if result['real_roi'] is not None:
+        print(f"Real ROI: {result['real_roi']:.2f}%  (on invested real capital {result['invested_real_abs']:.4f} {ref_ccy})")
     else:
         print("Real ROI: N/A (no invested capital detected)")
+    if 'real_xirr_pct' in result:
+        if result['real_xirr_pct'] is not None:
+            print(f"Real XIRR: {result['real_xirr_pct']:.2f}% per year")
+        else:
+            print("Real XIRR: N/A")
+        if result['real_twr_pct'] is not None:
+            print(f"Real TWR: {result['real_twr_pct']:.2f}% over the period")
+        elif result['twr_unpriced']:
+            print(f"Real TWR: N/A (no stored close for: {', '.join(result['twr_unpriced'])})")
+        else:
+            print("Real TWR: N/A")
     print('¯' * 64)
-    router()
- 
-    
 
-def router():
-    print()
-    print("1. US Stock Operations")
-    print("2. TR Stock Operations")
-    print("3. Edit Inflation Rates")
-    print("4. Calculate my reel profit")
-    print("5. Show my stock summary")
-    print("0. Exit")
 
+def collect_holdings(directories: list[str]) -> dict[str, list[dict]]:
+    holdings = {}
+    for directory in directories:
+        set_portfolio(directory)
+        try:
+            holdings[directory] = read_shares()
+        except (OSError, sqlite3.Error):
+            holdings[directory] = []  # reported by value_portfolio
+    return holdings
+
+
+def init_valuation_worker(cpi_index: dict, backend: str, fast_math: bool):
+    global STORAGE_BACKEND, FAST_MATH
+    STORAGE_BACKEND, FAST_MATH = backend, fast_math
+    pin_cpi_index(cpi_index)
+
+
+def value_portfolio(directory: str, ref_country: str, quotes: dict[tuple[str, str], Decimal], usdtry: Decimal | None) -> dict:
+    # Real profit of one portfolio directory against a shared quote snapshot, without prompts or network.
+    set_portfolio(directory)
     try:
-        choice = int(input("Please enter the number which indicates the operation you want to do: "))
-    except ValueError:
-        print("Please enter a number.")
-        router()
-    else:
+        prepared = prepare_real_profit(ref_country)
+        shares = read_shares()
+    except (ValueError, OSError, sqlite3.Error) as e:
+        return {'portfolio': directory, 'error': str(e)}
+    prices = {}
+    for share in shares:
+        key = (share['country_name'].strip().upper(), share['share_name'].strip().upper())
+        if key in quotes:
+            prices[share['share_name']] = quotes[key]
+    missing = [share['share_name'] for share in shares if share['share_name'] not in prices]
+    if missing:
+        return {'portfolio': directory, 'error': f"No price for: {', '.join(missing)}"}
+    if usdtry is None and needs_usdtry(shares, ref_country):
+        return {'portfolio': directory, 'error': 'No USD/TRY rate.'}
+    result = finish_real_profit(prepared, price_holdings_in_reference(shares, prices, ref_country, usdtry))
+    result.pop('curr_deflator')
+    result['portfolio'] = directory
+    return result
+
+
+def value_portfolios(directories: list[str], ref_country: str, quotes: dict[tuple[str, str], Decimal],
+                     usdtry: Decimal | None, inflation_dir: str = '.', workers: int | None = None,
+                     holdings: dict[str, list[dict]] | None = None, quote_stream=None) -> list[dict]:
+    # One CPI index (from inflation_dir) and one quote/FX snapshot are shared by every worker process.
+    # With quote_stream (pairs of iter_quotes) and holdings (of collect_holdings), quotes keeps filling
+    # while the portfolios are valued: each one goes to a worker once the last of its quotes arrived.
+    current_dir = PORTFOLIO_DIR
+    set_portfolio(inflation_dir)
+    cpi_index = load_cpi_index()
+    set_portfolio(current_dir)
+    from concurrent.futures import ProcessPoolExecutor  # pulls in multiprocessing; only calc-many needs it
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_valuation_worker,
+                             initargs=(cpi_index, STORAGE_BACKEND, FAST_MATH)) as pool:
+        if quote_stream is None:
+            futures = {directory: pool.submit(value_portfolio, directory, ref_country, quotes, usdtry)
+                       for directory in directories}
+            return [futures[directory].result() for directory in directories]
+        keys = {directory: {(share['country_name'].strip().upper(), share['share_name'].strip().upper())
+                            for share in holdings[directory]} for directory in directories}
+        waiting = {directory: keys[directory] - quotes.keys() for directory in directories}
+        futures = {}
+
+        def submit_ready():
+            for directory, missing in waiting.items():
+                if not missing and directory not in futures:
+                    snapshot = {key: quotes[key] for key in keys[directory] if key in quotes}
+                    futures[directory] = pool.submit(value_portfolio, directory, ref_country, snapshot, usdtry)
+
+        submit_ready()
+        for key, price in quote_stream:
+            if price is not None:
+                quotes[key] = price
+            for missing in waiting.values():
+                missing.discard(key)
+            submit_ready()
+        for missing in waiting.values():
+            missing.clear()  # keys the stream never delivered: value_portfolio reports them
+        submit_ready()
+        return [futures[directory].result() for directory in directories]
+
+
+def portfolio_report(results: list[dict]) -> dict:
+    valued = [result for result in results if 'error' not in result]
+    return {
+        'portfolios': results,
+        'valued': len(valued),
+        'failed': len(results) - len(valued),
+        'total_portfolio_nominal': sum((result['portfolio_nominal'] for result in valued), Decimal('0')),
+        'total_real_gain_today': sum((result['real_gain_today'] for result in valued), Decimal('0')),
+    }
+
+
+def print_portfolio_report(report: dict, ref_ccy: str):
+    print('_' * 82)
+    print(f"|{'Portfolio':^30}|{'Nominal value':^18}|{'Real net gain':^18}|{'Real ROI':^11}|")
+    for result in report['portfolios']:
+        name = os.path.basename(os.path.normpath(result['portfolio']))[:30]
+        if 'error' in result:
+            print(f"|{name:^30}| {result['error'][:48]:<48}|")
+            continue
+        roi = f"{result['real_roi']:.2f}%" if result['real_roi'] is not None else 'N/A'
+        print(f"|{name:^30}|{result['portfolio_nominal']:^18.4f}|{result['real_gain_today']:^18.4f}|{roi:^11}|")
+    print(f"|{'Total (' + ref_ccy + ')':^30}|{report['total_portfolio_nominal']:^18.4f}|{report['total_real_gain_today']:^18.4f}|{'----':^11}|")
+    print('¯' * 82)
+    print(f"Valued: {report['valued']}  Failed: {report['failed']}")
+
+
+@timed('calc.curve')
+def real_value_curve(ref_country: str) -> list[dict]:
+    # Month-by-month replay from the base month to the current month. Each month only applies that
+    # month's operations to the running holdings and cash flows, then values the holdings at the
+    # month's last historical close (see PRICE_STORE_DIR). Raises ValueError like prepare_real_profit.
+    ref_ccy = 'TL' if ref_country == 'TR' else 'USD'
+    quantity_deltas: dict[tuple[int, int], dict[str, list]] = {}
+
+    def track_quantities(operations):
+        for op in operations:
+            kind = op['transaction_type'].strip().lower()
+            if kind in ('purchase', 'sale'):
+                qty = Decimal(op['number_of_shares'])
+                month = quantity_deltas.setdefault(parse_year_month(op['date']), {})
+                entry = month.setdefault(op['stock_name'], [op['country_name'].strip().upper(), Decimal('0')])
+                entry[1] += qty if kind == 'purchase' else -qty
+            yield op
+
+    buckets = aggregate_cash_flows(track_quantities(iter_operations()), ref_ccy)
+    if not buckets:
+        raise ValueError('There has been no transaction yet. First, you need to make a transaction.')
+
+    base_year, base_month = min(buckets)
+    today = datetime.today()
+    months = list(iter_year_months(base_year, base_month, today.year, today.month))
+    deflators, missing = build_deflators(ref_country, base_year, base_month, months)
+    if missing is not None:
+        missing_str = ", ".join([f"{y}-{m:02d}" for (y, m) in sorted(missing)])
+        raise ValueError(f"Missing inflation data for: {missing_str}. Please add rates and try again.")
+
+    holdings: dict[str, list] = {}
+    cum_nominal_cashflows = Decimal('0')
+    cum_real_cashflows = Decimal('0')
+    curve = []
+    for ym in months:
+        deflator = deflators[ym]
+        for name, (country, delta) in quantity_deltas.get(ym, {}).items():
+            entry = holdings.setdefault(name, [country, Decimal('0')])
+            entry[1] += delta
+            if entry[1] <= 0:
+                del holdings[name]
+        outflows, inflows = buckets.get(ym, (Decimal('0'), Decimal('0')))
+        cum_nominal_cashflows += outflows + inflows
+        cum_real_cashflows += round_money(outflows * deflator) + round_money(inflows * deflator)
+
+        nominal_value, missing_prices = value_at_closes(holdings, f"{ym[0]}-{ym[1]:02d}-31", ref_country)
+        real_value = round_money(nominal_value * deflator)
+        curve.append({
+            'month': ym,
+            'nominal_value': nominal_value,
+            'real_value': real_value,
+            'cum_nominal_cashflows': cum_nominal_cashflows,
+            'cum_real_cashflows': cum_real_cashflows,
+            'real_gain': round_money(real_value + cum_real_cashflows),
+            'missing_prices': missing_prices,
+        })
+    return curve
+
+
+def print_real_value_curve(curve: list[dict], ref_ccy: str):
+    print('_' * 82)
+    print(f"|{'Month':^9}|{'Nominal value':^17}|{'Real value':^17}|{'Real cash flows':^17}|{'Real gain':^17}|")
+    for row in curve:
+        y, m = row['month']
+        flag = ' *' if row['missing_prices'] else ''
+        print(f"|{f'{y}-{m:02d}':^9}|{row['nominal_value']:^17.4f}|{row['real_value']:^17.4f}|"
+              f"{row['cum_real_cashflows']:^17.4f}|{row['real_gain']:^17.4f}|{flag}")
+    print('¯' * 82)
+    print(f"Amounts in {ref_ccy}, real values in base-month purchasing power.")
+    if any(row['missing_prices'] for row in curve):
+        print("* Some holdings had no stored close for that month and are not valued.")
+
+
+def calculate_reel_profit():
+    # 1) Ask reference inflation country
+    while True:
+        ref_country = input("Reference inflation (TR or US): ").strip().upper()
+        if ref_country in {'TR', 'US'}:
+            break
+        print("Please enter TR or US.")
+
+    try:
+        prepared = prepare_real_profit(ref_country)
+    except ValueError as e:
+        print(e)
+        return
+
+    with timing('calc.prices (interactive)'):
+        current_prices, usdtry = prompt_current_prices_for_shares(ref_country)
+    if current_prices is None:
+        print('Operation cancelled.')
+        return
+
+    detailed = input("Also compute the real XIRR, TWR and per-holding P&L (reads the ledger again)? (Y/N): ").strip().upper() == 'Y'
+
+    # 9) Report
+    result = finish_real_profit(prepared, current_prices)
+    if detailed:
+        result.update(real_returns(prepared, result['portfolio_nominal']))
+    print_real_profit(result)
+    if detailed:
+        print_holding_pnl(holding_pnl(prepared, current_prices), prepared['ref_ccy'])
+
+
+def storage_menu():
+    while True:
+        print()
+        print(f'Current storage backend: {STORAGE_BACKEND} (set REEL_PROFIT_STORAGE=sqlite to use {SQLITE_FILE})')
+        print('1. Import operations.csv and inflation.csv into SQLite')
+        print('2. Export SQLite into operations.csv and inflation.csv')
+        print('3. Rebuild holdings from the operations ledger')
+        print('0. Return to the previous page.')
+        choice = input("Please enter the action you wish to perform from the options above: ").strip()
+        if choice == '1':
+            import_csv_to_sqlite()
+            print(f'CSV files imported into {SQLITE_FILE}.')
+        elif choice == '2':
+            export_sqlite_to_csv()
+            print(f'{SQLITE_FILE} exported to CSV files.')
+        elif choice == '3':
+            rebuild_positions()
+            print(f'Holdings rebuilt: {len(read_shares())} open positions.')
+        elif choice != '0':
+            print('Please enter a valid number.')
+            continue
+        return
+
+
+def router():
+    while True:
+        print()
+        print("1. US Stock Operations")
+        print("2. TR Stock Operations")
+        print("3. Edit Inflation Rates")
+        print("4. Calculate my reel profit")
+        print("5. Show my stock summary")
+        print("6. Storage (CSV / SQLite)")
+        print("0. Exit")
+
+        try:
+            choice = int(input("Please enter the number which indicates the operation you want to do: "))
+        except ValueError:
+            print("Please enter a number.")
+            continue
         if choice == 1:
             print('\nYour country has been selected as US.')
             opr('US')
@@ -1070,17 +3715,372 @@ def router():
         elif choice == 4:
             calculate_reel_profit()
         elif choice == 5:
-            show_stocks()
+            if show_stocks():
+                return
+        elif choice == 6:
+            storage_menu()
         elif choice == 0:
+            checkpoint_positions()
             print("Exiting...")
             load_bar()
-
+            return
         else:
-            print("Please enter a valid number. (0-5)")
-            router()
+            print("Please enter a valid number. (0-6)")
+
+
+# Headless command line: `python main.py <command> ...` runs without prompts and exits with one of these.
+EXIT_OK = 0
+EXIT_ERROR = 1  # missing data, invalid input rows, no transactions (2 is argparse's usage error)
+EXIT_QUOTES = 3  # a price or USD/TRY could not be obtained
+
+
+def parse_manual_price(value: str) -> tuple[str, Decimal]:
+    symbol, sep, raw = value.partition('=')
+    try:
+        price = Decimal(raw.strip().replace(',', '.'))
+    except InvalidOperation:
+        price = None
+    if not sep or not symbol.strip() or price is None or price <= 0:
+        raise argparse.ArgumentTypeError(f"expected SYMBOL=PRICE with a positive price, got '{value}'")
+    return symbol.strip().upper(), price
+
+
+def add_quote_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--prices', choices=['auto', 'manual', 'history'], default='auto',
+                        help="auto: fetch every price not given with --price; manual: only use --price values; "
+                             "history: use stored closes (see import-prices), no network")
+    parser.add_argument('--price', type=parse_manual_price, action='append', default=[], metavar='SYMBOL=PRICE',
+                        help='price in the share\'s native currency (repeatable)')
+    parser.add_argument('--fx', default='auto', metavar='auto|history|RATE', help='USD/TRY rate, fetched by default')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+
+
+def parse_date(value: str) -> str:
+    if not is_valid_date(value):
+        raise argparse.ArgumentTypeError(f"expected a YYYY-MM-DD date, got '{value}'")
+    return value
+
+
+def resolve_prices(shares: list[dict], mode: str, manual: dict[str, Decimal],
+                   date: str | None = None) -> tuple[dict[str, Decimal], list[str]]:
+    # Returns ({share_name: price}, [share names without a price]). date is for mode 'history' (default today).
+    prices = {share['share_name']: manual[share['share_name']] for share in shares if share['share_name'] in manual}
+    missing = [share for share in shares if share['share_name'] not in prices]
+    if mode == 'history':
+        for share in missing:
+            close = historical_close((share['country_name'].strip().upper(), share['share_name'].strip().upper()),
+                                     date or str(datetime.today().date()))
+            if close is not None:
+                prices[share['share_name']] = close
+    elif mode == 'auto' and missing:
+        fetched, _ = fetch_share_prices([(share['country_name'], share['share_name']) for share in missing])
+        for share in missing:
+            key = (share['country_name'].strip().upper(), share['share_name'].strip().upper())
+            if key in fetched:
+                prices[share['share_name']] = fetched[key]
+    return prices, [share['share_name'] for share in shares if share['share_name'] not in prices]
+
+
+def resolve_fx(fx: str, date: str | None = None) -> Decimal | None:
+    if fx.strip().lower() == 'auto':
+        return get_usd_try()
+    if fx.strip().lower() == 'history':
+        return historical_close(('FX', 'USDTRY'), date or str(datetime.today().date()))
+    try:
+        rate = Decimal(fx.strip().replace(',', '.'))
+    except InvalidOperation:
+        return None
+    return rate if rate > 0 else None
+
+
+def json_ready(value):
+    if isinstance(value, dict):
+        return {key: json_ready(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_ready(item) for item in value]
+    if isinstance(value, tuple):
+        return f"{value[0]}-{value[1]:02d}"  # (year, month)
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+@timed('calc.prices')
+def cli_current_prices(args, date: str | None = None) -> list[dict] | None:
+    # Holdings (as of date) priced in the reference currency from the quote arguments; None after
+    # reporting a missing price or rate.
+    shares = holdings_as_of(date) if date else read_shares()
+    prices, failed = resolve_prices(shares, args.prices, dict(args.price), date)
+    if failed:
+        print(f"No price for: {', '.join(failed)}", file=sys.stderr)
+        return None
+    usdtry = None
+    if needs_usdtry(shares, args.ref):
+        usdtry = resolve_fx(args.fx, date)
+        if usdtry is None:
+            print("Failed to get the USD/TRY rate.", file=sys.stderr)
+            return None
+    return price_holdings_in_reference(shares, prices, args.ref, usdtry)
+
+
+def cli_calc(args) -> int:
+    try:
+        prepared = prepare_real_profit(args.ref, args.date)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    current_prices = cli_current_prices(args, args.date)
+    if current_prices is None:
+        return EXIT_QUOTES
+    result = finish_real_profit(prepared, current_prices)
+    if args.returns:
+        result.update(real_returns(prepared, result['portfolio_nominal']))
+    # Lots are built from another pass over the ledger, so only when --lots asks for them.
+    holdings = holding_pnl(prepared, current_prices, args.lots) if args.lots else None
+    if args.json:
+        result.pop('curr_deflator')
+        if holdings is not None:
+            result['holdings'] = holdings
+        print(json.dumps(json_ready(result), indent=2))
+    else:
+        print_real_profit(result)
+        if holdings is not None:
+            print_holding_pnl(holdings, result['ref_ccy'])
+    return EXIT_OK
+
+
+def parse_shocks(value: str) -> list[float]:
+    # Comma-separated percentages and/or START:STOP:STEP ranges (STOP included), e.g. "-10,0,10" or "-30:30:5".
+    shocks = []
+    try:
+        for part in value.split(','):
+            if ':' in part:
+                start, stop, step = (Decimal(item) for item in part.split(':'))
+                if step <= 0 or stop < start:
+                    raise ValueError
+                while start <= stop:
+                    shocks.append(float(start) / 100)
+                    start += step
+            else:
+                shocks.append(float(Decimal(part)) / 100)
+    except (ValueError, InvalidOperation):
+        raise argparse.ArgumentTypeError(f"expected percentages like -10,0,10 or -30:30:5, got '{value}'")
+    if any(shock <= -1 for shock in shocks):
+        raise argparse.ArgumentTypeError('shocks must be above -100%')
+    return shocks
+
+
+def cli_scenarios(args) -> int:
+    try:
+        prepared = prepare_real_profit(args.ref)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    current_prices = cli_current_prices(args)
+    if current_prices is None:
+        return EXIT_QUOTES
+    rows = evaluate_scenarios(scenario_inputs(prepared, current_prices), args.inflation, args.fx_shock, args.price_shock)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_scenarios(rows, prepared['ref_ccy'])
+    return EXIT_OK
+
+
+def cli_show(args) -> int:
+    shares = read_shares()
+    prices, failed = resolve_prices(shares, args.prices, dict(args.price))
+    for name in failed:
+        print(f"Failed to get the price for {name}. This share will be excluded from the list.", file=sys.stderr)
+    dollar = resolve_fx(args.fx)
+    if dollar is None:
+        print("Failed to get the USD/TRY rate.", file=sys.stderr)
+        return EXIT_QUOTES
+    rows = [dict(share, price=prices[share['share_name']]) for share in shares if share['share_name'] in prices]
+    summary = stock_summary(rows, dollar)
+    if args.json:
+        print(json.dumps(json_ready(summary), indent=2))
+    else:
+        print_stock_summary(summary)
+    return EXIT_QUOTES if failed else EXIT_OK
+
+
+def cli_import_inflation(args) -> int:
+    try:
+        added, updated, errors, gaps = import_inflation_series(args.file, args.allow_gaps)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    for error in errors:
+        print(error, file=sys.stderr)
+    for country, missing in gaps.items():
+        print(f"{country} missing months: {format_gaps(missing)}", file=sys.stderr)
+    if errors or (gaps and not args.allow_gaps):
+        print("Nothing imported." + ("" if errors else " Add the missing months or pass --allow-gaps."))
+        return EXIT_ERROR
+    print(f"Inflation rows added: {added}, updated: {updated}")
+    return EXIT_OK
+
+
+def cli_import_prices(args) -> int:
+    try:
+        imported, written, errors = import_price_history(args.file)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f"Closes imported: {imported} into {written} series, rejected: {len(errors)}")
+    return EXIT_ERROR if errors else EXIT_OK
+
+
+def cli_import_operations(args) -> int:
+    try:
+        written, errors = import_operations(args.file, args.dry_run)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors:
+        print(f"Nothing imported, {len(errors)} row(s) rejected.")
+        return EXIT_ERROR
+    print("Statement is valid." if args.dry_run else f"Operations imported: {written}")
+    return EXIT_OK
+
+
+def cli_curve(args) -> int:
+    try:
+        curve = real_value_curve(args.ref)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_ERROR
+    if args.json:
+        print(json.dumps(json_ready(curve), indent=2))
+    else:
+        print_real_value_curve(curve, 'TL' if args.ref == 'TR' else 'USD')
+    return EXIT_QUOTES if any(row['missing_prices'] for row in curve) else EXIT_OK
+
+
+def report_failed_quotes(quote_stream):
+    for key, price in quote_stream:
+        if price is None:
+            print(f"Failed to fetch the price for {key[1]} ({key[0]}).", file=sys.stderr)
+        yield key, price
+
+
+def cli_calc_many(args) -> int:
+    directories = args.portfolios
+    holdings = collect_holdings(directories)
+    set_portfolio(args.inflation_dir)  # shared market data: stored closes and the quote cache
+    all_shares = [share for shares in holdings.values() for share in shares]
+    manual = dict(args.price)
+    quotes = {}
+    for share in all_shares:
+        if share['share_name'] in manual:
+            quotes[(share['country_name'].strip().upper(), share['share_name'].strip().upper())] = manual[share['share_name']]
+    if args.prices == 'history':
+        for share in all_shares:
+            key = (share['country_name'].strip().upper(), share['share_name'].strip().upper())
+            if share['share_name'] not in manual:
+                close = historical_close(key, str(datetime.today().date()))
+                if close is None:
+                    print(f"No stored close for {key[1]} ({key[0]}).", file=sys.stderr)
+                else:
+                    quotes[key] = close
+    usdtry = resolve_fx(args.fx) if needs_usdtry(all_shares, args.ref) else None
+    quote_stream = None
+    if args.prices == 'auto':
+        # Portfolios are valued while the remaining quotes are still arriving.
+        quote_stream = report_failed_quotes(iter_quotes([(share['country_name'], share['share_name'])
+                                                         for share in all_shares if share['share_name'] not in manual]))
+
+    report = portfolio_report(value_portfolios(directories, args.ref, quotes, usdtry, args.inflation_dir, args.workers,
+                                               holdings, quote_stream))
+    if args.json:
+        print(json.dumps(json_ready(report), indent=2))
+    else:
+        print_portfolio_report(report, 'TL' if args.ref == 'TR' else 'USD')
+    return EXIT_ERROR if report['failed'] else EXIT_OK
+
+
+def run_cli(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog='main.py', description='Reel profit calculator. Run without arguments for the interactive menu.')
+    parser.add_argument('--portfolio', default='.', metavar='DIR', help='directory holding the portfolio files')
+    parser.add_argument('--timings', action='store_const', const='text',
+                        help='report time spent in HTTP, file I/O and calculation phases on stderr')
+    parser.add_argument('--timings-json', dest='timings', action='store_const', const='json',
+                        help='like --timings, as JSON')
+    parser.add_argument('--profile', metavar='FILE', help='write a cProfile of the run to FILE (pstats format)')
+    parser.add_argument('--trace-memory', action='store_true', help='report memory allocations (tracemalloc)')
+    parser.add_argument('--quote-file', default=QUOTE_FILE, metavar='CSV',
+                        help="quotes for the 'file' provider (country,symbol,price; FX,USDTRY for the rate)")
+    parser.add_argument('--quote-providers', default=os.environ.get('REEL_PROFIT_QUOTE_PROVIDERS'), metavar='SPEC',
+                        help="provider order per market, e.g. 'US=cnbc,file;TR=file;FX=file'")
+    commands = parser.add_subparsers(dest='command', required=True)
+    calc = commands.add_parser('calc', help='calculate the real profit')
+    calc.add_argument('--ref', choices=['TR', 'US'], required=True, type=str.upper, help='reference inflation')
+    calc.add_argument('--date', type=parse_date, default=None, metavar='YYYY-MM-DD',
+                      help='value the ledger as of this date (use with --prices history --fx history offline)')
+    calc.add_argument('--returns', action='store_true', help='also report the real XIRR and TWR (one more ledger pass)')
+    calc.add_argument('--lots', choices=LOT_METHODS, default=None,
+                      help='add the per-holding P&L, matching sales to purchases first-in first-out or at average cost')
+    add_quote_arguments(calc)
+    calc.set_defaults(handler=cli_calc)
+    scenarios = commands.add_parser('scenarios', help='real gain under inflation, USD/TRY and price shocks')
+    scenarios.add_argument('--ref', choices=['TR', 'US'], required=True, type=str.upper, help='reference inflation')
+    scenarios.add_argument('--inflation', type=parse_shocks, default=[0.0], metavar='PCTS',
+                           help='relative changes of every monthly inflation rate, e.g. --inflation=-20,0,20 or '
+                                '--inflation=-50:50:10 (use = when the list starts with a minus)')
+    scenarios.add_argument('--fx-shock', type=parse_shocks, default=[0.0], metavar='PCTS',
+                           help='USD/TRY changes, e.g. --fx-shock=-30:30:10')
+    scenarios.add_argument('--price-shock', type=parse_shocks, default=[0.0], metavar='PCTS',
+                           help='current price changes, e.g. --price-shock=-10,0,10')
+    add_quote_arguments(scenarios)
+    scenarios.set_defaults(handler=cli_scenarios)
+    show = commands.add_parser('show', help='show the stock summary')
+    add_quote_arguments(show)
+    show.set_defaults(handler=cli_show)
+    import_inflation = commands.add_parser('import-inflation', help='add or update inflation rows from a CSV or JSON file')
+    import_inflation.add_argument('file', help='CSV with month,year,country,rate columns or JSON (see README)')
+    import_inflation.add_argument('--allow-gaps', action='store_true', help='import even if months are missing in between')
+    import_inflation.set_defaults(handler=cli_import_inflation)
+    import_operations_parser = commands.add_parser('import-operations', help='add the trades of a broker statement in one batch')
+    import_operations_parser.add_argument('file', help='CSV with the operations.csv columns except id, tl_price and usd_price')
+    import_operations_parser.add_argument('--dry-run', action='store_true', help='only validate the file')
+    import_operations_parser.set_defaults(handler=cli_import_operations)
+    import_prices = commands.add_parser('import-prices', help='load daily closes into the local price store')
+    import_prices.add_argument('file', help='CSV with date,country,symbol,close columns (USD/TRY: FX,USDTRY)')
+    import_prices.set_defaults(handler=cli_import_prices)
+    curve = commands.add_parser('curve', help='monthly nominal and real portfolio value from historical closes')
+    curve.add_argument('--ref', choices=['TR', 'US'], required=True, type=str.upper, help='reference inflation')
+    curve.add_argument('--json', action='store_true', help='print the result as JSON')
+    curve.set_defaults(handler=cli_curve)
+    calc_many = commands.add_parser('calc-many', help='calculate the real profit of many portfolio directories in parallel')
+    calc_many.add_argument('portfolios', nargs='+', metavar='DIR', help='portfolio directories')
+    calc_many.add_argument('--ref', choices=['TR', 'US'], required=True, type=str.upper, help='reference inflation')
+    calc_many.add_argument('--inflation-dir', default='.', metavar='DIR', help='directory whose inflation data and stored closes all portfolios use')
+    calc_many.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    add_quote_arguments(calc_many)
+    calc_many.set_defaults(handler=cli_calc_many)
+    args = parser.parse_args(argv)
+    try:
+        configure_quote_providers(args.quote_file, args.quote_providers)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with instrumented_run(args.timings, args.profile, args.trace_memory):
+        set_portfolio(args.portfolio)
+        create_files()
+        try:
+            return args.handler(args)
+        finally:
+            checkpoint_positions()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     print('-' * 20 + "Welcome to Reel Profit Application" + '-' * 20) #74
     load_bar()
     if not is_info_file_exist():
@@ -1090,4 +4090,10 @@ if __name__ == '__main__':
         usr_info = get_usr_info()
         print(f"Hello {usr_info[0]}")
         print("You can operate what you want.")
-    router()
+    try:
+        configure_quote_providers(QUOTE_FILE, os.environ.get('REEL_PROFIT_QUOTE_PROVIDERS'))
+    except ValueError as e:
+        print(f"Ignoring REEL_PROFIT_QUOTE_PROVIDERS: {e}")
+    with instrumented_run(profile_path=os.environ.get('REEL_PROFIT_PROFILE') or None,
+                          trace_memory=os.environ.get('REEL_PROFIT_TRACE_MEMORY', '').strip() == '1'):
+        router()
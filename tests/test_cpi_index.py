@@ -0,0 +1,71 @@
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+@pytest.fixture
+def portfolio(tmp_path, monkeypatch):
+    # 2022-01..2023-12 TR rates without 2022-07, and a short US series; counts full rebuilds.
+    main.set_portfolio(str(tmp_path))
+    main.create_files()
+    rates = {('TR', year, month): Decimal(month + year % 10) / 4 for year in (2022, 2023) for month in range(1, 13)
+             if (year, month) != (2022, 7)}
+    rates.update({('US', 2023, month): Decimal('0.3') for month in range(1, 7)})
+    main.set_inflation_rates(rates)
+    main.load_cpi_index()
+    rebuilds = []
+    rebuild = main.rebuild_cpi_index
+    monkeypatch.setattr(main, 'rebuild_cpi_index', lambda: rebuilds.append(1) or rebuild())
+    yield rebuilds
+    main.set_portfolio('.')
+
+
+def assert_matches_rebuild(rebuilds):
+    # The incrementally updated index equals one built from scratch, in memory and on disk.
+    assert not rebuilds
+    updated = {country: dict(series) for country, series in main.load_cpi_index().items()}
+    assert main.read_cpi_index_file() and main._cpi_index == updated
+    main._cpi_index = None
+    os.remove(main.portfolio_path(main.CPI_INDEX_FILE))
+    assert {country: dict(series) for country, series in main.load_cpi_index().items()} == updated
+    rebuilds.clear()
+
+
+def test_add_fills_a_gap(portfolio):
+    assert main.add_inflation_rate(7, 2022, 'TR', Decimal('2.5'))
+    assert_matches_rebuild(portfolio)
+    assert main.load_cpi_index()['TR'][(2023, 12)][2] == (2022, 1)
+
+
+def test_edit_early_month(portfolio):
+    assert main.set_inflation_rate(2, 2022, 'TR', Decimal('9.75'))
+    assert_matches_rebuild(portfolio)
+
+
+def test_delete_splits_a_run(portfolio):
+    assert main.set_inflation_rate(3, 2023, 'TR', None)
+    assert_matches_rebuild(portfolio)
+    assert main.load_cpi_index()['TR'][(2023, 4)][2] == (2023, 4)
+
+
+def test_batch_over_both_countries(portfolio):
+    main.set_inflation_rates({('TR', 2022, 7): Decimal('1'), ('TR', 2024, 1): Decimal('3'),
+                              ('US', 2023, 3): Decimal('-0.1'), ('US', 2022, 12): Decimal('0.2')})
+    assert_matches_rebuild(portfolio)
+
+
+def test_deflators_compound_the_monthly_rates(portfolio):
+    assert main.add_inflation_rate(7, 2022, 'TR', Decimal('2.5'))
+    deflators, missing = main.build_deflators('TR', 2022, 3, [(2022, 3), (2022, 9)])
+    assert missing is None
+    index = Decimal('1')
+    for month in range(4, 10):
+        rate = Decimal('2.5') if month == 7 else Decimal(month + 2) / 4
+        index *= 1 + rate / 100
+    assert abs(deflators[(2022, 9)] - 1 / index) < Decimal('1e-20')
+    assert main.build_deflators('TR', 2021, 11, [(2022, 2)])[1] == {(2021, 12)}
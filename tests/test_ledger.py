@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+HEADER = ','.join(main.OPERATIONS_FIELDS) + '\r\n'
+ROWS = [
+    '1,THYAO,TR,purchase,10,100,1,30,TL,2024-01-10,1001,33.37',
+    '2,THYAO,TR,sale,12,50,1,32,TL,2024-06-10,599,18.72',
+]
+
+
+@pytest.fixture
+def portfolio(tmp_path):
+    main.set_portfolio(str(tmp_path))
+    yield tmp_path
+    main.set_portfolio('.')
+
+
+def test_unterminated_last_row_is_counted_and_ended(portfolio):
+    # A hand-edited ledger whose last row has no line break: the fold and the csv readers must agree on it.
+    ledger = portfolio / 'operations.csv'
+    ledger.write_bytes((HEADER + '\r\n'.join(ROWS)).encode())
+    main.create_files()
+    assert ledger.read_bytes().endswith(b'\r\n')
+    assert main.load_positions()['THYAO'] == ['TR', 50]
+    assert [row['id'] for row in main.iter_operations()] == ['1', '2']
+    main.append_operations([['ASELS', 'TR', 'purchase', '5', '10', '1', '30', 'TL', '2024-07-01', '51', '1.7']])
+    assert [row['stock_name'] for row in main.iter_operations()] == ['THYAO', 'THYAO', 'ASELS']
+
+
+def test_directory_without_ledger_gets_no_checkpoint(portfolio):
+    with pytest.raises(OSError):
+        main.read_shares()
+    main.set_portfolio('.')
+    assert not (portfolio / main.POSITIONS_FILE).exists()
+
+
+def test_next_id_follows_the_highest_id(portfolio):
+    # A reordered ledger whose last row does not hold the highest id.
+    ledger = portfolio / 'operations.csv'
+    ledger.write_bytes((HEADER + ROWS[1].replace('2,', '7,', 1) + '\r\n' + ROWS[0] + '\r\n').encode())
+    main.create_files()
+    assert main.append_operation(['ASELS', 'TR', 'purchase', '5', '10', '1', '30', 'TL', '2024-07-01', '51', '1.7']) == 8
+    assert main.append_operation(['ASELS', 'TR', 'sale', '6', '5', '1', '31', 'TL', '2024-08-01', '29', '0.9']) == 9
+    main.rebuild_ledger_index()
+    assert main.ensure_ledger_index() == 10
+    assert [row['id'] for row in main.iter_operations()] == ['7', '1', '8', '9']
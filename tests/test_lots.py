@@ -0,0 +1,75 @@
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+AS_OF = '2024-06-28'
+PRICES = {'THYAO': Decimal('140'), 'AAPL': Decimal('210'), 'ASELS': Decimal('55')}
+TRADES = [
+    # symbol, country, kind, price, quantity, fee, USD/TRY, date
+    ('THYAO', 'TR', 'purchase', '100', '10', '1', '30', '2024-01-15'),
+    ('AAPL', 'US', 'purchase', '180', '4', '2', '30.5', '2024-02-03'),
+    ('THYAO', 'TR', 'purchase', '120', '10', '1', '31', '2024-02-20'),
+    ('ASELS', 'TR', 'purchase', '45', '30', '3', '31.5', '2024-03-05'),
+    ('THYAO', 'TR', 'sale', '130', '15', '1', '32', '2024-04-10'),
+    ('ASELS', 'TR', 'sale', '50', '30', '3', '32.2', '2024-05-02'),
+    ('AAPL', 'US', 'sale', '200', '1', '2', '32.5', '2024-06-12'),
+]
+
+
+@pytest.fixture
+def portfolio(tmp_path):
+    main.set_portfolio(str(tmp_path))
+    main.create_files()
+    main.set_inflation_rates({(country, 2024, month): Decimal(rate) for month, rate in enumerate(
+        ('6.7', '4.5', '3.2', '3.2', '3.4', '1.6'), start=1) for country in ('TR',)})
+    for symbol, country, kind, price, qty, fee, rate, date in TRADES:
+        currency = 'TL' if country == 'TR' else 'USD'
+        tl_price, usd_price = main.operation_totals(Decimal(price), Decimal(qty), Decimal(rate), currency)
+        main.append_operation([symbol, country, kind, price, qty, fee, rate, currency, date, tl_price, usd_price])
+    yield tmp_path
+    main.set_portfolio('.')
+
+
+def valuation() -> tuple[dict, list[dict]]:
+    prepared = main.prepare_real_profit('TR', AS_OF)
+    current = main.price_holdings_in_reference(main.holdings_as_of(AS_OF), PRICES, 'TR', Decimal('33'))
+    return main.finish_real_profit(prepared, current), current
+
+
+@pytest.mark.parametrize('method', main.LOT_METHODS)
+def test_realized_and_unrealized_add_up_to_the_real_gain(portfolio, method):
+    result, current = valuation()
+    rows = main.holding_pnl(result, current, method)
+    assert {row['share_name'] for row in rows} == {'THYAO', 'AAPL', 'ASELS'}
+    real = sum(row['realized_real'] + (row['unrealized_real'] or 0) for row in rows)
+    # Real cash flows are rounded per month and the lots per trade: a cent per trade at most.
+    assert abs(real - result['real_gain']) <= Decimal('0.01') * len(TRADES)
+    nominal = sum(row['realized'] + (row['unrealized'] or 0) for row in rows)
+    flows = sum((1 if kind == 'sale' else -1) * Decimal(price) * Decimal(qty) * (1 if country == 'TR' else Decimal(rate))
+                - Decimal(fee) * (1 if country == 'TR' else Decimal(rate))
+                for _, country, kind, price, qty, fee, rate, _ in TRADES)
+    assert nominal == flows + result['portfolio_nominal']
+
+
+def test_fifo_and_average_cost_split(portfolio):
+    result, current = valuation()
+    fifo = {row['share_name']: row for row in main.holding_pnl(result, current, 'fifo')}['THYAO']
+    average = {row['share_name']: row for row in main.holding_pnl(result, current, 'average')}['THYAO']
+    # Lots of 10 at 1001 and 10 at 1201 (fees included); 15 sold for 1950 less a fee of 1.
+    assert (fifo['quantity'], fifo['cost_basis'], fifo['realized']) == (5, Decimal('600.50'), Decimal('347.50'))
+    assert (average['quantity'], average['cost_basis'], average['realized']) == (5, Decimal('550.50'), Decimal('297.50'))
+    assert fifo['market_value'] == average['market_value'] == Decimal('700.00')
+    assert fifo['realized'] + fifo['unrealized'] == average['realized'] + average['unrealized']
+    # Real amounts in January lira: the February lot and the April sale deflated by the compounded rates.
+    feb_lot = main.round_money(Decimal('1201') / Decimal('1.045'))
+    april_sale = main.round_money(Decimal('1949') / (Decimal('1.045') * Decimal('1.032') * Decimal('1.032')))
+    assert fifo['realized_real'] == april_sale - 1001 - main.round_money(feb_lot / 2)
+    assert average['realized_real'] == april_sale - main.round_money((1001 + feb_lot) * Decimal('0.75'))
+    closed = {row['share_name']: row for row in main.holding_pnl(result, current, 'fifo')}['ASELS']
+    assert (closed['quantity'], closed['market_value'], closed['realized']) == (0, None, Decimal('144'))
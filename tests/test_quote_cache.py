@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+@pytest.fixture
+def providers(tmp_path, monkeypatch):
+    # A fresh quote cache in a temporary portfolio and a 'US' market whose providers the test registers.
+    monkeypatch.setattr(main, '_quote_providers', {})
+    monkeypatch.setattr(main, '_quote_cache', main.OrderedDict())
+    main.set_portfolio(str(tmp_path))
+    yield tmp_path
+    main.set_portfolio('.')
+
+
+def test_live_quotes_are_cached_in_the_portfolio_directory(providers):
+    calls = []
+    main.register_quote_provider('US', 'live', lambda symbol: calls.append(symbol) or Decimal('10.5'))
+    assert main.get_share_price('US', 'aapl') == Decimal('10.5')
+    assert main.get_share_price('US', 'AAPL') == Decimal('10.5')
+    assert calls == ['AAPL']
+    assert not (providers / main.QUOTE_CACHE_FILE).exists()  # written once per batch, not per quote
+    main.save_quote_cache()
+    assert json.loads((providers / main.QUOTE_CACHE_FILE).read_text())[0][:3] == ['US', 'AAPL', '10.5']
+
+
+def test_local_quotes_are_not_cached(providers):
+    main.register_quote_provider('US', 'live', lambda symbol: None)
+    main.register_quote_provider('US', 'file', lambda symbol: Decimal('7'), local=True)
+    assert main.get_share_price('US', 'MSFT') == Decimal('7')
+    assert main.cache_get(('US', 'MSFT')) is None
+    assert not (providers / main.QUOTE_CACHE_FILE).exists()
+
+
+def test_hedged_local_backup_is_not_cached(providers, monkeypatch):
+    monkeypatch.setattr(main, 'HEDGE_MIN_SAMPLES', 0)
+    main.register_quote_provider('US', 'live', lambda symbol: None)
+    main.register_quote_provider('US', 'file', lambda symbol: Decimal('7'), local=True)
+    main.quote_providers('US')[0].latencies.append(0.0)
+    value, provider = main.answered_quote('US', 'MSFT')
+    assert (value, provider.name) == (Decimal('7'), 'file')
+    assert main.get_share_price('US', 'MSFT') == Decimal('7')
+    assert main.cache_get(('US', 'MSFT')) is None
+
+
+def test_streamed_quotes_are_saved_once(providers, monkeypatch):
+    writes = []
+    atomic_write = main.atomic_write
+    monkeypatch.setattr(main, 'atomic_write', lambda path, data: writes.append(path) or atomic_write(path, data))
+    main.register_quote_provider('US', 'live', lambda symbol: Decimal(len(symbol)))
+    prices, failed = main.fetch_share_prices([('US', symbol) for symbol in ('A', 'BB', 'CCC', 'DDDD')])
+    assert len(prices) == 4 and not failed
+    assert writes == [str(providers / main.QUOTE_CACHE_FILE)]
+    assert len(json.loads((providers / main.QUOTE_CACHE_FILE).read_text())) == 4
@@ -0,0 +1,137 @@
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CNBC = ('span', 'QuoteStrip-lastPrice')
+DOVIZ = ('div', 'text-xl font-semibold text-white')
+
+
+def page(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), mode='rb') as f:
+        return f.read()
+
+
+def chunked(content: bytes, size: int) -> list[bytes]:
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def scan(content: bytes, element: tuple[str, str], size: int = main.STREAM_CHUNK_SIZE) -> str | None:
+    return main.scan_element_text(chunked(content, size), main.element_text_pattern(*element))[0]
+
+
+def xpath(content: bytes, element: tuple[str, str]) -> str | None:
+    return main.xpath_text(content, f'//{element[0]}[@class="{element[1]}"]/text()')
+
+
+class FakeResponse:
+    # What fetch_element_text uses of a streamed requests.Response.
+    def __init__(self, content: bytes):
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))}
+        self.read = 0
+        self.closed = False
+        self.raw = self
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size: int):
+        for chunk in chunked(self.content, size):
+            self.read += len(chunk)
+            yield chunk
+
+    def tell(self) -> int:
+        return self.read
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def served(monkeypatch):
+    # Serves the named fixture to every http_get and keeps the responses for inspection.
+    responses = []
+
+    def serve(name: str):
+        def http_get(url, **kwargs):
+            responses.append(FakeResponse(page(name)))
+            return responses[-1]
+        monkeypatch.setattr(main, 'http_get', http_get)
+        return responses
+    return serve
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 1024, main.STREAM_CHUNK_SIZE])
+@pytest.mark.parametrize('name, element, expected', [
+    ('cnbc_quote.html', CNBC, '1,234.56'),
+    ('doviz_usd.html', DOVIZ, '41,2345'),
+])
+def test_scan_matches_xpath_across_chunk_boundaries(name, element, expected, size):
+    content = page(name)
+    assert scan(content, element, size) == expected
+    assert xpath(content, element) == expected
+
+
+@pytest.mark.parametrize('size', [1, 5, main.STREAM_CHUNK_SIZE])
+def test_scan_unescapes_entities(size):
+    content = page('cnbc_entities.html')
+    assert scan(content, CNBC, size) == '$\xa098.76'
+    assert xpath(content, CNBC) == '$\xa098.76'
+
+
+def test_whitespace_only_first_match_is_skipped():
+    # XPath returns the blank text of the first element; the scan moves on to the next one with a value.
+    content = page('cnbc_whitespace_first.html')
+    assert xpath(content, CNBC).strip() == ''
+    assert scan(content, CNBC) == '187.44'
+    assert scan(content, CNBC, 3) == '187.44'
+
+
+def test_value_in_child_node_is_left_to_xpath(served):
+    content = page('cnbc_nested_value.html')
+    assert scan(content, CNBC) is None
+    served('cnbc_nested_value.html')
+    assert main.fetch_element_text('https://www.cnbc.com/quotes/MSFT', *CNBC) == '412.05'
+
+
+def test_page_without_quote(served):
+    content = page('cnbc_no_quote.html')
+    assert scan(content, CNBC) is None
+    assert xpath(content, CNBC) is None
+    responses = served('cnbc_no_quote.html')
+    assert main.fetch_element_text('https://www.cnbc.com/quotes/NOPE', *CNBC) is None
+    assert responses[0].closed
+
+
+def test_reading_stops_at_the_quote(served, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_CHUNK_SIZE', 64)
+    monkeypatch.setattr(main, 'STREAM_DRAIN_LIMIT', 0)
+    responses = served('cnbc_quote.html')
+    assert main.fetch_element_text('https://www.cnbc.com/quotes/AAPL', *CNBC) == '1,234.56'
+    assert responses[0].read < len(responses[0].content)
+    assert responses[0].closed
+
+
+def test_small_rest_is_drained_for_keep_alive(served, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_CHUNK_SIZE', 64)
+    responses = served('cnbc_quote.html')
+    assert main.fetch_element_text('https://www.cnbc.com/quotes/AAPL', *CNBC) == '1,234.56'
+    assert responses[0].read == len(responses[0].content)
+
+
+def test_quote_functions_parse_saved_pages(served):
+    served('cnbc_quote.html')
+    assert main.get_share_price_us('aapl') == Decimal('1234.56')
+    served('cnbc_entities.html')
+    assert main.get_share_price_us('AAPL') == Decimal('98.76')
+    served('cnbc_no_quote.html')
+    assert main.get_share_price_us('NOPE') is None
+    served('doviz_usd.html')
+    assert main.get_dollar() == Decimal('41.2345')